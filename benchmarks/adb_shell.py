@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2018  Muhammed Ziad
+# This file is part of XenDroid - https://github.com/muhzii/XenDroid
+#
+# An instrumented sandbox for Android
+# This program is a free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License
+
+"""
+Compare the fork-per-call `adb shell` path with the persistent shell session
+usage: python -m benchmarks.adb_shell -s <serial> [-n <calls>]
+"""
+
+import time
+import argparse
+
+from modules.connection.adb import ADB
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark adb shell round trips")
+
+    parser.add_argument("-s", action="store", required=True, dest="serial",
+                        help="device serial as per the output of 'adb devices'")
+
+    parser.add_argument("-n", action="store", type=int, default=200, dest="calls",
+                        help="number of shell commands to issue per mode")
+
+    parser.add_argument("-c", action="store", default="getprop ro.build.version.sdk", dest="cmd",
+                        help="shell command to issue")
+
+    return parser.parse_args()
+
+
+def time_calls(adb_connection, cmd, calls):
+    """
+    issue the same shell command repeatedly
+    :return: total elapsed seconds
+    """
+    # warm up, this also opens the session in persistent mode
+    adb_connection.shell(cmd)
+
+    start = time.time()
+    for _ in range(calls):
+        adb_connection.shell(cmd)
+    return time.time() - start
+
+
+def run():
+    options = parse_args()
+
+    fork_adb = ADB(options.serial)
+    session_adb = ADB(options.serial, persistent_shell=True)
+
+    try:
+        results = [
+            ('fork-per-call', time_calls(fork_adb, options.cmd, options.calls)),
+            ('persistent session', time_calls(session_adb, options.cmd, options.calls)),
+        ]
+    finally:
+        session_adb.close()
+
+    for mode, elapsed in results:
+        print('{:<20} {:>8.2f} ms/call {:>10.1f} calls/s'.format(
+            mode, elapsed * 1000 / options.calls, options.calls / elapsed))
+
+    print('speedup: {:.1f}x'.format(results[0][1] / results[1][1]))
+
+
+if __name__ == "__main__":
+    run()
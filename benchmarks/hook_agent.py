@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2018  Muhammed Ziad
+# This file is part of XenDroid - https://github.com/muhzii/XenDroid
+#
+# An instrumented sandbox for Android
+# This program is a free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License
+
+"""
+Compare the per-hook generated agent of `ScriptFactory` with the table driven one
+of `TableAgentFactory`, the script sizes are always reported, the hook install
+times only when a device and a package to spawn are given
+usage: python -m benchmarks.hook_agent [-s <serial> -p <package>] [-n <runs>]
+"""
+
+import os
+import json
+import time
+import argparse
+import threading
+
+from lib.definitions.constants import ROOT_DIR
+from modules.monitoring.api_mon import ScriptFactory, TableAgentFactory
+
+# reports how long the hooks took to install, java.perform callbacks run in order
+# so this one runs after the agent's
+INSTALL_PROBE = \
+    """
+    Java.perform(function() {
+        send({"type": "xendroid-bench", "elapsed": Date.now() - xendroidBenchStart});
+    });
+    """
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the generated frida agents")
+
+    parser.add_argument("-s", action="store", dest="serial",
+                        help="device serial as per the output of 'adb devices'")
+
+    parser.add_argument("-p", action="store", dest="package",
+                        help="package name of an installed app to spawn")
+
+    parser.add_argument("-n", action="store", type=int, default=5, dest="runs",
+                        help="number of spawns per agent")
+
+    return parser.parse_args()
+
+
+def time_install(frida_connection, package, source):
+    """
+    spawn the app, load the agent and wait for its hooks to be installed
+    :return: tuple of (seconds spent in `load`, milliseconds reported by the agent)
+    """
+    installed = threading.Event()
+    result = {}
+
+    def on_message(message, data):
+        payload = message.get('payload')
+        if message['type'] == 'send' and isinstance(payload, dict) and payload.get('type') == 'xendroid-bench':
+            result['elapsed'] = payload['elapsed']
+            installed.set()
+
+    frida_connection.spawn_app(package)
+    frida_connection.set_msg_handler(on_message)
+    frida_connection.start_session()
+
+    start = time.time()
+    frida_connection.load_script('var xendroidBenchStart = Date.now();\n' + source + INSTALL_PROBE)
+    load_time = time.time() - start
+
+    installed.wait(60)
+    frida_connection.terminate_session()
+    frida_connection.device.kill(frida_connection.pid)
+    return load_time, result.get('elapsed')
+
+
+def run():
+    options = parse_args()
+
+    with open(os.path.join(ROOT_DIR, 'utils', 'hooking', 'hooks_def.json'), 'r') as fh:
+        hooks_def = json.load(fh)
+
+    factories = [('generated', ScriptFactory), ('table', TableAgentFactory)]
+    agents = []
+    for name, factory in factories:
+        start = time.time()
+        source = factory.build_agent(hooks_def)
+        agents.append((name, source))
+        print('{:<10} {:>8d} bytes, generated in {:.2f} ms'.format(
+            name, len(source), (time.time() - start) * 1000))
+
+    if not (options.serial and options.package):
+        return
+
+    from modules.connection.Frida import Frida
+    frida_connection = Frida(options.serial)
+
+    for name, source in agents:
+        loads, installs = [], []
+        for _ in range(options.runs):
+            load_time, install_time = time_install(frida_connection, options.package, source)
+            loads.append(load_time)
+            if install_time is not None:
+                installs.append(install_time)
+
+        print('{:<10} load {:>8.1f} ms, hooks installed in {} (avg of {} runs)'.format(
+            name, sum(loads) * 1000 / len(loads),
+            '{:.1f} ms'.format(float(sum(installs)) / len(installs)) if installs else 'n/a', options.runs))
+
+
+if __name__ == "__main__":
+    run()
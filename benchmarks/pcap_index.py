@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2018  Muhammed Ziad
+# This file is part of XenDroid - https://github.com/muhzii/XenDroid
+#
+# An instrumented sandbox for Android
+# This program is a free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License
+
+"""
+Measure the throughput of the traffic index over a synthetic capture mixing
+DNS lookups, HTTP requests, TLS handshakes and bulk TCP transfers
+usage: python -m benchmarks.pcap_index [-n <packets>] [-f <flows>] [--pcapng] [-o <capture path>]
+"""
+
+import os
+import io
+import time
+import shutil
+import struct
+import socket
+import argparse
+import tempfile
+
+from modules.analysing.traffic import index_capture
+
+ETHERNET_HEADER = b'\x02\x00\x00\x00\x00\x01\x02\x00\x00\x00\x00\x02\x08\x00'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the pcap traffic index")
+
+    parser.add_argument("-n", action="store", type=int, default=1000000, dest="packets",
+                        help="number of packets in the synthetic capture")
+
+    parser.add_argument("-f", action="store", type=int, default=10000, dest="flows",
+                        help="number of distinct flows")
+
+    parser.add_argument("--pcapng", action="store_true", dest="pcapng",
+                        help="write the capture as pcapng instead of pcap")
+
+    parser.add_argument("-o", action="store", dest="output",
+                        help="keep the synthetic capture at this path")
+
+    return parser.parse_args()
+
+
+def ipv4_packet(proto, src, sport, dst, dport, payload):
+    if proto == 6:
+        transport = struct.pack('!HHIIBBHHH', sport, dport, 1, 1, 5 << 4, 0x18, 65535, 0, 0)
+    else:
+        transport = struct.pack('!HHHH', sport, dport, 8 + len(payload), 0)
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(transport) + len(payload), 0, 0, 64, proto, 0,
+                     socket.inet_aton(src), socket.inet_aton(dst))
+    return ETHERNET_HEADER + ip + transport + payload
+
+
+def dns_query(name):
+    labels = b''.join(struct.pack('!B', len(label)) + label for label in name.encode('ascii').split(b'.'))
+    return struct.pack('!HHHHHH', 0x1234, 0x0100, 1, 0, 0, 0) + labels + b'\x00' + struct.pack('!HH', 1, 1)
+
+
+def dns_response(name, address):
+    query = dns_query(name)
+    answer = b'\xc0\x0c' + struct.pack('!HHIH', 1, 1, 60, 4) + socket.inet_aton(address)
+    return struct.pack('!HHHH', 0x1234, 0x8180, 1, 1) + query[8:] + answer
+
+
+def tls_client_hello(server_name):
+    name = server_name.encode('ascii')
+    sni = struct.pack('!HHHBH', 0, len(name) + 5, len(name) + 3, 0, len(name)) + name
+    body = b'\x03\x03' + b'\x00' * 32 + b'\x00' + b'\x00\x02\x13\x01' + b'\x01\x00' + struct.pack('!H', len(sni)) + sni
+    handshake = b'\x01' + struct.pack('!I', len(body))[1:] + body
+    return b'\x16\x03\x01' + struct.pack('!H', len(handshake)) + handshake
+
+
+def synthetic_packets(count, flows):
+    """
+    :return: generator of (timestamp, frame)
+    """
+    bulk = b'\xab' * 1400
+    ts = 1500000000.0
+    for i in range(count):
+        flow = i % flows
+        host = '10.0.{}.{}'.format(flow // 250 % 250, flow % 250 + 1)
+        sport = 30000 + flow % 30000
+        name = 'host{}.example.com'.format(flow)
+        kind = i // flows % 16
+        ts += 0.0001
+
+        if kind == 0:
+            yield ts, ipv4_packet(17, '10.1.0.2', sport, '8.8.8.8', 53, dns_query(name))
+        elif kind == 1:
+            yield ts, ipv4_packet(17, '8.8.8.8', 53, '10.1.0.2', sport, dns_response(name, host))
+        elif kind == 2:
+            yield ts, ipv4_packet(6, '10.1.0.2', sport, host, 80,
+                                  'GET /{} HTTP/1.1\r\nHost: {}\r\n\r\n'.format(i, name).encode('ascii'))
+        elif kind == 3:
+            yield ts, ipv4_packet(6, '10.1.0.2', sport + 1, host, 443, tls_client_hello(name))
+        else:
+            yield ts, ipv4_packet(6, host, 443, '10.1.0.2', sport + 1, bulk)
+
+
+def write_capture(path, packets, pcapng=False):
+    with io.open(path, 'wb') as fh:
+        if pcapng:
+            fh.write(struct.pack('<IIIHHq', 0x0a0d0d0a, 28, 0x1a2b3c4d, 1, 0, -1) + struct.pack('<I', 28))
+            fh.write(struct.pack('<IIHHII', 1, 20, 1, 0, 65535, 20))
+        else:
+            fh.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+
+        for ts, frame in packets:
+            if pcapng:
+                padded = frame + b'\x00' * (-len(frame) % 4)
+                units = int(ts * 1000000)
+                length = 32 + len(padded)
+                fh.write(struct.pack('<IIIIIII', 6, length, 0, units >> 32, units & 0xffffffff,
+                                     len(frame), len(frame)) + padded + struct.pack('<I', length))
+            else:
+                fh.write(struct.pack('<IIII', int(ts), int(ts % 1 * 1000000), len(frame), len(frame)) + frame)
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run():
+    options = parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='xendroid-pcap-bench-')
+    capture_path = options.output or os.path.join(work_dir, 'capture.pcap')
+    try:
+        start = time.time()
+        write_capture(capture_path, synthetic_packets(options.packets, options.flows), options.pcapng)
+        size = os.path.getsize(capture_path)
+        print('capture    {:>10.1f} MB, {} packets, written in {:.1f} s'.format(
+            size / 1e6, options.packets, time.time() - start))
+
+        rss_before = peak_rss_mb()
+        start = time.time()
+        stats = index_capture([capture_path], os.path.join(work_dir, 'index.ndjson'))
+        elapsed = time.time() - start
+
+        print('index      {:>10.1f} MB/s, {:.0f} packets/s, {:.2f} s'.format(
+            size / 1e6 / elapsed, stats['packets'] / elapsed, elapsed))
+        print('found      {flows} flows, {dns} dns, {http} http, {tls} tls, {undecoded} undecoded'.format(**stats))
+        if rss_before is not None:
+            print('peak rss   {:>10.1f} MB (was {:.1f} MB before indexing)'.format(peak_rss_mb(), rss_before))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2018  Muhammed Ziad
+# This file is part of XenDroid - https://github.com/muhzii/XenDroid
+#
+# An instrumented sandbox for Android
+# This program is a free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License
+
+"""
+Measure how long the task timeline takes to build and to answer range and type
+queries over synthetic API and network events
+usage: python -m benchmarks.timeline [-n <events>] [-q <queries>]
+"""
+
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+from modules.analysing.timeline import Timeline
+
+API_NAMES = ['android.telephony.TelephonyManager.getDeviceId', 'java.io.FileOutputStream.write',
+             'android.app.SharedPreferencesImpl.getString', 'java.lang.reflect.Method.invoke',
+             'javax.crypto.Cipher.doFinal', 'java.net.URL.openConnection']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the task timeline")
+
+    parser.add_argument("-n", action="store", type=int, default=1000000, dest="events",
+                        help="number of events in the timeline")
+
+    parser.add_argument("-q", action="store", type=int, default=200, dest="queries",
+                        help="number of queries of every kind")
+
+    return parser.parse_args()
+
+
+def synthetic_events(count, start_ms):
+    """
+    :return: generator of timeline events, one API call every millisecond and a flow every 100
+    """
+    for i in range(count):
+        ts = start_ms + i
+        if i % 100 == 0:
+            yield ts, 'flow', 'tcp 10.1.0.2:{} > 198.18.0.1:443'.format(30000 + i % 30000), {'packets': 1}
+        else:
+            yield ts, 'api', API_NAMES[i % len(API_NAMES)], {'Arg': i}
+
+
+def time_queries(label, queries, func):
+    start = time.time()
+    rows = 0
+    for args in queries:
+        rows += len(func(*args))
+    elapsed = time.time() - start
+    print('{:<28} {:>8.2f} ms/query, {:.0f} rows/query'.format(label, elapsed * 1000 / len(queries),
+                                                              float(rows) / len(queries)))
+
+
+def run():
+    options = parse_args()
+    start_ms = 1500000000000
+    end_ms = start_ms + options.events
+
+    work_dir = tempfile.mkdtemp(prefix='xendroid-timeline-bench-')
+    try:
+        timeline = Timeline(os.path.join(work_dir, 'timeline.sqlite'))
+
+        start = time.time()
+        timeline.add_events('bench', synthetic_events(options.events, start_ms))
+        loaded = time.time() - start
+        timeline.create_indexes()
+        print('build        {} events loaded in {:.2f} s, indexed in {:.2f} s, {:.1f} MB'.format(
+            options.events, loaded, time.time() - start - loaded,
+            os.path.getsize(timeline.db_path) / 1e6))
+
+        rand = random.Random(0)
+        points = [rand.randint(start_ms, end_ms) for _ in range(options.queries)]
+
+        time_queries('range of 1 s', [(p, p + 1000) for p in points],
+                     lambda a, b: timeline.query(start=a, end=b))
+        time_queries('flows over 10 s', [(p, p + 10000) for p in points],
+                     lambda a, b: timeline.query(start=a, end=b, types=['flow']))
+        time_queries('10 API calls before a point', [(p,) for p in points],
+                     lambda p: timeline.preceding(p, types=['api']))
+        time_queries('method over 1 s', [(p, p + 1000) for p in points],
+                     lambda a, b: timeline.query(start=a, end=b, name='javax.crypto.*'))
+        timeline.close()
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    run()
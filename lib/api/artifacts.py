@@ -0,0 +1,92 @@
+# Copyright (C) 2018  Muhammed Ziad
+# This file is part of XenDroid - https://github.com/muhzii/XenDroid
+#
+# An instrumented sandbox for Android
+# This program is a free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License
+
+
+import os
+import logging
+import threading
+
+from lib.api.utils import download_and_extract_archive_from_url, file_digest
+from lib.definitions.constants import ARTIFACTS_DIR
+from lib.definitions.exceptions import XenDroidDownloadError
+
+
+class ArtifactCache(object):
+    """
+    Versioned cache of downloaded binaries (e.g. frida-server),
+    artifacts live under <root>/<name>/<version>/<arch>/<name> next to
+    a `.sha256` file that's checked before a cached copy is used
+    """
+
+    # shared by all the instances as they may point at the same directory
+    _lock = threading.Lock()
+
+    def __init__(self, root=ARTIFACTS_DIR, source=None, offline=False):
+        """
+        :param root: cache directory
+        :param source: download source passed to `download_and_extract_archive_from_url`
+        :param offline: only serve artifacts that are already cached
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.root = root
+        self.source = source
+        self.offline = offline
+
+    def path_for(self, name, version, arch):
+        return os.path.join(self.root, name, version, arch, name)
+
+    def lookup(self, name, version, arch):
+        """
+        get a cached artifact, corrupt copies are evicted
+        :return: path of the artifact or None
+        """
+        path = self.path_for(name, version, arch)
+        checksum_path = path + '.sha256'
+        if not (os.path.exists(path) and os.path.exists(checksum_path)):
+            return None
+
+        with open(checksum_path, 'r') as fh:
+            expected = fh.read().strip()
+
+        if file_digest(path) != expected:
+            self.logger.warning('Cached {} {} ({}) is corrupt, evicting it'.format(name, version, arch))
+            os.unlink(path)
+            os.unlink(checksum_path)
+            return None
+        return path
+
+    def fetch(self, name, version, arch, url, sha256=None):
+        """
+        get an artifact from the cache, downloading it on a miss
+        :param name: artifact name
+        :param version:
+        :param arch:
+        :param url: where to download the artifact from, `.xz` archives get extracted
+        :param sha256: expected sha256 of the downloaded archive
+        :return: path of the artifact
+        """
+        with self._lock:
+            path = self.lookup(name, version, arch)
+            if path is not None:
+                self.logger.debug('Using cached {} {} ({})'.format(name, version, arch))
+                return path
+
+            if self.offline:
+                raise XenDroidDownloadError(
+                    '{} {} ({}) is not cached and offline mode is on'.format(name, version, arch))
+
+            path = self.path_for(name, version, arch)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+
+            self.logger.debug('Downloading {} {} ({})...'.format(name, version, arch))
+            digest = download_and_extract_archive_from_url(url, path, self.source, sha256)
+
+            with open(path + '.sha256', 'w') as fh:
+                fh.write(digest + '\n')
+            return path
@@ -0,0 +1,308 @@
+# Copyright (C) 2018  Muhammed Ziad
+# This file is part of XenDroid - https://github.com/muhzii/XenDroid
+#
+# An instrumented sandbox for Android
+# This program is a free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License
+
+
+import io
+import os
+import re
+import gzip
+import json
+import logging
+import threading
+
+try:
+    from queue import Queue, Full, Empty
+except ImportError:
+    from Queue import Queue, Full, Empty
+
+from lib.definitions.exceptions import XenDroidDependencyError
+
+# what to do with a record when the queue is full
+POLICY_BLOCK = 'block'
+POLICY_DROP_NEWEST = 'drop_newest'
+POLICY_DROP_OLDEST = 'drop_oldest'
+
+COMPRESSION_EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+_FLUSH = object()
+_CLOSE = object()
+
+_SEGMENT_SUFFIX = re.compile(r'^\.(\d+)\.ndjson(\.gz|\.zst)?$')
+
+
+class _Segment(object):
+
+    def __init__(self, path, compression):
+        self.path = path
+        self.size = 0
+
+        self._raw = io.open(path, 'wb')
+        if compression == 'gzip':
+            self._fh = gzip.GzipFile(fileobj=self._raw, mode='wb')
+        elif compression == 'zstd':
+            import zstandard
+            self._fh = zstandard.ZstdCompressor().stream_writer(self._raw)
+        else:
+            self._fh = self._raw
+
+    def write(self, data):
+        self._fh.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        self._fh.flush()
+        if self._fh is not self._raw:
+            self._raw.flush()
+
+    def close(self):
+        self._fh.close()
+        if not self._raw.closed:
+            self._raw.close()
+
+
+class EventWriter(object):
+    """
+    Writes records as newline-delimited JSON from a background thread,
+    producers only pay for putting the record in a bounded queue.
+    The output is split in segments named <base>.<n>.ndjson[.gz|.zst]
+    """
+
+    def __init__(self, base_path, compression=None, segment_size=64 * 1024 * 1024,
+                 queue_size=1024, buffer_size=1024 * 1024, policy=POLICY_DROP_NEWEST, block_timeout=1.0,
+                 header=None):
+        """
+        :param base_path: path of the segments without their suffix
+        :param compression: None, 'gzip' or 'zstd'
+        :param segment_size: uncompressed bytes after which a new segment is started
+        :param queue_size: queued writes after which `policy` applies
+        :param buffer_size: bytes gathered before they're written out
+        :param policy: one of the POLICY_* values
+        :param block_timeout: seconds a blocked producer waits before the record is dropped
+        :param header: record written first in every segment, so that each one can be read on its own
+        """
+        if compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError('Unknown compression `{}`'.format(compression))
+        if policy not in (POLICY_BLOCK, POLICY_DROP_NEWEST, POLICY_DROP_OLDEST):
+            raise ValueError('Unknown queue policy `{}`'.format(policy))
+        if compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError as err:
+                raise XenDroidDependencyError(err)
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.base_path = base_path
+        self.compression = compression
+        self.segment_size = segment_size
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.header = None if header is None else json.dumps(header).encode('utf-8') + b'\n'
+
+        self.segments = []
+        self.written = 0
+        self.dropped = 0
+        self.error = None
+
+        self._queue = Queue(queue_size)
+        self._segment = None
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, name='event-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, record):
+        """
+        queue a record
+        :param record: a JSON serializable object, or an already serialized line
+        :return: whether the record was queued
+        """
+        return self.write_lines([record])
+
+    def write_lines(self, records):
+        """
+        queue several records as a single write
+        :param records: list of records, see `write`
+        :return: whether the records were queued
+        """
+        if self._closed or self.error is not None:
+            self.dropped += len(records)
+            return False
+
+        lines = []
+        for record in records:
+            if not isinstance(record, (bytes, type(u''))):
+                record = json.dumps(record)
+            if not isinstance(record, bytes):
+                record = record.encode('utf-8')
+            lines.append(record)
+
+        item = (len(lines), b'\n'.join(lines) + b'\n')
+        if self.policy == POLICY_BLOCK:
+            try:
+                self._queue.put(item, timeout=self.block_timeout)
+                return True
+            except Full:
+                pass
+        elif self.policy == POLICY_DROP_OLDEST:
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    return True
+                except Full:
+                    try:
+                        old = self._queue.get_nowait()
+                    except Empty:
+                        continue
+                    if old is _CLOSE or old[0] is _FLUSH:
+                        # control items must get through, give up on this record instead
+                        self._queue.put(old)
+                        break
+                    self.dropped += old[0]
+        else:
+            try:
+                self._queue.put_nowait(item)
+                return True
+            except Full:
+                pass
+
+        self.dropped += len(lines)
+        return False
+
+    def flush(self, timeout=None):
+        """
+        wait until everything queued so far is written to disk
+        :param timeout: seconds to wait
+        :return: whether the flush completed
+        """
+        done = threading.Event()
+        self._queue.put((_FLUSH, done))
+        done.wait(timeout)
+        return done.is_set()
+
+    def close(self, timeout=None):
+        """
+        write what's left in the queue and close the current segment
+        :param timeout: seconds to wait for the writer thread
+        :return:
+        """
+        if self._closed:
+            return
+        self._closed = True
+
+        self._queue.put(_CLOSE)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            self.logger.warning('Timed out while waiting for the writer of {}'.format(self.base_path))
+
+        if self.dropped:
+            self.logger.warning('{} records were dropped while writing {}'.format(self.dropped, self.base_path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _next_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+
+        path = '{}.{}.ndjson{}'.format(self.base_path, len(self.segments), COMPRESSION_EXTENSIONS[self.compression])
+        self._segment = _Segment(path, self.compression)
+        self.segments.append(path)
+        if self.header is not None:
+            self._segment.write(self.header)
+
+    def _write_out(self, chunks, count):
+        data = b''.join(chunks)
+        if self._segment is None or (self._segment.size > len(self.header or b'') and
+                                     self._segment.size + len(data) > self.segment_size):
+            self._next_segment()
+        self._segment.write(data)
+        self.written += count
+
+    def _run(self):
+        chunks, count, buffered = [], 0, 0
+        item = None
+        while item is not _CLOSE:
+            # block for the first item then gather whatever else is queued
+            item = self._queue.get()
+            while True:
+                if item is _CLOSE or (isinstance(item, tuple) and item[0] is _FLUSH):
+                    break
+                chunks.append(item[1])
+                count += item[0]
+                buffered += len(item[1])
+                if buffered >= self.buffer_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except Empty:
+                    break
+
+            try:
+                if chunks and self.error is None:
+                    self._write_out(chunks, count)
+                if item is _CLOSE or item[0] is _FLUSH:
+                    if self._segment is not None:
+                        self._segment.flush()
+            except (IOError, OSError) as err:
+                self.logger.error('Unable to write to {}: {}'.format(self.base_path, err))
+                self.error = err
+                self.dropped += count
+            chunks, count, buffered = [], 0, 0
+
+            if isinstance(item, tuple) and item[0] is _FLUSH:
+                item[1].set()
+
+        if self._segment is not None:
+            try:
+                self._segment.close()
+            except (IOError, OSError) as err:
+                self.logger.error('Unable to close {}: {}'.format(self._segment.path, err))
+
+
+def segment_paths(base_path):
+    """
+    :param base_path: base path given to the `EventWriter`
+    :return: paths of the segments, in the order they were written
+    """
+    directory, prefix = os.path.split(base_path)
+    segments = []
+    for name in os.listdir(directory or '.'):
+        match = _SEGMENT_SUFFIX.match(name[len(prefix):]) if name.startswith(prefix) else None
+        if match:
+            segments.append((int(match.group(1)), os.path.join(directory, name)))
+    return [path for _, path in sorted(segments)]
+
+
+def read_records(base_path):
+    """
+    read back what an `EventWriter` wrote
+    :param base_path: base path given to the `EventWriter`
+    :return: generator of the records, headers included
+    """
+    for path in segment_paths(base_path):
+        if path.endswith('.gz'):
+            fh = gzip.open(path, 'rb')
+        elif path.endswith('.zst'):
+            try:
+                import zstandard
+            except ImportError as err:
+                raise XenDroidDependencyError(err)
+            fh = zstandard.ZstdDecompressor().stream_reader(io.open(path, 'rb'))
+            fh = io.BufferedReader(fh)
+        else:
+            fh = io.open(path, 'rb')
+
+        with fh:
+            for line in fh:
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'))
@@ -0,0 +1,166 @@
+# Copyright (C) 2018  Muhammed Ziad
+# This file is part of XenDroid - https://github.com/muhzii/XenDroid
+#
+# An instrumented sandbox for Android
+# This program is a free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License
+
+
+import io
+import os
+import re
+import struct
+import logging
+
+# libpcap magic numbers as read in little endian, with microsecond or nanosecond timestamps
+PCAP_MAGICS = {
+    0xa1b2c3d4: ('<', 1000000),
+    0xd4c3b2a1: ('>', 1000000),
+    0xa1b23c4d: ('<', 1000000000),
+    0x4d3cb2a1: ('>', 1000000000),
+}
+
+PCAP_HEADER_SIZE = 24
+RECORD_HEADER_SIZE = 16
+
+_SEGMENT_SUFFIX = re.compile(r'^\.(\d+)\.pcap$')
+
+
+class PcapWriter(object):
+    """
+    Writes a libpcap stream, e.g. the output of `tcpdump -w -`, as it arrives.
+    The stream is cut at packet boundaries in segments named <base>.<n>.pcap,
+    each starting with the stream's global header so that it can be read on its own
+    """
+
+    def __init__(self, base_path, segment_size=64 * 1024 * 1024, segment_duration=None):
+        """
+        :param base_path: path of the segments without their suffix
+        :param segment_size: bytes after which a new segment is started
+        :param segment_duration: seconds of capture, as per the packets' timestamps,
+        after which a new segment is started, None disables it
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.base_path = base_path
+        self.segment_size = segment_size
+        self.segment_duration = segment_duration
+
+        self.segments = []
+        self.packets = 0
+        self.bytes = 0
+
+        self._header = None
+        self._endian = None
+        self._ts_scale = None
+        self._pending = b''
+        self._fh = None
+        self._size = 0
+        self._first_ts = None
+
+    def feed(self, data):
+        """
+        write a chunk of the stream, whatever follows the last complete
+        packet is kept until the next chunk
+        :param data: bytes as read from the stream
+        :return:
+        """
+        buf = self._pending + data
+        offset = 0
+
+        if self._header is None:
+            if len(buf) < PCAP_HEADER_SIZE:
+                self._pending = buf
+                return
+            magic = struct.unpack_from('<I', buf)[0]
+            if magic not in PCAP_MAGICS:
+                raise ValueError('Not a libpcap stream, magic number: {:#x}'.format(magic))
+            self._endian, self._ts_scale = PCAP_MAGICS[magic]
+            self._header = buf[:PCAP_HEADER_SIZE]
+            offset = PCAP_HEADER_SIZE
+
+        record_fmt = self._endian + 'IIII'
+        chunks = []
+        while len(buf) - offset >= RECORD_HEADER_SIZE:
+            ts_sec, ts_frac, incl_len, _ = struct.unpack_from(record_fmt, buf, offset)
+            end = offset + RECORD_HEADER_SIZE + incl_len
+            if end > len(buf):
+                break
+
+            ts = ts_sec + float(ts_frac) / self._ts_scale
+            if self._should_rotate(end - offset, ts):
+                self._write(chunks)
+                chunks = []
+                self._next_segment(ts)
+
+            chunks.append(buf[offset:end])
+            self._size += end - offset
+            self.packets += 1
+            offset = end
+
+        self._write(chunks)
+        self._pending = buf[offset:]
+
+    def _should_rotate(self, record_size, ts):
+        if self._fh is None:
+            return True
+        if self._size == PCAP_HEADER_SIZE:
+            return False
+        if self._size + record_size > self.segment_size:
+            return True
+        return self.segment_duration is not None and ts - self._first_ts >= self.segment_duration
+
+    def _next_segment(self, ts):
+        if self._fh is not None:
+            self._fh.close()
+
+        path = '{}.{}.pcap'.format(self.base_path, len(self.segments))
+        self._fh = io.open(path, 'wb')
+        self._fh.write(self._header)
+        self._size = PCAP_HEADER_SIZE
+        self._first_ts = ts
+        self.segments.append(path)
+        self.bytes += PCAP_HEADER_SIZE
+
+    def _write(self, chunks):
+        if not chunks:
+            return
+        data = b''.join(chunks)
+        self._fh.write(data)
+        # the segments are meant to be readable while the capture goes on
+        self._fh.flush()
+        self.bytes += len(data)
+
+    def close(self):
+        """
+        close the current segment, an incomplete trailing packet is discarded
+        :return:
+        """
+        if self._pending:
+            self.logger.warning('Discarded {} bytes of an incomplete packet at the end of {}'.format(
+                len(self._pending), self.base_path))
+            self._pending = b''
+
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def pcap_segment_paths(base_path):
+    """
+    :param base_path: base path given to the `PcapWriter`
+    :return: paths of the segments, in the order they were written
+    """
+    directory, prefix = os.path.split(base_path)
+    segments = []
+    for name in os.listdir(directory or '.'):
+        match = _SEGMENT_SUFFIX.match(name[len(prefix):]) if name.startswith(prefix) else None
+        if match:
+            segments.append((int(match.group(1)), os.path.join(directory, name)))
+    return [path for _, path in sorted(segments)]
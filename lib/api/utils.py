@@ -9,17 +9,24 @@ import os
 import lzma
 import ntpath
 import random
+import time
 import string
-import signal
+import hashlib
+import tempfile
 import requests
+import functools
+import threading
 import subprocess
 
+from contextlib import contextmanager
+
 from lib.definitions.exceptions import (
     XenDroidDependencyError,
+    XenDroidDownloadError,
     XenDroidTimeOutError
 )
 
-from lib.definitions.constants import XENDROID_TIMEOUT
+from lib.definitions.constants import XENDROID_TIMEOUT, OPERATION_TIMEOUTS
 
 
 def get_package_name(path_to_apk):
@@ -38,31 +45,87 @@ def get_package_name(path_to_apk):
     return package_name
 
 
-def download_and_extract_archive_from_url(url, t_path):
+class HttpSource(object):
+    """
+    Default source of downloads, fetches a url over http(s) as a stream of chunks
     """
-    download archive from url, extract it then return the data
+
+    def __init__(self, chunk_size=64 * 1024, timeout=60):
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+
+    def iter_content(self, url):
+        """
+        :param url:
+        :return: iterator over the content of the url
+        """
+        try:
+            req = requests.get(url, stream=True, timeout=self.timeout)
+        except requests.RequestException as err:
+            raise XenDroidDownloadError('Unable to download {}: {}'.format(url, err))
+
+        if req.status_code != 200:
+            raise XenDroidDownloadError('Unable to download {}: HTTP {}'.format(url, req.status_code))
+        return req.iter_content(self.chunk_size)
+
+
+def download_and_extract_archive_from_url(url, t_path, source=None, sha256=None):
+    """
+    download archive from url and extract it to the target path while it's
+    being downloaded, `.xz` archives are decompressed and anything else is
+    written as is, memory use is bounded by the chunk size
     :param url:
-    :param t_path: Target path for the downloaded file
-    :return: extracted data
+    :param t_path: Target path for the extracted file
+    :param source: object with an `iter_content(url)` method, `HttpSource` by default
+    :param sha256: expected sha256 of the archive
+    :return: sha256 of the extracted file
     """
-    req = requests.get(url, stream=True)
+    if source is None:
+        source = HttpSource()
 
-    data = None
-    if req.status_code == 200:
+    decompressor = lzma.LZMADecompressor() if url.endswith('.xz') else None
+    archive_hash, data_hash = hashlib.sha256(), hashlib.sha256()
 
-        # Downloading and writing the archive.
-        req.raw.decode_content = True
-        with open(t_path, "wb") as fh:
-            for chunk in req.iter_content(1024):
+    t_dir = os.path.dirname(os.path.abspath(t_path))
+    fd, tmp_path = tempfile.mkstemp(dir=t_dir, prefix='.download_')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            for chunk in source.iter_content(url):
+                archive_hash.update(chunk)
+                if decompressor is not None:
+                    chunk = decompressor.decompress(chunk)
+                data_hash.update(chunk)
                 fh.write(chunk)
 
-        # Extracting data from the archive
-        with lzma.open(t_path) as fh:
-            data = fh.read()
+        if decompressor is not None and not decompressor.eof:
+            raise XenDroidDownloadError('Truncated archive downloaded from {}'.format(url))
+
+        if sha256 is not None and archive_hash.hexdigest() != sha256.lower():
+            raise XenDroidDownloadError('Checksum mismatch for the archive downloaded from {}'.format(url))
 
-        os.unlink(t_path)
+        os.rename(tmp_path, t_path)
+    except lzma.LZMAError as err:
+        raise XenDroidDownloadError('Corrupt archive downloaded from {}: {}'.format(url, err))
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
 
-    return data
+    return data_hash.hexdigest()
+
+
+def file_digest(path, algorithm='sha256', chunk_size=64 * 1024):
+    """
+    hash a file without reading it whole
+    :param path:
+    :param algorithm: any algorithm known to `hashlib`
+    :param chunk_size:
+    :return: hex digest
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 def get_filename_from_path(path):
@@ -105,22 +168,170 @@ def get_rand_mac_addr():
     return pretty_mac
 
 
-def with_timeout(f):
+class Deadline(object):
+    """
+    A point in time an operation must finish by, nested deadlines
+    never outlive the one they're created under
+    """
+
+    def __init__(self, timeout, parent=None):
+        """
+        :param timeout: seconds from now
+        :param parent: enclosing `Deadline`
+        """
+        self.parent = parent
+        self.expires_at = time.time() + timeout
+        if parent is not None:
+            self.expires_at = min(self.expires_at, parent.expires_at)
+
+        self._cancelled = threading.Event()
+        self._committed = False
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.time())
+
+    @property
+    def expired(self):
+        if self._cancelled.is_set() or time.time() >= self.expires_at:
+            return True
+        return self.parent is not None and self.parent.expired
+
+    def cancel(self):
+        """
+        give up on the operation
+        :return: False if it already committed its results, see `commit`
+        """
+        with self._lock:
+            if self._committed:
+                return False
+            self._cancelled.set()
+            return True
+
+    @contextmanager
+    def commit(self, operation=None):
+        """
+        run the block that stores the results of an operation in shared state,
+        only if it wasn't given up on, the check and the block are atomic with
+        respect to `cancel` of this deadline and of the enclosing ones
+        :param operation: name of the operation for the error message
+        :return:
+        """
+        chain = []
+        deadline = self
+        while deadline is not None:
+            chain.append(deadline)
+            deadline = deadline.parent
+
+        # always locked outermost first
+        for deadline in reversed(chain):
+            deadline._lock.acquire()
+        try:
+            self.check(operation)
+            yield
+            self._committed = True
+        finally:
+            for deadline in chain:
+                deadline._lock.release()
+
+    def check(self, operation=None):
+        """
+        raise if the deadline passed, for long running code to poll
+        :param operation: name of the operation for the error message
+        :return:
+        """
+        if self.expired:
+            raise XenDroidTimeOutError(operation)
+
+
+_deadlines = threading.local()
+
+
+def current_deadline():
+    """
+    :return: the innermost `Deadline` active on the calling thread or None
+    """
+    stack = getattr(_deadlines, 'stack', None)
+    return stack[-1] if stack else None
+
+
+@contextmanager
+def deadline_scope(timeout):
     """
-    A decorator for timeout-sensitive methods
+    run a block under a deadline, nested under the current one if any
+    :param timeout: seconds
     :return:
     """
-    def handler(sig, frame):
-        raise XenDroidTimeOutError()
+    deadline = Deadline(timeout, current_deadline())
+    if getattr(_deadlines, 'stack', None) is None:
+        _deadlines.stack = []
+
+    _deadlines.stack.append(deadline)
+    try:
+        yield deadline
+    finally:
+        _deadlines.stack.pop()
+
+
+def get_timeout(operation):
+    """
+    :param operation: operation name, e.g. `frida.spawn_app`
+    :return: the timeout configured for the operation in seconds
+    """
+    return OPERATION_TIMEOUTS.get(operation, XENDROID_TIMEOUT)
+
+
+def set_timeout(operation, seconds):
+    """
+    configure the timeout of an operation
+    :param operation:
+    :param seconds:
+    :return:
+    """
+    OPERATION_TIMEOUTS[operation] = seconds
+
+
+def with_timeout(operation):
+    """
+    A decorator for timeout-sensitive methods, the method runs on a worker
+    thread that the caller stops waiting for once the operation's deadline passes.
+    Works from any thread and nests, a decorated method called from another
+    one gets at most what's left of the outer deadline.
+    The abandoned call keeps running, a method that changes shared state must
+    do it under `current_deadline().commit()` and undo what it did otherwise
+    :param operation: name of the operation in OPERATION_TIMEOUTS
+    :return:
+    """
+    def decorator(f):
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            deadline = Deadline(get_timeout(operation), current_deadline())
+            result = {}
+
+            def target():
+                _deadlines.stack = [deadline]
+                try:
+                    result['value'] = f(*args, **kwargs)
+                except BaseException as err:
+                    result['error'] = err
 
-    def wrapper(*args, **kwargs):
+            worker = threading.Thread(target=target, name='timeout-' + operation)
+            worker.daemon = True
+            worker.start()
+            worker.join(deadline.remaining())
 
-        signal.signal(signal.SIGALRM, handler)
-        signal.alarm(XENDROID_TIMEOUT)
+            if worker.is_alive():
+                # let the abandoned call notice it if it polls the deadline
+                if deadline.cancel():
+                    raise XenDroidTimeOutError(operation)
+                # its results are in, only the end of the call is left
+                worker.join()
 
-        ret = f(*args, **kwargs)
+            if 'error' in result:
+                raise result['error']
+            return result.get('value')
 
-        signal.alarm(0)
-        return ret
+        return wrapper
 
-    return wrapper
+    return decorator
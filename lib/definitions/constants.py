@@ -10,10 +10,34 @@ import os
 
 XENDROID_TIMEOUT = 120
 
+# seconds allowed for the timeout-sensitive operations, XENDROID_TIMEOUT applies to anything else
+OPERATION_TIMEOUTS = {
+    'frida.spawn_app': 60,
+    'frida.load_script': 60,
+    'adb.cmd': XENDROID_TIMEOUT,
+    'adb.ui_cmd': XENDROID_TIMEOUT,
+}
+
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 ANALYSES_DIR = os.path.join(ROOT_DIR, 'xendroid_storage', 'analyses')
 
 MISC_FOLDER = os.path.join(ROOT_DIR, 'xendroid_storage', 'misc')
 
+ARTIFACTS_DIR = os.path.join(MISC_FOLDER, 'artifacts')
+
+AGENT_CACHE_DIR = os.path.join(MISC_FOLDER, 'agent_cache')
+
+DEX_ANALYSIS_DIR = os.path.join(MISC_FOLDER, 'dex_analysis')
+
+FAKE_INTERNET_DIR = os.path.join(MISC_FOLDER, 'fake_internet')
+
 UTILS_FOLDER = os.path.join(ROOT_DIR, 'utils')
+
+FAKE_INTERNET_RESPONSES = os.path.join(UTILS_FOLDER, 'fake_internet', 'responses.json')
+
+FRIDA_SERVER_URL = 'https://github.com/frida/frida/releases/download/{version}/frida-server-{version}-android-{arch}.xz'
+
+ADB_SERVER_HOST = '127.0.0.1'
+
+ADB_SERVER_PORT = 5037
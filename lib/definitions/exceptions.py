@@ -30,6 +30,10 @@ class XenDroidAnalysisError(Exception):
     pass
 
 
+class XenDroidInstallError(XenDroidAnalysisError):
+    pass
+
+
 class XenDroidCommunicationError(Exception):
     pass
 
@@ -42,10 +46,16 @@ class XenDroidFridaError(XenDroidCommunicationError):
     pass
 
 
+class XenDroidDownloadError(Exception):
+    pass
+
+
 class XenDroidTimeOutError(Exception):
 
-    def __init__(self):
+    def __init__(self, operation=None):
         msg = 'Timeout reached, Exiting...'
+        if operation is not None:
+            msg = 'Timeout reached during `{}`, Exiting...'.format(operation)
         Exception.__init__(self, msg)
 
 
@@ -0,0 +1,238 @@
+# Copyright (C) 2018  Muhammed Ziad
+# This file is part of XenDroid - https://github.com/muhzii/XenDroid
+#
+# An instrumented sandbox for Android
+# This program is a free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License
+
+
+import os
+import json
+import sqlite3
+import logging
+
+from lib.api.event_writer import read_records, segment_paths
+from modules.analysing.traffic import read_index
+from modules.monitoring.api_mon import iter_hook_events
+
+logger = logging.getLogger('Timeline')
+
+TIMELINE_VERSION = 1
+
+SOURCE_API = 'api'
+SOURCE_NETWORK = 'network'
+SOURCE_FAKE_INTERNET = 'fake_internet'
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+    'CREATE TABLE IF NOT EXISTS events (ts INTEGER NOT NULL, source TEXT NOT NULL, type TEXT NOT NULL, '
+    'name TEXT, data TEXT)',
+]
+
+_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS events_ts ON events (ts)',
+    'CREATE INDEX IF NOT EXISTS events_type_ts ON events (type, ts)',
+]
+
+
+class Timeline(object):
+    """
+    Events of every monitor of a task on the device's clock, stored in SQLite
+    and indexed by time and by type. Every event has a timestamp in milliseconds,
+    the monitor it comes from, a type, a short name, e.g. the hooked method or the
+    queried host, and its full record as JSON
+    """
+
+    def __init__(self, db_path, batch_size=10000):
+        """
+        :param db_path: path of the SQLite database, created if missing
+        :param batch_size: events inserted at once
+        """
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.db = sqlite3.connect(db_path)
+        # the timeline can always be rebuilt from the logs, durability isn't worth the bulk load time
+        self.db.execute('PRAGMA synchronous = OFF')
+        for statement in _SCHEMA:
+            self.db.execute(statement)
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('version', str(TIMELINE_VERSION)))
+        self.db.commit()
+
+    def add_events(self, source, events):
+        """
+        add the events of a monitor, much faster before `create_indexes` is called
+        :param source: name of the monitor
+        :param events: iterable of (timestamp in ms, type, name, record)
+        :return: number of events added
+        """
+        count = 0
+        batch = []
+        for ts, event_type, name, record in events:
+            batch.append((int(ts), source, event_type, name, json.dumps(record, separators=(',', ':'))))
+            if len(batch) >= self.batch_size:
+                self.db.executemany('INSERT INTO events VALUES (?, ?, ?, ?, ?)', batch)
+                count += len(batch)
+                batch = []
+
+        if batch:
+            self.db.executemany('INSERT INTO events VALUES (?, ?, ?, ?, ?)', batch)
+            count += len(batch)
+        self.db.commit()
+        return count
+
+    def create_indexes(self):
+        for statement in _INDEXES:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def query(self, start=None, end=None, types=None, sources=None, name=None, limit=None, reverse=False):
+        """
+        :param start: first timestamp in ms, included
+        :param end: last timestamp in ms, included
+        :param types: event types to keep
+        :param sources: monitors to keep
+        :param name: glob pattern the names must match, e.g. 'android.telephony.*'
+        :param limit: maximum number of events
+        :param reverse: latest events first
+        :return: list of (timestamp, source, type, name, record) in time order
+        """
+        clauses, args = [], []
+        if start is not None:
+            clauses.append('ts >= ?')
+            args.append(int(start))
+        if end is not None:
+            clauses.append('ts <= ?')
+            args.append(int(end))
+        for column, values in (('type', types), ('source', sources)):
+            if values is not None:
+                values = list(values)
+                clauses.append('{} IN ({})'.format(column, ', '.join('?' * len(values))))
+                args.extend(values)
+        if name is not None:
+            clauses.append('name GLOB ?')
+            args.append(name)
+
+        sql = 'SELECT ts, source, type, name, data FROM events'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY ts DESC' if reverse else ' ORDER BY ts'
+        if limit is not None:
+            sql += ' LIMIT {:d}'.format(limit)
+
+        return [(ts, source, event_type, event_name, json.loads(data))
+                for ts, source, event_type, event_name, data in self.db.execute(sql, args)]
+
+    def preceding(self, ts, types=None, count=10):
+        """
+        the events that happened right before a timestamp, e.g. the API calls before a connection
+        :param ts: timestamp in ms
+        :param types: event types to keep
+        :param count: number of events
+        :return: see `query`, latest first
+        """
+        return self.query(end=ts, types=types, limit=count, reverse=True)
+
+    def counts(self):
+        """
+        :return: {(source, type): number of events}
+        """
+        return dict(((source, event_type), count) for source, event_type, count in self.db.execute(
+            'SELECT source, type, COUNT(*) FROM events GROUP BY source, type'))
+
+    def close(self):
+        self.db.close()
+
+
+def hook_events(logs_path):
+    """
+    :param logs_path: base path of the hook events, see `APIMonitor.logs_path`
+    :return: generator of timeline events, hook timestamps are already in ms on the device's clock
+    """
+    # every hook event has the same type, they're told apart by their name
+    for event in iter_hook_events(logs_path):
+        if 'Timestamp' not in event:
+            continue
+        if 'Class' in event:
+            name = '{}.{}'.format(event['Class'], event['Method'])
+        else:
+            name = str(event.get('Hook', event.get('type')))
+        yield event['Timestamp'], 'api', name, event
+
+
+def network_events(index_path):
+    """
+    :param index_path: traffic index of the task, see `index_capture`
+    :return: generator of timeline events, capture timestamps are on the device's clock
+    """
+    for record in read_index(index_path):
+        record_type = record['type']
+        if record_type == 'flow':
+            name = '{} {}:{} > {}:{}'.format(record['proto'], record['src'], record['sport'], record['dst'],
+                                             record['dport'])
+            ts = record['first']
+        elif record_type == 'dns':
+            name = ' '.join(question['name'] for question in record['questions'])
+            ts = record['ts']
+        elif record_type == 'http':
+            name = '{} {}{}'.format(record['method'], record['host'] or '', record['uri'])
+            ts = record['ts']
+        elif record_type == 'tls':
+            name = record['sni']
+            ts = record['ts']
+        else:
+            continue
+        yield ts * 1000, record_type, name, record
+
+
+def fake_internet_events(logs_base, host_clock_offset):
+    """
+    :param logs_base: base path of the fake internet logs
+    :param host_clock_offset: seconds to add to the host's clock to get the device's
+    :return: generator of timeline events
+    """
+    for record in read_records(logs_base):
+        record_type = record.get('type')
+        if record_type == 'dns':
+            name = record['name']
+        elif record_type in ('http', 'https'):
+            name = '{} {}{}'.format(record['method'], record['host'], record['path'])
+        elif record_type == 'tls':
+            name = record['sni']
+        else:
+            continue
+        yield (record['ts'] + host_clock_offset) * 1000, 'fake-' + record_type, name, record
+
+
+def build_timeline(analysis_path, host_clock_offset=0.0):
+    """
+    gather the events of every monitor of a task in logs/timeline.sqlite
+    :param analysis_path: the task directory
+    :param host_clock_offset: seconds to add to the host's clock to get the device's,
+    applies to the events timestamped on the host
+    :return: the `Timeline`
+    """
+    logs_dir = os.path.join(analysis_path, 'logs')
+    db_path = os.path.join(logs_dir, 'timeline.sqlite')
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    sources = [
+        (SOURCE_API, os.path.join(logs_dir, 'frida_logs'), hook_events),
+        (SOURCE_NETWORK, os.path.join(logs_dir, 'net_index.ndjson'), network_events),
+        (SOURCE_FAKE_INTERNET, os.path.join(logs_dir, 'fake_internet'),
+         lambda path: fake_internet_events(path, host_clock_offset)),
+    ]
+
+    timeline = Timeline(db_path)
+    for source, path, reader in sources:
+        if not (os.path.exists(path) or segment_paths(path)):
+            continue
+        try:
+            count = timeline.add_events(source, reader(path))
+        except (IOError, OSError, ValueError, KeyError) as err:
+            logger.error('Unable to add the {} events to the timeline: {}'.format(source, err))
+            continue
+        logger.debug('{} {} events added to the timeline'.format(count, source))
+
+    timeline.create_indexes()
+    return timeline
@@ -0,0 +1,545 @@
+# Copyright (C) 2018  Muhammed Ziad
+# This file is part of XenDroid - https://github.com/muhzii/XenDroid
+#
+# An instrumented sandbox for Android
+# This program is a free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License
+
+
+import io
+import os
+import json
+import mmap
+import socket
+import struct
+import logging
+
+from lib.api.pcap_writer import PCAP_MAGICS, PCAP_HEADER_SIZE, RECORD_HEADER_SIZE
+
+logger = logging.getLogger('TrafficIndex')
+
+INDEX_VERSION = 1
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = (12, 14, 101)
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+LINKTYPE_NFLOG = 239
+
+# attribute of an nflog packet holding the network layer packet
+NFULA_PAYLOAD = 9
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+
+PROTO_TCP = 6
+PROTO_UDP = 17
+
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_IDB = 1
+PCAPNG_SPB = 3
+PCAPNG_EPB = 6
+
+DNS_TYPES = {1: 'A', 2: 'NS', 5: 'CNAME', 6: 'SOA', 12: 'PTR', 15: 'MX', 16: 'TXT', 28: 'AAAA', 33: 'SRV',
+             65: 'HTTPS'}
+
+HTTP_METHODS = (b'GET', b'POST', b'PUT', b'HEAD', b'DELETE', b'OPTIONS', b'PATCH', b'CONNECT', b'TRACE')
+
+# first bytes worth looking at in a TCP payload, HTTP methods and the TLS handshake record type
+_INTERESTING_FIRST_BYTES = frozenset(bytearray(b'GPHDOCT\x16'))
+
+_u8 = struct.Struct('!B').unpack_from
+_u16 = struct.Struct('!H').unpack_from
+
+
+class _MappedFile(object):
+    """
+    Maps a file in windows, so that memory stays bounded whatever the size of the file
+    """
+
+    def __init__(self, fh, window_size):
+        self.fh = fh
+        self.size = os.fstat(fh.fileno()).st_size
+        self.window_size = window_size
+        self.buf = None
+        self.start = self.end = 0
+
+    def view(self, offset, length):
+        """
+        :return: tuple of (mapping, offset in the mapping) covering `length` bytes at `offset`,
+        the mapping stays valid until the next call
+        """
+        if offset < self.start or offset + length > self.end:
+            self.close()
+            self.start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            self.end = min(self.size, max(offset + length, self.start + self.window_size))
+            self.buf = mmap.mmap(self.fh.fileno(), self.end - self.start, access=mmap.ACCESS_READ,
+                                 offset=self.start)
+        return self.buf, offset - self.start
+
+    def close(self):
+        if self.buf is not None:
+            self.buf.close()
+            self.buf = None
+
+
+def _pcap_packets(mapped):
+    buf, _ = mapped.view(0, PCAP_HEADER_SIZE)
+    endian, scale = PCAP_MAGICS[struct.unpack_from('<I', buf)[0]]
+    linktype = struct.unpack_from(endian + 'I', buf, 20)[0]
+    record = struct.Struct(endian + 'IIII').unpack_from
+
+    offset, size = PCAP_HEADER_SIZE, mapped.size
+    while offset + RECORD_HEADER_SIZE <= size:
+        buf, pos = mapped.view(offset, RECORD_HEADER_SIZE)
+        ts_sec, ts_frac, incl_len, _ = record(buf, pos)
+        offset += RECORD_HEADER_SIZE
+        if offset + incl_len > size:
+            logger.debug('Truncated packet at the end of the capture')
+            return
+        buf, pos = mapped.view(offset, incl_len)
+        yield ts_sec + float(ts_frac) / scale, linktype, buf, pos, incl_len
+        offset += incl_len
+
+
+def _pcapng_ts_unit(buf, endian, offset, end):
+    """
+    :return: seconds per timestamp unit of an interface, as per its if_tsresol option
+    """
+    while offset + 4 <= end:
+        code, length = struct.unpack_from(endian + 'HH', buf, offset)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            resol = _u8(buf, offset + 4)[0]
+            return 2.0 ** -(resol & 0x7f) if resol & 0x80 else 10.0 ** -resol
+        offset += 4 + (length + 3) // 4 * 4
+    return 1e-6
+
+
+def _pcapng_packets(mapped):
+    endian = '<'
+    interfaces = []
+    ts = 0.0
+
+    offset, size = 0, mapped.size
+    while offset + 12 <= size:
+        buf, pos = mapped.view(offset, 12)
+        # the section header block type reads the same in both byte orders
+        if struct.unpack_from('<I', buf, pos)[0] == PCAPNG_SHB:
+            endian = '<' if struct.unpack_from('<I', buf, pos + 8)[0] == 0x1a2b3c4d else '>'
+            interfaces = []
+
+        block_type, block_len = struct.unpack_from(endian + 'II', buf, pos)
+        if block_len < 12 or offset + block_len > size:
+            logger.debug('Truncated block at the end of the capture')
+            return
+        buf, pos = mapped.view(offset, block_len)
+
+        if block_type == PCAPNG_IDB:
+            linktype = struct.unpack_from(endian + 'H', buf, pos + 8)[0]
+            interfaces.append((linktype, _pcapng_ts_unit(buf, endian, pos + 16, pos + block_len - 4)))
+        elif block_type == PCAPNG_EPB:
+            if_id, ts_high, ts_low, incl_len = struct.unpack_from(endian + 'IIII', buf, pos + 8)
+            if if_id < len(interfaces):
+                linktype, unit = interfaces[if_id]
+                ts = ((ts_high << 32) | ts_low) * unit
+                yield ts, linktype, buf, pos + 28, min(incl_len, block_len - 32)
+        elif block_type == PCAPNG_SPB and interfaces:
+            # simple packets have no timestamp, they get the one of the previous packet
+            orig_len = struct.unpack_from(endian + 'I', buf, pos + 8)[0]
+            yield ts, interfaces[0][0], buf, pos + 12, min(orig_len, block_len - 16)
+
+        offset += block_len
+
+
+def iter_packets(path, window_size=64 * 1024 * 1024):
+    """
+    iterate the packets of a pcap or pcapng file without reading it in memory,
+    the file is memory mapped a window at a time and packets are given as offsets in the mapping
+    :param path:
+    :param window_size: bytes of the file mapped at once
+    :return: generator of (timestamp, link type, buffer, offset, captured length),
+    the buffer is only valid until the next packet
+    """
+    with io.open(path, 'rb') as fh:
+        mapped = _MappedFile(fh, window_size)
+        if mapped.size < 4:
+            return
+
+        try:
+            magic = struct.unpack_from('<I', mapped.view(0, 4)[0])[0]
+            if magic in PCAP_MAGICS:
+                packets = _pcap_packets(mapped)
+            elif magic == PCAPNG_SHB:
+                packets = _pcapng_packets(mapped)
+            else:
+                raise ValueError('{} is not a pcap or pcapng file'.format(path))
+
+            for packet in packets:
+                yield packet
+        finally:
+            mapped.close()
+
+
+def _network_offset(buf, linktype, offset, end):
+    """
+    :return: tuple of (ethertype, offset of the network layer) or None
+    """
+    if linktype == LINKTYPE_ETHERNET:
+        if offset + 14 > end:
+            return None
+        ethertype = _u16(buf, offset + 12)[0]
+        offset += 14
+        while ethertype in ETHERTYPE_VLAN and offset + 4 <= end:
+            ethertype = _u16(buf, offset + 2)[0]
+            offset += 4
+        return ethertype, offset
+
+    if linktype in LINKTYPE_RAW:
+        if offset >= end:
+            return None
+        version = _u8(buf, offset)[0] >> 4
+        return ETHERTYPE_IPV4 if version == 4 else ETHERTYPE_IPV6, offset
+
+    if linktype == LINKTYPE_LINUX_SLL:
+        return (_u16(buf, offset + 14)[0], offset + 16) if offset + 16 <= end else None
+
+    if linktype == LINKTYPE_LINUX_SLL2:
+        return (_u16(buf, offset)[0], offset + 20) if offset + 20 <= end else None
+
+    if linktype == LINKTYPE_NFLOG:
+        if offset + 4 > end:
+            return None
+        ethertype = ETHERTYPE_IPV4 if _u8(buf, offset)[0] == socket.AF_INET else ETHERTYPE_IPV6
+        # type-length-value attributes follow the header, their fields are in host byte order
+        # which is little endian on every device we run on
+        pos = offset + 4
+        while pos + 4 <= end:
+            length, tlv_type = struct.unpack_from('<HH', buf, pos)
+            if length < 4:
+                return None
+            if tlv_type == NFULA_PAYLOAD:
+                return ethertype, pos + 4
+            pos += (length + 3) // 4 * 4
+        return None
+
+    return None
+
+
+def _read_dns_name(buf, offset, msg_start, end):
+    """
+    read a possibly compressed domain name
+    :return: tuple of (name, offset following the name)
+    """
+    labels = []
+    next_offset = None
+    for _ in range(128):
+        if offset >= end:
+            raise ValueError('DNS name out of bounds')
+        length = _u8(buf, offset)[0]
+        if length & 0xc0 == 0xc0:
+            if next_offset is None:
+                next_offset = offset + 2
+            offset = msg_start + (_u16(buf, offset)[0] & 0x3fff)
+            continue
+        offset += 1
+        if length == 0:
+            name = b'.'.join(labels).decode('utf-8', 'replace')
+            return name, offset if next_offset is None else next_offset
+        labels.append(buf[offset:offset + length])
+        offset += length
+    raise ValueError('DNS name compression loop')
+
+
+def _ip_to_str(raw):
+    return socket.inet_ntop(socket.AF_INET if len(raw) == 4 else socket.AF_INET6, raw)
+
+
+def parse_dns(buf, offset, end):
+    """
+    :return: dict describing a DNS query or response
+    """
+    if offset + 12 > end:
+        raise ValueError('Truncated DNS header')
+    txid, flags, qdcount, ancount = struct.unpack_from('!HHHH', buf, offset)
+    record = {'txid': txid, 'response': bool(flags & 0x8000), 'rcode': flags & 0xf, 'questions': [], 'answers': []}
+
+    pos = offset + 12
+    for _ in range(qdcount):
+        name, pos = _read_dns_name(buf, pos, offset, end)
+        qtype = _u16(buf, pos)[0]
+        pos += 4
+        record['questions'].append({'name': name, 'type': DNS_TYPES.get(qtype, qtype)})
+
+    for _ in range(ancount):
+        name, pos = _read_dns_name(buf, pos, offset, end)
+        rtype, _, ttl, rdlength = struct.unpack_from('!HHIH', buf, pos)
+        pos += 10
+        if pos + rdlength > end:
+            raise ValueError('Truncated DNS answer')
+
+        if rtype in (1, 28):
+            data = _ip_to_str(buf[pos:pos + rdlength])
+        elif rtype in (2, 5, 12):
+            data = _read_dns_name(buf, pos, offset, end)[0]
+        else:
+            data = None
+        record['answers'].append({'name': name, 'type': DNS_TYPES.get(rtype, rtype), 'ttl': ttl, 'data': data})
+        pos += rdlength
+
+    return record
+
+
+def parse_http_request(buf, offset, end, max_line=2048):
+    """
+    :return: dict with the request line and host of an HTTP request, or None
+    """
+    head = buf[offset:min(end, offset + max_line)]
+    line_end = head.find(b'\r\n')
+    if line_end == -1:
+        return None
+
+    parts = head[:line_end].split(b' ')
+    if len(parts) != 3 or parts[0] not in HTTP_METHODS or not parts[2].startswith(b'HTTP/'):
+        return None
+
+    record = {'method': parts[0].decode('ascii'), 'uri': parts[1].decode('utf-8', 'replace'),
+              'version': parts[2].decode('ascii', 'replace'), 'host': None}
+    for header in head[line_end + 2:].split(b'\r\n'):
+        if header[:5].lower() == b'host:':
+            record['host'] = header[5:].strip().decode('utf-8', 'replace')
+            break
+    return record
+
+
+def parse_tls_sni(buf, offset, end):
+    """
+    :return: the server name sent in a TLS ClientHello, or None
+    """
+    # record header, then the handshake header of a ClientHello
+    if offset + 9 > end or _u8(buf, offset)[0] != 0x16 or _u8(buf, offset + 5)[0] != 1:
+        return None
+
+    # handshake header, client version and random
+    pos = offset + 5 + 4 + 2 + 32
+    if pos + 1 > end:
+        return None
+    pos += 1 + _u8(buf, pos)[0]
+    if pos + 2 > end:
+        return None
+    pos += 2 + _u16(buf, pos)[0]
+    if pos + 1 > end:
+        return None
+    pos += 1 + _u8(buf, pos)[0]
+    if pos + 2 > end:
+        return None
+
+    ext_end = min(end, pos + 2 + _u16(buf, pos)[0])
+    pos += 2
+    while pos + 4 <= ext_end:
+        ext_type, ext_len = struct.unpack_from('!HH', buf, pos)
+        pos += 4
+        if ext_type == 0:
+            # server name list, then the type and length of the first entry
+            if pos + 5 > ext_end or _u8(buf, pos + 2)[0] != 0:
+                return None
+            name_len = _u16(buf, pos + 3)[0]
+            return buf[pos + 5:min(ext_end, pos + 5 + name_len)].decode('utf-8', 'replace')
+        pos += ext_len
+    return None
+
+
+class TrafficIndex(object):
+    """
+    Builds a compact index of captured traffic as newline-delimited JSON,
+    flows with their packet and byte counts per direction, DNS messages,
+    HTTP request lines and TLS server names. Application payloads are only
+    looked at packet by packet, there's no TCP reassembly.
+    Memory is bounded by `max_flows`, idle flows are written out and forgotten
+    """
+
+    def __init__(self, out, flow_timeout=300, max_flows=65536, sweep_every=8192):
+        """
+        :param out: binary file object the index is written to
+        :param flow_timeout: seconds of inactivity after which a flow is written out
+        :param max_flows: flows kept in memory before the least recently active are written out
+        :param sweep_every: packets between two looks for idle flows
+        """
+        self.out = out
+        self.flow_timeout = flow_timeout
+        self.max_flows = max_flows
+        self.sweep_every = sweep_every
+
+        # 5-tuple as seen from the initiator => [id, first ts, last ts, packets, bytes, reply packets, reply bytes]
+        self.flows = {}
+        self.next_flow_id = 0
+        self.stats = {'packets': 0, 'flows': 0, 'dns': 0, 'http': 0, 'tls': 0, 'undecoded': 0}
+
+        self._emit({'type': 'xendroid-net-index', 'version': INDEX_VERSION})
+
+    def _emit(self, record):
+        self.out.write(json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n')
+
+    def _write_flow(self, key, flow):
+        proto, src, sport, dst, dport = key
+        self._emit({'type': 'flow', 'id': flow[0], 'proto': 'tcp' if proto == PROTO_TCP else
+                    'udp' if proto == PROTO_UDP else proto, 'src': _ip_to_str(src), 'sport': sport,
+                    'dst': _ip_to_str(dst), 'dport': dport, 'first': flow[1], 'last': flow[2],
+                    'packets': flow[3], 'bytes': flow[4], 'reply_packets': flow[5], 'reply_bytes': flow[6]})
+
+    def _sweep(self, ts):
+        """
+        write out the idle flows, and the least recently active ones if there are still too many
+        :param ts: current capture time
+        :return:
+        """
+        expired = [key for key, flow in self.flows.items() if ts - flow[2] > self.flow_timeout]
+        if len(self.flows) - len(expired) > self.max_flows:
+            active = sorted((flow[2], key) for key, flow in self.flows.items() if ts - flow[2] <= self.flow_timeout)
+            expired.extend(key for _, key in active[:len(active) - self.max_flows // 2])
+
+        for key in expired:
+            self._write_flow(key, self.flows.pop(key))
+
+    def add_packet(self, ts, linktype, buf, offset, length):
+        """
+        account for a packet as given by `iter_packets`
+        :return:
+        """
+        self.stats['packets'] += 1
+        if self.stats['packets'] % self.sweep_every == 0 or len(self.flows) > self.max_flows:
+            self._sweep(ts)
+
+        end = offset + length
+        network = _network_offset(buf, linktype, offset, end)
+        if network is None:
+            self.stats['undecoded'] += 1
+            return
+        ethertype, pos = network
+
+        try:
+            if ethertype == ETHERTYPE_IPV4 and pos + 20 <= end:
+                ihl = (_u8(buf, pos)[0] & 0xf) * 4
+                total_len, frag = struct.unpack_from('!H2xH', buf, pos + 2)
+                proto = _u8(buf, pos + 9)[0]
+                src, dst = buf[pos + 12:pos + 16], buf[pos + 16:pos + 20]
+                end = min(end, pos + total_len)
+                # only the first fragment carries the transport header
+                transport = pos + ihl if frag & 0x1fff == 0 else None
+            elif ethertype == ETHERTYPE_IPV6 and pos + 40 <= end:
+                payload_len = _u16(buf, pos + 4)[0]
+                proto = _u8(buf, pos + 6)[0]
+                src, dst = buf[pos + 8:pos + 24], buf[pos + 24:pos + 40]
+                total_len = 40 + payload_len
+                end = min(end, pos + total_len)
+                transport = pos + 40
+            else:
+                self.stats['undecoded'] += 1
+                return
+
+            sport = dport = 0
+            payload = None
+            if transport is not None and proto == PROTO_TCP and transport + 20 <= end:
+                sport, dport, data_off = struct.unpack_from('!HH8xB', buf, transport)
+                payload = transport + (data_off >> 4) * 4
+            elif transport is not None and proto == PROTO_UDP and transport + 8 <= end:
+                sport, dport = struct.unpack_from('!HH', buf, transport)
+                payload = transport + 8
+        except struct.error:
+            self.stats['undecoded'] += 1
+            return
+
+        key = (proto, src, sport, dst, dport)
+        flow = self.flows.get(key)
+        if flow is not None:
+            flow[3] += 1
+            flow[4] += total_len
+        else:
+            flow = self.flows.get((proto, dst, dport, src, sport))
+            if flow is not None:
+                flow[5] += 1
+                flow[6] += total_len
+            else:
+                flow = self.flows[key] = [self.next_flow_id, ts, ts, 1, total_len, 0, 0]
+                self.next_flow_id += 1
+                self.stats['flows'] += 1
+        flow[2] = ts
+
+        if payload is not None and payload < end:
+            self._inspect(ts, flow[0], proto, sport, dport, buf, payload, end)
+
+    def _inspect(self, ts, flow_id, proto, sport, dport, buf, offset, end):
+        try:
+            if proto == PROTO_UDP and 53 in (sport, dport):
+                record = parse_dns(buf, offset, end)
+                record.update({'type': 'dns', 'ts': ts, 'flow': flow_id})
+                self._emit(record)
+                self.stats['dns'] += 1
+
+            elif proto == PROTO_TCP and _u8(buf, offset)[0] in _INTERESTING_FIRST_BYTES:
+                if _u8(buf, offset)[0] == 0x16:
+                    sni = parse_tls_sni(buf, offset, end)
+                    if sni is not None:
+                        self._emit({'type': 'tls', 'ts': ts, 'flow': flow_id, 'sni': sni})
+                        self.stats['tls'] += 1
+                else:
+                    record = parse_http_request(buf, offset, end)
+                    if record is not None:
+                        record.update({'type': 'http', 'ts': ts, 'flow': flow_id})
+                        self._emit(record)
+                        self.stats['http'] += 1
+        except (struct.error, ValueError, socket.error) as err:
+            logger.debug('Unable to parse the payload of flow {}: {}'.format(flow_id, err))
+
+    def add_capture(self, path):
+        """
+        index every packet of a pcap or pcapng file
+        :param path:
+        :return:
+        """
+        for packet in iter_packets(path):
+            self.add_packet(*packet)
+
+    def close(self):
+        """
+        write out the flows left in memory
+        :return:
+        """
+        for key, flow in sorted(self.flows.items(), key=lambda item: item[1][0]):
+            self._write_flow(key, flow)
+        self.flows = {}
+        self.out.flush()
+
+
+def index_capture(capture_paths, index_path, **kwargs):
+    """
+    index capture files as if they were one capture, e.g. the segments of a `PcapWriter`
+    :param capture_paths: pcap or pcapng files, in order
+    :param index_path: where the index is written
+    :param kwargs: see `TrafficIndex`
+    :return: the counters of the index
+    """
+    with io.open(index_path, 'wb') as out:
+        index = TrafficIndex(out, **kwargs)
+        for path in capture_paths:
+            index.add_capture(path)
+        index.close()
+    return index.stats
+
+
+def read_index(index_path, types=None):
+    """
+    read back an index written by `index_capture`
+    :param index_path:
+    :param types: record types to keep, e.g. ('dns', 'tls'), all of them by default
+    :return: generator of the records, the header excluded
+    """
+    with io.open(index_path, 'rb') as fh:
+        for line in fh:
+            record = json.loads(line.decode('utf-8'))
+            if record['type'] == 'xendroid-net-index':
+                continue
+            if types is None or record['type'] in types:
+                yield record
@@ -7,9 +7,15 @@
 
 
 import os
+import time
+import sqlite3
 import logging
 
 from modules import startup
+from modules.snapshot import SnapshotEngine
+from modules.fake_internet import FakeInternet
+from modules.static_analysis import ApkReferences
+from modules.analysing.timeline import build_timeline
 from modules.connection.adb import ADB
 from modules.connection.Frida import Frida
 from modules.connection.droidbot import DroidBot
@@ -17,7 +23,7 @@ from modules.monitoring.api_mon import APIMonitor
 from modules.monitoring.net_mon import TrafficMonitor
 
 from lib.definitions.constants import ANALYSES_DIR
-from lib.definitions.exceptions import XenDroidModuleError
+from lib.definitions.exceptions import XenDroidModuleError, XenDroidADBError
 from lib.api.utils import get_package_name, get_filename_from_path
 
 
@@ -27,14 +33,40 @@ class AnalysisManager(object):
     Launches an analysis task
     """
 
-    def __init__(self, apk_path, device_serial):
+    def __init__(self, apk_path, device_serial, offline=False, app_traffic_only=False, fake_internet=None,
+                 profile_interval=None, capture_blobs=False, blob_dir=None):
+        """
+        :param apk_path: path of the sample
+        :param device_serial: device serial as per the output of `adb devices`
+        :param offline: only use already cached artifacts
+        :param app_traffic_only: only capture the network traffic of the sample
+        :param fake_internet: keyword arguments of the `FakeInternet` the device is wired to,
+        None to leave the device's network alone
+        :param profile_interval: seconds between two dumps of the hooks' overhead to logs/hooks_profile.json,
+        None doesn't profile the hooks
+        :param capture_blobs: keep the full content of large captured buffers, otherwise only their digest
+        and prefix are logged
+        :param blob_dir: store of the captured buffers, shared between tasks, defaults to the task's logs/blobs
+        """
         self.logger = logging.getLogger(self.__class__.__name__)
 
         self.apk_path = apk_path
+        self.offline = offline
+        self.app_traffic_only = app_traffic_only
+        self.fake_internet_options = fake_internet
+        self.fake_internet = None
+        self.profile_interval = profile_interval
+        self.capture_blobs = capture_blobs
+        self.blob_dir = blob_dir
+        self.package_name = None
         self.adb_connection = ADB(device_serial)
         self.frida_connection = Frida(device_serial)
+        self.snapshot_engine = SnapshotEngine(self.adb_connection)
 
         self.modules = []
+        self.startup_ctx = None
+        self.apk_refs = None
+        self.clock_offset = 0.0
 
         self.analysis_path = None
         self.backup_path = None
@@ -43,11 +75,20 @@ class AnalysisManager(object):
     def _init_paths(self):
         analysis_num = 0
         if os.path.exists(ANALYSES_DIR):
-            analysis_num = int(max(os.listdir(ANALYSES_DIR),
-                                   key=lambda x: int(x.split('_')[1]))) + 1
+            analysis_num = max([int(x.split('_')[1]) for x in os.listdir(ANALYSES_DIR)] or [-1]) + 1
 
-        self.analysis_path = os.path.join(ANALYSES_DIR, 'task_' + str(analysis_num))
-        self.backup_path = os.path.join(self.analysis_path, 'backup', 'backup.ab')
+        # several tasks may be starting at once, the first to create a directory owns it
+        while True:
+            self.analysis_path = os.path.join(ANALYSES_DIR, 'task_' + str(analysis_num))
+            try:
+                os.makedirs(self.analysis_path)
+                break
+            except OSError:
+                if not os.path.exists(self.analysis_path):
+                    raise
+                analysis_num += 1
+
+        self.backup_path = os.path.join(self.analysis_path, 'backup', 'snapshot.json')
 
         os.makedirs(os.path.join(self.analysis_path, 'backup'))
         os.makedirs(os.path.join(self.analysis_path, 'logs'))
@@ -67,8 +108,13 @@ class AnalysisManager(object):
         modules = self.modules
 
         # Initialize the monitoring modules
-        tm = TrafficMonitor(self.adb_connection, self.analysis_path)
-        api_m = APIMonitor(self.frida_connection, self.analysis_path)
+        tm = TrafficMonitor(self.analysis_path, self.adb_connection,
+                            package_name=self.package_name if self.app_traffic_only else None)
+        blob_dir = None
+        if self.capture_blobs:
+            blob_dir = self.blob_dir or os.path.join(self.analysis_path, 'logs', 'blobs')
+        api_m = APIMonitor(self.analysis_path, self.frida_connection, profile_interval=self.profile_interval,
+                           blob_dir=blob_dir, apk_refs=self.apk_refs)
 
         try:
             api_m.start()
@@ -82,24 +128,66 @@ class AnalysisManager(object):
         except XenDroidModuleError:
             self.logger.error('Network sniffer module startup failed...')
 
+    def measure_clock_offset(self):
+        """
+        :return: seconds to add to the host's clock to get the device's
+        """
+        try:
+            before = time.time()
+            device_time = self.adb_connection.get_device_time()
+            return device_time - (before + time.time()) / 2
+        except (XenDroidADBError, ValueError) as err:
+            self.logger.warning('Unable to read the clock of the device, assuming it matches the host: {}'.format(
+                err))
+            return 0.0
+
+    def write_timeline(self):
+        """
+        gather the events of every monitor on the device's clock in logs/timeline.sqlite
+        :return:
+        """
+        try:
+            timeline = build_timeline(self.analysis_path, self.clock_offset)
+        except sqlite3.Error as err:
+            self.logger.error('Unable to write the timeline of the task: {}'.format(err))
+            return
+
+        self.logger.info('Timeline: {} events'.format(sum(timeline.counts().values())))
+        timeline.close()
+
+    def stop_fake_internet(self):
+        if self.fake_internet is not None:
+            self.fake_internet.stop()
+            self.fake_internet = None
+
     def roll_back(self):
-        if self.backup_path.exists():
-            self.adb_connection.restore_backup(self.backup_path)
+        self.stop_fake_internet()
+
+        if os.path.exists(self.backup_path):
+            self.snapshot_engine.restore(self.backup_path)
 
     def start(self):
         self.logger.info('Analysis started with task ID: '
                          + get_filename_from_path(self.analysis_path))
 
-        # store a backup of the device's current state
-        self.adb_connection.backup_device(self.backup_path)
-        startup.run_startup(self.adb_connection)
+        # store a snapshot of the device's current state
+        self.snapshot_engine.capture(self.backup_path)
+
+        if self.fake_internet_options is not None:
+            self.fake_internet = FakeInternet(os.path.join(self.analysis_path, 'logs', 'fake_internet'),
+                                              **self.fake_internet_options)
+        self.startup_ctx = startup.run_startup(self.adb_connection, self.offline, fake_internet=self.fake_internet)
+        self.clock_offset = self.measure_clock_offset()
 
         # install the target application
         self.adb_connection.install(self.apk_path)
 
+        # find the hooks the sample can reach before it's started
+        self.apk_refs = ApkReferences.for_apk(self.apk_path)
+
         # fire the target application
-        package_name = get_package_name(self.apk_path)
-        self.frida_connection.spawn_app(package_name)
+        self.package_name = get_package_name(self.apk_path)
+        self.frida_connection.spawn_app(self.package_name)
 
         # start loading the monitoring modules
         self.load_monitoring()
@@ -112,3 +200,6 @@ class AnalysisManager(object):
         ############################
 
         self.stop_monitoring()
+        # flushes the fake internet's logs before they're gathered in the timeline
+        self.stop_fake_internet()
+        self.write_timeline()
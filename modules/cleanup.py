@@ -0,0 +1,134 @@
+# Copyright (C) 2018  Muhammed Ziad
+# This file is part of XenDroid - https://github.com/muhzii/XenDroid
+#
+# An instrumented sandbox for Android
+# This program is a free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License
+
+
+import os
+import time
+import logging
+import tempfile
+
+from lib.definitions.exceptions import XenDroidADBError
+
+# user storage that gets scanned for the extensions below
+USER_FILES_ROOTS = ('/sdcard/',)
+
+USER_FILES_EXTENSIONS = ('.jpg', '.png', '.jpeg', '.mp4', '.db', '.xml')
+
+# folders emptied under every /data/data/<package>
+APP_DATA_FOLDERS = ('files', 'databases', 'shared_prefs')
+
+
+class CleanupReport(object):
+
+    def __init__(self, matched, errors, elapsed):
+        """
+        :param matched: number of files selected for deletion
+        :param errors: number of errors reported by find/rm on the device
+        :param elapsed: seconds spent
+        """
+        self.matched = matched
+        self.errors = errors
+        self.elapsed = elapsed
+
+    def __str__(self):
+        return '{} files matched, {} errors in {:.2f}s'.format(self.matched, self.errors, self.elapsed)
+
+
+class DeviceCleaner(object):
+    """
+    Deletes user files and applications' data on the device,
+    the deletion set is built on the device by `find` in a single pass and
+    removed in bulk with `-exec rm {} +` instead of one adb round trip per file
+    """
+
+    script_path = '/data/local/tmp/xendroid_cleanup.sh'
+    err_path = '/data/local/tmp/xendroid_cleanup.err'
+
+    def __init__(self, adb_connection, roots=USER_FILES_ROOTS, extensions=USER_FILES_EXTENSIONS,
+                 app_folders=APP_DATA_FOLDERS):
+        """
+        :param adb_connection: ADB connection to the device
+        :param roots: directories scanned for user files
+        :param extensions: extensions of the user files to delete
+        :param app_folders: folders to empty in every application's data directory
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.adb_connection = adb_connection
+
+        self.roots = roots
+        self.extensions = extensions
+        self.app_folders = app_folders
+
+    def _find_cmds(self, action):
+        cmds = []
+
+        if self.roots and self.extensions:
+            ext_filter = ' -o '.join('-iname "*{}"'.format(ext) for ext in self.extensions)
+            cmds.append('find {} -type f \\( {} \\) {}'.format(' '.join(self.roots), ext_filter, action))
+
+        if self.app_folders:
+            folder_filter = ' -o '.join('-path "/data/data/*/{}/*"'.format(f) for f in self.app_folders)
+            cmds.append('find /data/data -type f \\( {} \\) {}'.format(folder_filter, action))
+
+        return cmds
+
+    def _build_script(self, dry_run):
+        if dry_run:
+            finds = self._find_cmds('-print')
+            body = '{{\n{}\n}} 2>/dev/null'.format('\n'.join(finds))
+        else:
+            finds = self._find_cmds('-print -exec rm -f {} +')
+            body = '{{\n{}\n}} 2>{} | wc -l\nwc -l < {}\nrm -f {}'.format(
+                '\n'.join(finds), self.err_path, self.err_path, self.err_path)
+
+        return '# generated by XenDroid\n{}\n'.format(body)
+
+    def _push_script(self, dry_run):
+        fd, tmp_path = tempfile.mkstemp(suffix='.sh')
+        try:
+            with os.fdopen(fd, 'w') as fh:
+                fh.write(self._build_script(dry_run))
+            self.adb_connection.push_to_path(tmp_path, self.script_path)
+        finally:
+            os.unlink(tmp_path)
+
+    def iter_targets(self):
+        """
+        dry run, stream the paths that would be deleted without deleting anything
+        :return: generator of device paths
+        """
+        self._push_script(dry_run=True)
+
+        pending = b''
+        for chunk in self.adb_connection.exec_out_stream('su -c sh {}'.format(self.script_path)):
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                if line:
+                    yield line.decode('utf-8', 'replace')
+
+        if pending:
+            yield pending.decode('utf-8', 'replace')
+
+    def run(self):
+        """
+        delete the files on the device
+        :return: a `CleanupReport`
+        """
+        start = time.time()
+
+        self._push_script(dry_run=False)
+        out = self.adb_connection.shell('su -c sh {}'.format(self.script_path)) or b''
+
+        try:
+            matched, errors = [int(x) for x in out.split()[-2:]]
+        except ValueError:
+            raise XenDroidADBError('Unexpected output from the cleanup script: {!r}'.format(out))
+
+        report = CleanupReport(matched, errors, time.time() - start)
+        self.logger.debug('Device cleanup: {}'.format(report))
+        return report
@@ -10,8 +10,8 @@ import time
 import frida
 import logging
 
-from lib.api.utils import with_timeout
-from lib.definitions.exceptions import XenDroidFridaError
+from lib.api.utils import with_timeout, current_deadline
+from lib.definitions.exceptions import XenDroidFridaError, XenDroidTimeOutError
 
 
 class Frida(object):
@@ -35,37 +35,56 @@ class Frida(object):
         except (frida.InvalidArgumentError, frida.TimedOutError):
             raise XenDroidFridaError('Frida connection failed, device not found')
 
-    @with_timeout
+    @with_timeout('frida.spawn_app')
     def spawn_app(self, package_name):
         """
         start a target application by package name
         :param package_name:
         :return:
         """
-        self.pkg = package_name
-
+        deadline = current_deadline()
+        while True:
+            try:
+                pid = self.device.spawn([package_name])
+                break
+
+            except frida.NotSupportedError:
+                raise XenDroidFridaError(
+                    'No application with such package name installed: {}'.format(package_name))
+            except frida.ServerNotRunningError:
+                raise XenDroidFridaError(
+                    "Unable to connect to frida's server on the device")
+            except (frida.TransportError, frida.TimedOutError):
+                self.logger.warning('Application startup failed, re-spawning the application...')
+            except frida.InvalidOperationError:
+                # wait for a previous spawn operation to finish
+                time.sleep(min(5, deadline.remaining()))
+            deadline.check('frida.spawn_app')
+
+        # the caller may have given up on the spawn by now
         try:
-            self.pid = self.device.spawn([package_name])
-
-        except frida.NotSupportedError:
-            raise XenDroidFridaError(
-                'No application with such package name installed: {}'.format(self.pkg))
-        except frida.ServerNotRunningError:
-            raise XenDroidFridaError(
-                "Unable to connect to frida's server on the device")
-        except (frida.TransportError, frida.TimedOutError):
-            self.logger.warning('Application startup failed, re-spawning the application...')
-            self.spawn_app(self.pkg)
-            return
-        except frida.InvalidOperationError:
-            # wait for a previous spawn operation to finish
-            time.sleep(5)
-            self.spawn_app(self.pkg)
-            return
+            with deadline.commit('frida.spawn_app'):
+                self.pkg = package_name
+                self.pid = pid
+        except XenDroidTimeOutError:
+            self.logger.warning('Killing {} (pid {}), spawned after the timeout'.format(package_name, pid))
+            self._kill(pid)
+            raise
 
         self.logger.debug('Spawned target application...')
         self.logger.debug('Target application process name: {}'.format(self.pkg))
 
+    def _kill(self, pid):
+        """
+        kill a process, ignoring the ones that are already gone
+        :param pid:
+        :return:
+        """
+        try:
+            self.device.kill(pid)
+        except (frida.ProcessNotFoundError, frida.TransportError, frida.InvalidOperationError) as err:
+            self.logger.debug('Unable to kill {}: {}'.format(pid, err))
+
     def set_msg_handler(self, msg_handler):
         """
         set the handler function to handle messages
@@ -111,25 +130,89 @@ class Frida(object):
 
         self.logger.debug('Frida session established!')
 
-    @with_timeout
-    def load_script(self, _script):
+    @staticmethod
+    def runtime_tag():
+        """
+        :return: identifies the compiler of `compile_script`
+        """
+        return 'frida-{}'.format(frida.__version__)
+
+    def compile_script(self, _script):
+        """
+        compile a script to bytecode in the current session
+        :param _script: frida based JavaScript code
+        :return: the bytecode or None if the session can't compile scripts
+        """
+        if not hasattr(self.session, 'compile_script'):
+            return None
+
+        try:
+            return self.session.compile_script(_script)
+        except frida.NotSupportedError as err:
+            self.logger.debug('The session does not support compiling scripts: {}'.format(err))
+            return None
+        except (frida.InvalidArgumentError, frida.InvalidOperationError) as err:
+            raise XenDroidFridaError('Unable to compile the script: {}'.format(err))
+
+    @with_timeout('frida.load_script')
+    def load_script(self, _script, bytecode=None):
         """
         load a script into the process
         :param _script: frida based JavaScript code
+        :param bytecode: the compiled script, used instead of the code if given
         :return:
         """
+        deadline = current_deadline()
         if self.script is not None:
             self.terminate_session()
             self.spawn_app(self.pkg)
             self.start_session()
 
+        while True:
+            script = None
+            try:
+                if bytecode is not None:
+                    try:
+                        script = self.session.create_script_from_bytes(bytecode)
+                    except (frida.NotSupportedError, frida.InvalidArgumentError) as err:
+                        self.logger.debug('Unable to load the compiled script, using its code: {}'.format(err))
+
+                if script is None:
+                    script = self.session.create_script(_script)
+                script.on('message', self.script_msg_handler)
+                script.load()
+                break
+            except frida.TransportError:
+                self.logger.debug('Failed at loading the script, reloading...')
+            deadline.check('frida.load_script')
+
+        # the caller may have given up on the script by now
+        try:
+            with deadline.commit('frida.load_script'):
+                self.script = script
+        except XenDroidTimeOutError:
+            try:
+                script.unload()
+            except (frida.InvalidOperationError, frida.TransportError):
+                pass
+            raise
+
+    def call_export(self, name, *args):
+        """
+        call a function exported by the loaded script through `rpc.exports`
+        :param name: name of the export, in snake case
+        :param args:
+        :return: what the export returned
+        """
+        if self.script is None:
+            raise XenDroidFridaError('No script is loaded')
+
+        # `exports` became asynchronous in frida 16, the blocking variant is `exports_sync`
+        exports = getattr(self.script, 'exports_sync', None) or self.script.exports
         try:
-            self.script = self.session.create_script(_script)
-            self.script.on('message', self.script_msg_handler)
-            self.script.load()
-        except frida.TransportError:
-            self.logger.debug('Failed at loading the script, reloading...')
-            self.load_script(_script)
+            return getattr(exports, name)(*args)
+        except (frida.InvalidOperationError, frida.core.RPCException) as err:
+            raise XenDroidFridaError('Call to the script export `{}` failed: {}'.format(name, err))
 
     def terminate_session(self):
         """
@@ -6,11 +6,154 @@
 # it under the terms of the GNU General Public License
 
 
+import os
+import re
+import stat
+import time
+import select
 import logging
+import threading
 import subprocess
 
 from multiprocessing import Process
-from lib.definitions.exceptions import XenDroidADBError
+from lib.api.utils import get_rand_str, current_deadline, deadline_scope, get_timeout
+from lib.definitions.exceptions import XenDroidADBError, XenDroidInstallError, XenDroidTimeOutError
+from modules.connection.ui_automator import UIWaiter
+
+
+class ShellSession(object):
+    """
+    A long-lived `adb shell` channel to a single device,
+    commands are written to the shell's stdin and each one is framed
+    by a sentinel line carrying its exit code
+    """
+
+    err_file = '/data/local/tmp/.xendroid_shell_err'
+
+    def __init__(self, serial, timeout=60):
+        """
+        :param serial: device serial as per the output of `adb devices`
+        :param timeout: seconds to wait for a single command to finish
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.serial = serial
+        self.timeout = timeout
+
+        self.process = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        """
+        spawn the underlying `adb shell` process
+        :return:
+        """
+        self.close()
+        try:
+            self.process = subprocess.Popen(
+                ['adb', '-s', self.serial, 'shell'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=open(os.devnull, 'wb')
+            )
+        except OSError as err:
+            raise XenDroidADBError('Unable to start an adb shell session: {}'.format(err))
+
+        self.logger.debug('Shell session opened with device {}'.format(self.serial))
+
+    def _is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def _read_until(self, sentinel):
+        """
+        read the shell's stdout until the sentinel line is complete
+        :param sentinel:
+        :return: the output preceding the sentinel and the exit code
+        """
+        fd = self.process.stdout.fileno()
+        buf = b''
+
+        while True:
+            idx = buf.find(sentinel)
+            if idx != -1:
+                end = buf.find(b'\n', idx)
+                if end != -1:
+                    code = buf[idx + len(sentinel):end].strip()
+                    return buf[:idx], int(code)
+
+            deadline = current_deadline()
+            timeout = self.timeout if deadline is None else min(self.timeout, deadline.remaining())
+
+            ready, _, _ = select.select([fd], [], [], timeout)
+            if not ready:
+                raise XenDroidADBError('adb shell session timed out')
+
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise EOFError()
+            buf += chunk
+
+    def _send(self, cmd_line):
+        """
+        write a command line followed by the sentinel echo
+        :param cmd_line:
+        :return: the output of the command and its exit code
+        """
+        token = get_rand_str(16)
+
+        # the sentinel is split in the printf arguments so that
+        # a shell echoing its input can never produce a false match
+        frame = '{}; printf "__XENDROID_%s__ %d\\n" {} $?\n'.format(cmd_line, token)
+        self.process.stdin.write(frame.encode())
+        self.process.stdin.flush()
+
+        return self._read_until('__XENDROID_{}__'.format(token).encode())
+
+    def _execute(self, cmd):
+        # stdin is detached so that a command can't swallow the next frames
+        out, code = self._send('{{ {}\n}} </dev/null 2>{}'.format(cmd, self.err_file))
+
+        err = None
+        if code != 0:
+            err, _ = self._send('cat {}'.format(self.err_file))
+        return out, code, err
+
+    def run(self, cmd):
+        """
+        run a command over the session, reconnecting once
+        if the channel turns out to be broken
+        :param cmd: shell command line
+        :return: tuple of (stdout, exit code, stderr or None)
+        """
+        with self.lock:
+            for attempt in range(2):
+                if not self._is_alive():
+                    self._connect()
+                try:
+                    return self._execute(cmd)
+                except (IOError, OSError, EOFError, ValueError):
+                    self.logger.debug('Shell session with {} dropped, reconnecting...'.format(self.serial))
+                    self.close()
+                    if attempt:
+                        raise XenDroidADBError('adb shell session lost: `{}`'.format(cmd))
+                except XenDroidADBError:
+                    # the output state is unknown after a timeout
+                    self.close()
+                    raise
+
+    def close(self):
+        """
+        terminate the underlying `adb shell` process
+        :return:
+        """
+        if self.process is None:
+            return
+
+        try:
+            if self.process.poll() is None:
+                self.process.stdin.close()
+                self.process.kill()
+            self.process.wait()
+        except (IOError, OSError):
+            pass
+        self.process = None
 
 
 class ADB(object):
@@ -19,16 +162,24 @@ class ADB(object):
     send adb commands via this
     """
 
-    def __init__(self, serial):
+    def __init__(self, serial, persistent_shell=False, wire_client=None):
         """
         initiate a ADB connection from serial no
         the serial no should be in output of `adb devices`
         :param serial: serial no.
+        :param persistent_shell: send `shell` commands over one long-lived
+        session instead of forking `adb shell` for every command
+        :param wire_client: an `AdbWireClient` that talks to the adb server directly,
+        shell, push, pull, install, root and remount go through it instead of the adb binary
         :return:
         """
         self.logger = logging.getLogger(self.__class__.__name__)
+        self.serial = serial
         self.cmd_prefix = ['adb', "-s", serial]
 
+        self.shell_session = ShellSession(serial) if persistent_shell else None
+        self.wire_client = wire_client
+
     def run_cmd(self, extra_args):
         """
         run an adb command and return the output
@@ -38,11 +189,25 @@ class ADB(object):
         if isinstance(extra_args, str) or isinstance(extra_args, unicode):
             extra_args = extra_args.split()
 
+        if self.wire_client is not None and extra_args in (['root'], ['remount']):
+            return self.wire_client.run_service(extra_args[0] + ':') or None
+
         args = [] + self.cmd_prefix
         args += extra_args
 
-        p = subprocess.Popen(args, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        out, err = p.communicate()
+        with deadline_scope(get_timeout('adb.cmd')) as deadline:
+            p = subprocess.Popen(args, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+
+            timer = threading.Timer(deadline.remaining(), self._kill_process, args=(p,))
+            timer.daemon = True
+            timer.start()
+            try:
+                out, err = p.communicate()
+            finally:
+                timer.cancel()
+
+            if deadline.expired:
+                raise XenDroidTimeOutError('adb {}'.format(' '.join(args[3:])))
 
         if p.returncode != 0:
             msg = 'adb command: `{}` failed\nERROR:{}'.format(' '.join(args[3:]), err)
@@ -53,6 +218,14 @@ class ADB(object):
         else:
             return out
 
+    @staticmethod
+    def _kill_process(p):
+        try:
+            p.kill()
+        except OSError:
+            # already exited
+            pass
+
     def shell(self, extra_args):
         """
         run an `adb shell` command
@@ -62,16 +235,130 @@ class ADB(object):
         if isinstance(extra_args, str) or isinstance(extra_args, unicode):
             extra_args = extra_args.split()
 
+        if self.wire_client is not None:
+            return self._wire_shell(' '.join(extra_args))
+
+        if self.shell_session is not None:
+            return self._session_shell(' '.join(extra_args))
+
         shell_extra_args = ['shell'] + extra_args
         return self.run_cmd(shell_extra_args)
 
+    def _session_shell(self, cmd):
+        """
+        run a shell command over the persistent session,
+        mirrors the error and output handling of `run_cmd`
+        :param cmd:
+        :return:
+        """
+        with deadline_scope(get_timeout('adb.cmd')):
+            out, code, err = self.shell_session.run(cmd)
+
+        if code != 0:
+            msg = 'adb command: `shell {}` failed\nERROR:{}'.format(cmd, err)
+            raise XenDroidADBError(msg)
+
+        if out == b'':
+            return None
+        else:
+            return out
+
+    def _wire_shell(self, cmd):
+        """
+        run a shell command through the adb server protocol,
+        mirrors the error and output handling of `run_cmd`
+        :param cmd:
+        :return:
+        """
+        with deadline_scope(get_timeout('adb.cmd')):
+            out, err, code = self.wire_client.shell(cmd)
+
+        if code != 0:
+            msg = 'adb command: `shell {}` failed\nERROR:{}'.format(cmd, err)
+            raise XenDroidADBError(msg)
+
+        if out == b'':
+            return None
+        else:
+            return out
+
+    def exec_out_stream(self, cmd, chunk_size=65536):
+        """
+        run a command through `adb exec-out` and yield its raw output
+        as it arrives, closing the generator stops the command
+        :param cmd: shell command line
+        :param chunk_size:
+        :return: generator of output chunks
+        """
+        if self.wire_client is not None:
+            sock = self.wire_client.open_service('exec:{}'.format(cmd))
+            try:
+                while True:
+                    chunk = sock.recv(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                sock.close()
+            return
+
+        args = self.cmd_prefix + ['exec-out', cmd]
+        try:
+            p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=open(os.devnull, 'wb'))
+        except OSError as err:
+            raise XenDroidADBError('adb command: `exec-out {}` failed\nERROR:{}'.format(cmd, err))
+
+        try:
+            while True:
+                chunk = os.read(p.stdout.fileno(), chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            if p.poll() is None:
+                p.kill()
+            p.wait()
+
+    def exec_out(self, cmd):
+        """
+        run a command through `adb exec-out`, the output is binary safe
+        :param cmd: shell command line
+        :return: the raw output of the command
+        """
+        return b''.join(self.exec_out_stream(cmd))
+
+    def close(self):
+        """
+        release the persistent shell session and the pooled
+        adb server connections if there are any
+        :return:
+        """
+        if self.shell_session is not None:
+            self.shell_session.close()
+
+        if self.wire_client is not None:
+            self.wire_client.close()
+
     def install(self, apk_path):
         """
         install application on device with `adb install`
         :param apk_path: Path to the APK file
         :return:
         """
-        self.run_cmd('install %s' % apk_path)
+        if self.wire_client is None:
+            self.run_cmd('install %s' % apk_path)
+            return
+
+        t_path = '/data/local/tmp/{}'.format(os.path.basename(apk_path))
+        self.wire_client.push(apk_path, t_path)
+        try:
+            out = self.shell('pm install {}'.format(t_path)) or b''
+        finally:
+            self.shell('rm -f {}'.format(t_path))
+
+        if b'Success' not in out:
+            # the package manager rejected the sample, the device itself is fine
+            raise XenDroidInstallError('adb command: `install {}` failed\nERROR:{}'.format(apk_path, out))
 
     def touch(self, x, y):
         """
@@ -86,22 +373,11 @@ class ADB(object):
         """
         This function gets the coordinates of a specific element
         on the screen given its name
-        :param element_name:
-        :return:
+        :param element_name: text, content-desc or resource-id of the view
+        :return: coordinates of the center of the view or None
         """
-
-        self.shell("uiautomator dump")
-        layout = self.shell("cat /mnt/sdcard/window_dump.xml")
-
-        if element_name.lower() in layout.lower():
-            bounds = layout.split(element_name)[1].split("bounds=")[1].\
-                    split()[0].split("][")[0][2:]
-
-            x, y = map(int, bounds.split(","))
-
-            return x, y
-        else:
-            return None
+        node = UIWaiter(self).dump().find(element_name)
+        return node.center if node is not None else None
 
     def get_prop(self, _property):
         """
@@ -142,6 +418,27 @@ class ADB(object):
         _property = 'ro.build.version.sdk'
         return self.get_prop(_property)
 
+    def get_device_time(self):
+        """
+        Get the time on the device's clock
+        :return: seconds since the epoch
+        """
+        out = (self.shell('date +%s.%N') or b'').strip()
+        if not re.match(br'^\d+\.\d+$', out):
+            # no nanoseconds support in `date`
+            out = (self.shell('date +%s') or b'').strip()
+        return float(out)
+
+    def get_package_uid(self, package_name):
+        """
+        Get the linux user id an installed application runs as
+        :param package_name:
+        :return: the uid or None if the package isn't installed
+        """
+        out = self.shell('dumpsys package {}'.format(package_name)) or b''
+        match = re.search(br'userId=(\d+)', out)
+        return int(match.group(1)) if match else None
+
     def push_to_path(self, source_p, target_p):
         """
         Push a file specified by the source to a target path
@@ -149,6 +446,13 @@ class ADB(object):
         :param source_p:
         :return:
         """
+        if self.wire_client is not None:
+            # mimic `adb push` when the target is a directory
+            if stat.S_ISDIR(self.wire_client.stat(target_p)[0]):
+                target_p = '{}/{}'.format(target_p.rstrip('/'), os.path.basename(source_p))
+            self.wire_client.push(source_p, target_p)
+            return
+
         push_arg = 'push {} {}'.format(source_p, target_p)
         self.run_cmd(push_arg)
 
@@ -159,9 +463,40 @@ class ADB(object):
         :param target_p:
         :return:
         """
+        if self.wire_client is not None:
+            if os.path.isdir(target_p):
+                target_p = os.path.join(target_p, source_p.rstrip('/').split('/')[-1])
+            self.wire_client.pull(source_p, target_p)
+            return
+
         pull_arg = 'pull {} {}'.format(source_p, target_p)
         self.run_cmd(pull_arg)
 
+    def reverse(self, device_port, host_port):
+        """
+        Make connections to a port of the device's loopback reach a port of the host
+        :param device_port:
+        :param host_port:
+        :return:
+        """
+        if self.wire_client is not None:
+            self.wire_client.run_service('reverse:forward:tcp:{};tcp:{}'.format(device_port, host_port))
+            return
+
+        self.run_cmd(['reverse', 'tcp:{}'.format(device_port), 'tcp:{}'.format(host_port)])
+
+    def remove_reverse(self, device_port):
+        """
+        Remove a port reversed with `reverse`
+        :param device_port:
+        :return:
+        """
+        if self.wire_client is not None:
+            self.wire_client.run_service('reverse:killforward:tcp:{}'.format(device_port))
+            return
+
+        self.run_cmd(['reverse', '--remove', 'tcp:{}'.format(device_port)])
+
     def kill_process(self, pid):
         """
         Stops a running process given its pid
@@ -173,20 +508,33 @@ class ADB(object):
 
         self.logger.debug('target process with PID {} is suspended'.format(pid))
 
-    def run_ui_based_cmd(self, args, view_to_click):
+    def run_ui_based_cmd(self, args, view_to_click, timeout=None):
         """
         Run a process that requires a UI action
         :param args:
-        :param view_to_click:
+        :param view_to_click: name of the view to click, or a list of candidates
+        :param timeout: seconds to wait for the process to finish,
+        the `adb.ui_cmd` timeout by default
         :return:
         """
+        if timeout is None:
+            timeout = get_timeout('adb.ui_cmd')
+
         process = Process(target=ADB.run_cmd, args=(self, args))
         process.start()
 
-        while process.is_alive():
-            coords = self.get_view_coordinates_by_name(view_to_click)
-            if coords is not None:
-                self.touch(coords[0], coords[1])
+        waiter = UIWaiter(self)
+        deadline = time.time() + timeout
+
+        while process.is_alive() and time.time() < deadline:
+            found = waiter.wait_for(view_to_click, deadline - time.time(), alive=process.is_alive)
+            if found is not None:
+                self.touch(*found[1].center)
+                waiter.invalidate()
+
+        if process.is_alive():
+            process.terminate()
+            raise XenDroidADBError('adb command: `{}` timed out waiting for the UI'.format(args))
         process.join()
 
     def backup_device(self, backup_to_path):
@@ -0,0 +1,253 @@
+# Copyright (C) 2018  Muhammed Ziad
+# This file is part of XenDroid - https://github.com/muhzii/XenDroid
+#
+# An instrumented sandbox for Android
+# This program is a free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License
+
+
+import os
+import struct
+import shutil
+import logging
+import tempfile
+import threading
+import subprocess
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from modules.connection.adb_wire import (
+    recv_exact, to_bytes, SYNC_DATA_MAX, SHELL_STDOUT, SHELL_STDERR, SHELL_EXIT
+)
+
+
+class _ProtocolError(Exception):
+    pass
+
+
+class _FakeAdbHandler(socketserver.BaseRequestHandler):
+
+    def _read_request(self):
+        length = int(recv_exact(self.request, 4), 16)
+        return recv_exact(self.request, length).decode('utf-8')
+
+    def _okay(self, payload=None):
+        msg = b'OKAY'
+        if payload is not None:
+            payload = to_bytes(payload)
+            msg += b'%04x' % len(payload) + payload
+        self.request.sendall(msg)
+
+    def _fail(self, msg):
+        msg = to_bytes(msg)
+        self.request.sendall(b'FAIL' + b'%04x' % len(msg) + msg)
+        raise _ProtocolError()
+
+    def handle(self):
+        server = self.server.fake
+        server.connections += 1
+
+        try:
+            request = self._read_request()
+            server.requests.append(request)
+
+            if request == 'host:version':
+                self._okay('0029')
+            elif request == 'host:devices':
+                self._okay(''.join('{}\tdevice\n'.format(s) for s in server.serials))
+            elif request.startswith('host-serial:') and request.endswith(':features'):
+                self._okay(','.join(server.features))
+            elif request.startswith('host:transport'):
+                self._handle_transport(request)
+            else:
+                self._fail('unknown host service')
+        except _ProtocolError:
+            pass
+        except Exception as err:
+            server.logger.debug('fake adb server connection dropped: {}'.format(err))
+
+    def _handle_transport(self, request):
+        server = self.server.fake
+
+        if request == 'host:transport-any' and server.serials:
+            serial = server.serials[0]
+        else:
+            serial = request.split(':', 2)[-1]
+        if serial not in server.serials:
+            self._fail("device '{}' not found".format(serial))
+        self._okay()
+
+        service = self._read_request()
+        server.requests.append(service)
+
+        if service.startswith('shell,v2'):
+            self._okay()
+            self._handle_shell_v2(service.split(':', 1)[1])
+        elif service.startswith('shell:') or service.startswith('exec:'):
+            self._okay()
+            out, err, _ = server.shell_handler(service.split(':', 1)[1])
+            self.request.sendall(out if service.startswith('exec:') else out + err)
+        elif service == 'sync:':
+            self._okay()
+            self._handle_sync()
+        elif service in ('root:', 'remount:'):
+            self._okay()
+            self.request.sendall(b'')
+        else:
+            self._fail('unknown device service')
+
+    def _handle_shell_v2(self, cmd):
+        out, err, code = self.server.fake.shell_handler(cmd)
+
+        packets = [(SHELL_STDOUT, out), (SHELL_STDERR, err), (SHELL_EXIT, struct.pack('<B', code & 0xff))]
+        for packet_id, data in packets:
+            if data or packet_id == SHELL_EXIT:
+                self.request.sendall(struct.pack('<BI', packet_id, len(data)) + data)
+
+    def _sync_reply(self, cmd_id, data=b''):
+        self.request.sendall(cmd_id + struct.pack('<I', len(data)) + data)
+
+    def _handle_sync(self):
+        server = self.server.fake
+
+        while True:
+            header = recv_exact(self.request, 8)
+            cmd_id, length = header[:4], struct.unpack('<I', header[4:])[0]
+
+            if cmd_id == b'QUIT':
+                return
+            arg = recv_exact(self.request, length).decode('utf-8')
+            server.requests.append('sync:{} {}'.format(cmd_id.decode(), arg))
+
+            if cmd_id == b'STAT':
+                path = server.local_path(arg)
+                if os.path.exists(path):
+                    st = os.stat(path)
+                    reply = (st.st_mode, st.st_size, int(st.st_mtime))
+                else:
+                    reply = (0, 0, 0)
+                self.request.sendall(b'STAT' + struct.pack('<III', *reply))
+
+            elif cmd_id == b'SEND':
+                remote_path, mode = arg.rsplit(',', 1)
+                self._sync_receive_file(server.local_path(remote_path), int(mode))
+
+            elif cmd_id == b'RECV':
+                path = server.local_path(arg)
+                if not os.path.isfile(path):
+                    self._sync_reply(b'FAIL', b'No such file or directory')
+                    continue
+                with open(path, 'rb') as fh:
+                    while True:
+                        chunk = fh.read(SYNC_DATA_MAX)
+                        if not chunk:
+                            break
+                        self._sync_reply(b'DATA', chunk)
+                self._sync_reply(b'DONE')
+
+            else:
+                self._sync_reply(b'FAIL', b'unsupported sync command')
+                return
+
+    def _sync_receive_file(self, path, mode):
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+
+        with open(path, 'wb') as fh:
+            while True:
+                header = recv_exact(self.request, 8)
+                cmd_id, length = header[:4], struct.unpack('<I', header[4:])[0]
+                if cmd_id == b'DATA':
+                    fh.write(recv_exact(self.request, length))
+                elif cmd_id == b'DONE':
+                    mtime = length
+                    break
+                else:
+                    raise _ProtocolError()
+
+        os.chmod(path, mode & 0o777)
+        os.utime(path, (mtime, mtime))
+        self._sync_reply(b'OKAY')
+
+
+class _ThreadingServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeAdbServer(object):
+    """
+    A local stand-in for the adb server, speaks enough of the host protocol
+    for the `AdbWireClient` to be exercised without a device.
+    Sync paths are mapped into the `root` directory and shell commands
+    run on the host via `sh -c` with `root` as the working directory
+    """
+
+    def __init__(self, serials=('emulator-5554',), root=None, features=('shell_v2', 'cmd'),
+                 shell_handler=None):
+        """
+        :param serials: serials of the emulated devices
+        :param root: directory acting as the device filesystem, a temporary one by default
+        :param features: feature list reported for the devices
+        :param shell_handler: callable taking a command and returning (stdout, stderr, exit code)
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.serials = list(serials)
+        self.features = list(features)
+        self.shell_handler = shell_handler or self._run_locally
+
+        self._own_root = root is None
+        self.root = tempfile.mkdtemp(prefix='xendroid_fake_adb_') if root is None else root
+
+        self.connections = 0
+        self.requests = []
+
+        self._server = None
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def local_path(self, device_path):
+        return os.path.join(self.root, device_path.lstrip('/'))
+
+    def _run_locally(self, cmd):
+        p = subprocess.Popen(['sh', '-c', cmd], cwd=self.root,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        return out, err, p.returncode
+
+    def start(self):
+        """
+        start serving on an ephemeral localhost port
+        :return: the port
+        """
+        self._server = _ThreadingServer(('127.0.0.1', 0), _FakeAdbHandler)
+        self._server.fake = self
+
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+        if self._own_root:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
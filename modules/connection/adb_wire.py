@@ -0,0 +1,389 @@
+# Copyright (C) 2018  Muhammed Ziad
+# This file is part of XenDroid - https://github.com/muhzii/XenDroid
+#
+# An instrumented sandbox for Android
+# This program is a free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License
+
+
+import os
+import re
+import stat
+import time
+import socket
+import struct
+import logging
+import threading
+
+from lib.api.utils import get_rand_str, current_deadline
+from lib.definitions.constants import ADB_SERVER_HOST, ADB_SERVER_PORT
+from lib.definitions.exceptions import XenDroidADBError
+
+# maximum payload of a single sync DATA packet
+SYNC_DATA_MAX = 64 * 1024
+
+# shell protocol v2 packet ids
+SHELL_STDIN, SHELL_STDOUT, SHELL_STDERR, SHELL_EXIT = 0, 1, 2, 3
+
+
+def to_bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+
+def recv_exact(sock, size):
+    """
+    read exactly `size` bytes from a socket
+    :param sock:
+    :param size:
+    :return:
+    """
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, SYNC_DATA_MAX))
+        if not chunk:
+            raise XenDroidADBError('adb server closed the connection unexpectedly')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_all(sock, fh=None):
+    """
+    read from a socket until EOF
+    :param sock:
+    :param fh: optional file object to stream the data into
+    :return: the data read or None when streaming into `fh`
+    """
+    chunks = []
+    while True:
+        chunk = sock.recv(SYNC_DATA_MAX)
+        if not chunk:
+            break
+        if fh is None:
+            chunks.append(chunk)
+        else:
+            fh.write(chunk)
+    return b''.join(chunks) if fh is None else None
+
+
+class AdbWireClient(object):
+    """
+    A client of the adb server's host protocol,
+    talks to the server at localhost:5037 directly instead of exec'ing the adb binary
+    https://android.googlesource.com/platform/system/core/+/master/adb/SERVICES.TXT
+    """
+
+    def __init__(self, serial, host=ADB_SERVER_HOST, port=ADB_SERVER_PORT,
+                 timeout=60, pool_size=4):
+        """
+        :param serial: device serial as per the output of `adb devices`
+        :param host: adb server host
+        :param port: adb server port
+        :param timeout: socket timeout in seconds
+        :param pool_size: maximum number of idle sync connections kept open
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.serial = serial
+        self.address = (host, port)
+        self.timeout = timeout
+        self.pool_size = pool_size
+
+        self._features = None
+        self._sync_pool = []
+        self._pool_lock = threading.Lock()
+
+    # -- host protocol --
+
+    def _connect(self):
+        deadline = current_deadline()
+        timeout = self.timeout if deadline is None else min(self.timeout, deadline.remaining())
+        try:
+            return socket.create_connection(self.address, timeout)
+        except socket.error as err:
+            raise XenDroidADBError(
+                'Unable to connect to the adb server at {}:{}: {}'.format(
+                    self.address[0], self.address[1], err))
+
+    @staticmethod
+    def _read_status(sock, request):
+        status = recv_exact(sock, 4)
+        if status == b'OKAY':
+            return
+        if status == b'FAIL':
+            length = int(recv_exact(sock, 4), 16)
+            msg = recv_exact(sock, length).decode('utf-8', 'replace')
+            raise XenDroidADBError('adb request `{}` failed\nERROR:{}'.format(request, msg))
+        raise XenDroidADBError('adb request `{}` got an invalid response: {!r}'.format(request, status))
+
+    def _request(self, sock, request):
+        """
+        send a length-prefixed request then wait for its status
+        :param sock:
+        :param request:
+        :return:
+        """
+        payload = to_bytes(request)
+        sock.sendall(b'%04x' % len(payload) + payload)
+        self._read_status(sock, request)
+
+    def host_query(self, request):
+        """
+        run a `host:` service that replies with a length-prefixed string
+        :param request: e.g. host:version
+        :return:
+        """
+        sock = self._connect()
+        try:
+            self._request(sock, request)
+            length = int(recv_exact(sock, 4), 16)
+            return recv_exact(sock, length)
+        finally:
+            sock.close()
+
+    def open_service(self, service):
+        """
+        switch a new connection to the device transport then open a service on it
+        :param service: e.g. `shell:ls`, `exec:cat file`, `sync:`
+        :return: the connected socket, which belongs to the caller
+        """
+        sock = self._connect()
+        try:
+            self._request(sock, 'host:transport:{}'.format(self.serial))
+            self._request(sock, service)
+        except (XenDroidADBError, socket.error):
+            sock.close()
+            raise
+        return sock
+
+    def run_service(self, service):
+        """
+        open a device service and read its output until EOF
+        :param service:
+        :return:
+        """
+        sock = self.open_service(service)
+        try:
+            return recv_all(sock)
+        finally:
+            sock.close()
+
+    def features(self):
+        """
+        get the feature list of the device
+        :return:
+        """
+        if self._features is None:
+            out = self.host_query('host-serial:{}:features'.format(self.serial))
+            self._features = set(out.decode('utf-8').split(','))
+        return self._features
+
+    # -- shell and exec --
+
+    def _shell_v2(self, cmd):
+        sock = self.open_service('shell,v2,raw:{}'.format(cmd))
+        out, err, code = [], [], None
+        try:
+            while True:
+                header = sock.recv(5)
+                if not header:
+                    break
+                if len(header) < 5:
+                    header += recv_exact(sock, 5 - len(header))
+
+                packet_id, length = struct.unpack('<BI', header)
+                data = recv_exact(sock, length)
+
+                if packet_id == SHELL_STDOUT:
+                    out.append(data)
+                elif packet_id == SHELL_STDERR:
+                    err.append(data)
+                elif packet_id == SHELL_EXIT:
+                    code = struct.unpack('<B', data)[0]
+                    break
+        finally:
+            sock.close()
+
+        if code is None:
+            raise XenDroidADBError('shell command `{}` ended without an exit status'.format(cmd))
+        return b''.join(out), b''.join(err), code
+
+    def _shell_legacy(self, cmd):
+        # the legacy service has no exit status, so append a marker carrying it
+        marker = '__XENDROID_EXIT_{}__'.format(get_rand_str(16))
+        out = self.run_service('shell:( {}\n); printf "{}%d" $?'.format(cmd, marker))
+
+        idx = out.rfind(to_bytes(marker))
+        code = re.match(br'\d+', out[idx + len(marker):]) if idx != -1 else None
+        if code is None:
+            raise XenDroidADBError('shell command `{}` ended without an exit status'.format(cmd))
+        return out[:idx], b'', int(code.group())
+
+    def shell(self, cmd):
+        """
+        run a shell command on the device
+        :param cmd: shell command line
+        :return: tuple of (stdout, stderr, exit code)
+        """
+        if 'shell_v2' in self.features():
+            return self._shell_v2(cmd)
+        return self._shell_legacy(cmd)
+
+    def exec_out(self, cmd, fh=None):
+        """
+        run a command through the raw `exec:` service,
+        the output is binary safe as no pty is involved
+        :param cmd:
+        :param fh: optional file object to stream the output into
+        :return: the output or None when streaming into `fh`
+        """
+        sock = self.open_service('exec:{}'.format(cmd))
+        try:
+            return recv_all(sock, fh)
+        finally:
+            sock.close()
+
+    # -- sync --
+
+    def _sync_acquire(self):
+        with self._pool_lock:
+            if self._sync_pool:
+                return self._sync_pool.pop()
+        return self.open_service('sync:')
+
+    def _sync_release(self, sock, broken=False):
+        if not broken:
+            with self._pool_lock:
+                if len(self._sync_pool) < self.pool_size:
+                    self._sync_pool.append(sock)
+                    return
+            try:
+                sock.sendall(b'QUIT' + struct.pack('<I', 0))
+            except socket.error:
+                pass
+        sock.close()
+
+    @staticmethod
+    def _sync_request(sock, cmd_id, path):
+        path = to_bytes(path)
+        sock.sendall(cmd_id + struct.pack('<I', len(path)) + path)
+
+    @staticmethod
+    def _sync_fail(sock, length, request):
+        msg = recv_exact(sock, length).decode('utf-8', 'replace')
+        raise XenDroidADBError('adb sync `{}` failed\nERROR:{}'.format(request, msg))
+
+    def _sync_call(self, func, *args):
+        """
+        run a sync operation on a pooled connection, the connection is
+        dropped instead of being returned to the pool if anything goes wrong
+        :return:
+        """
+        sock = self._sync_acquire()
+        try:
+            ret = func(sock, *args)
+        except Exception:
+            self._sync_release(sock, broken=True)
+            raise
+        self._sync_release(sock)
+        return ret
+
+    def _stat(self, sock, path):
+        self._sync_request(sock, b'STAT', path)
+        resp = recv_exact(sock, 16)
+        if resp[:4] != b'STAT':
+            raise XenDroidADBError('adb sync `STAT {}` got an invalid response'.format(path))
+        return struct.unpack('<III', resp[4:])
+
+    def stat(self, path):
+        """
+        stat a file on the device
+        :param path:
+        :return: tuple of (mode, size, mtime), all zeros if the path doesn't exist
+        """
+        return self._sync_call(self._stat, path)
+
+    def _send(self, sock, fh, remote_path, mode, mtime):
+        request = 'SEND {}'.format(remote_path)
+        self._sync_request(sock, b'SEND', '{},{}'.format(remote_path, mode))
+
+        while True:
+            chunk = fh.read(SYNC_DATA_MAX)
+            if not chunk:
+                break
+            sock.sendall(b'DATA' + struct.pack('<I', len(chunk)) + chunk)
+        sock.sendall(b'DONE' + struct.pack('<I', mtime))
+
+        resp = recv_exact(sock, 8)
+        cmd_id, length = resp[:4], struct.unpack('<I', resp[4:])[0]
+        if cmd_id == b'FAIL':
+            self._sync_fail(sock, length, request)
+        if cmd_id != b'OKAY':
+            raise XenDroidADBError('adb sync `{}` got an invalid response'.format(request))
+
+    def push(self, local, remote_path, mode=None, mtime=None):
+        """
+        push a file to the device, streaming it in sync DATA packets
+        :param local: a path or a readable binary file object
+        :param remote_path: target path on the device
+        :param mode: permission bits, taken from the local file by default
+        :param mtime: modification time, the current time by default
+        :return:
+        """
+        if mtime is None:
+            mtime = int(time.time())
+
+        if hasattr(local, 'read'):
+            return self._sync_call(self._send, local, remote_path, mode or 0o644, mtime)
+
+        if mode is None:
+            mode = stat.S_IMODE(os.stat(local).st_mode)
+        with open(local, 'rb') as fh:
+            return self._sync_call(self._send, fh, remote_path, mode, mtime)
+
+    def _recv(self, sock, remote_path, fh):
+        request = 'RECV {}'.format(remote_path)
+        self._sync_request(sock, b'RECV', remote_path)
+
+        while True:
+            resp = recv_exact(sock, 8)
+            cmd_id, length = resp[:4], struct.unpack('<I', resp[4:])[0]
+            if cmd_id == b'DATA':
+                while length:
+                    chunk = sock.recv(min(length, SYNC_DATA_MAX))
+                    if not chunk:
+                        raise XenDroidADBError('adb server closed the connection unexpectedly')
+                    fh.write(chunk)
+                    length -= len(chunk)
+            elif cmd_id == b'DONE':
+                return
+            elif cmd_id == b'FAIL':
+                self._sync_fail(sock, length, request)
+            else:
+                raise XenDroidADBError('adb sync `{}` got an invalid response'.format(request))
+
+    def pull(self, remote_path, local):
+        """
+        pull a file from the device, streaming it straight into the target
+        :param remote_path: source path on the device
+        :param local: a path or a writable binary file object
+        :return:
+        """
+        if hasattr(local, 'write'):
+            return self._sync_call(self._recv, remote_path, local)
+
+        with open(local, 'wb') as fh:
+            return self._sync_call(self._recv, remote_path, fh)
+
+    def close(self):
+        """
+        close all the pooled sync connections
+        :return:
+        """
+        with self._pool_lock:
+            pool, self._sync_pool = self._sync_pool, []
+
+        for sock in pool:
+            self._sync_release(sock, broken=True)
@@ -0,0 +1,204 @@
+# Copyright (C) 2018  Muhammed Ziad
+# This file is part of XenDroid - https://github.com/muhzii/XenDroid
+#
+# An instrumented sandbox for Android
+# This program is a free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License
+
+
+import re
+import time
+import logging
+
+from xml.etree.ElementTree import XMLParser, ParseError
+
+from lib.definitions.exceptions import XenDroidADBError
+
+_BOUNDS = re.compile(r'\[(-?\d+),(-?\d+)\]\[(-?\d+),(-?\d+)\]')
+
+
+class UINode(object):
+
+    def __init__(self, attrs):
+        self.text = attrs.get('text', '')
+        self.resource_id = attrs.get('resource-id', '')
+        self.content_desc = attrs.get('content-desc', '')
+        self.cls = attrs.get('class', '')
+        self.clickable = attrs.get('clickable') == 'true'
+
+        match = _BOUNDS.match(attrs.get('bounds', ''))
+        self.bounds = tuple(int(x) for x in match.groups()) if match else None
+
+    @property
+    def center(self):
+        if self.bounds is None:
+            return None
+        x1, y1, x2, y2 = self.bounds
+        return (x1 + x2) // 2, (y1 + y2) // 2
+
+
+class UIHierarchy(object):
+    """
+    Index of the nodes of a `uiautomator dump`, built while the
+    dump is being parsed, keyed by lowercased text/content-desc and by resource-id
+    """
+
+    def __init__(self):
+        self.nodes = []
+        self.by_text = {}
+        self.by_resource_id = {}
+        self.complete = False
+
+        self._depth = 0
+
+    # XMLParser target interface
+
+    def start(self, tag, attrs):
+        self._depth += 1
+        if tag != 'node':
+            return
+
+        node = UINode(attrs)
+        self.nodes.append(node)
+        for label in (node.text, node.content_desc):
+            if label:
+                self.by_text.setdefault(label.lower(), []).append(node)
+        if node.resource_id:
+            self.by_resource_id.setdefault(node.resource_id, []).append(node)
+
+    def end(self, tag):
+        self._depth -= 1
+        if self._depth == 0:
+            self.complete = True
+
+    def data(self, data):
+        pass
+
+    def close(self):
+        return self
+
+    def find(self, name):
+        """
+        find a view by resource-id or by its text, exact (case insensitive)
+        matches are preferred over partial ones
+        :param name:
+        :return: the `UINode` or None
+        """
+        nodes = self.by_resource_id.get(name) or self.by_text.get(name.lower())
+        if nodes:
+            return nodes[0]
+
+        name = name.lower()
+        for label, nodes in self.by_text.items():
+            if name in label:
+                return nodes[0]
+        return None
+
+
+class UIWaiter(object):
+    """
+    Waits for views to show up on the screen, dumps are fetched in a single
+    `exec-out` round trip and parsed incrementally, the parsed hierarchy is reused
+    as long as the focused window doesn't change
+    """
+
+    dump_path = '/sdcard/window_dump.xml'
+
+    def __init__(self, adb_connection, max_age=5.0):
+        """
+        :param adb_connection: ADB connection to the device
+        :param max_age: seconds after which a cached hierarchy is dumped again
+        even if the focused window is the same
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.adb_connection = adb_connection
+        self.max_age = max_age
+
+        self._cached = None
+        self._cached_focus = None
+        self._cached_at = 0
+
+    def _get_focus(self):
+        out = self.adb_connection.exec_out('dumpsys window windows | grep -E "mCurrentFocus|mFocusedApp"')
+        return out.strip()
+
+    def dump(self):
+        """
+        dump and parse the current UI hierarchy
+        :return: a `UIHierarchy`
+        """
+        hierarchy = UIHierarchy()
+        parser = XMLParser(target=hierarchy)
+        end_tag = b'</hierarchy>'
+
+        cmd = 'uiautomator dump {0} >/dev/null && cat {0}'.format(self.dump_path)
+        stream = self.adb_connection.exec_out_stream(cmd)
+        try:
+            tail = b''
+            for chunk in stream:
+                # anything after the root element would upset the parser
+                idx = (tail + chunk).find(end_tag)
+                if idx != -1:
+                    parser.feed(chunk[:idx - len(tail) + len(end_tag)])
+                    break
+                parser.feed(chunk)
+                tail = (tail + chunk)[-len(end_tag):]
+            parser.close()
+        except ParseError as err:
+            raise XenDroidADBError('Unable to parse the UI hierarchy dump: {}'.format(err))
+        finally:
+            stream.close()
+
+        return hierarchy
+
+    def hierarchy(self):
+        """
+        get the current UI hierarchy, from the cache if the screen didn't change
+        :return: a `UIHierarchy`
+        """
+        focus = self._get_focus()
+        fresh = time.time() - self._cached_at < self.max_age
+
+        if self._cached is None or focus != self._cached_focus or not fresh:
+            self._cached = self.dump()
+            self._cached_focus = focus
+            self._cached_at = time.time()
+        return self._cached
+
+    def invalidate(self):
+        """
+        drop the cached hierarchy, e.g. after interacting with the screen
+        :return:
+        """
+        self._cached = None
+
+    def wait_for(self, names, timeout, initial_delay=0.25, max_delay=2.0, alive=None):
+        """
+        wait until one of the views shows up, polling with an exponential backoff
+        :param names: a view name or a list of them, see `UIHierarchy.find`
+        :param timeout: seconds to wait
+        :param initial_delay: first polling interval
+        :param max_delay: upper bound of the polling interval
+        :param alive: optional callable, the wait is abandoned once it returns False
+        :return: tuple of (name, `UINode`) or None if the deadline or `alive` hit first
+        """
+        if not isinstance(names, (list, tuple)):
+            names = [names]
+
+        deadline = time.time() + timeout
+        delay = initial_delay
+
+        while alive is None or alive():
+            hierarchy = self.hierarchy()
+            for name in names:
+                node = hierarchy.find(name)
+                if node is not None and node.center is not None:
+                    return name, node
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, max_delay)
+
+        return None
@@ -0,0 +1,380 @@
+# Copyright (C) 2018  Muhammed Ziad
+# This file is part of XenDroid - https://github.com/muhzii/XenDroid
+#
+# An instrumented sandbox for Android
+# This program is a free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License
+
+
+import os
+import ssl
+import json
+import time
+import socket
+import struct
+import fnmatch
+import logging
+import threading
+import subprocess
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UDPServer, BaseRequestHandler
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UDPServer, BaseRequestHandler
+
+from lib.api.event_writer import EventWriter, POLICY_BLOCK
+from modules.analysing.traffic import parse_tls_sni
+from lib.definitions.constants import FAKE_INTERNET_DIR, FAKE_INTERNET_RESPONSES
+from lib.definitions.exceptions import XenDroidADBError, XenDroidStartupError
+
+logger = logging.getLogger('FakeInternet')
+
+# how the device's traffic reaches the host
+MODE_IPTABLES = 'iptables'
+MODE_REVERSE = 'reverse'
+
+DNS_TYPE_A = 1
+
+# bytes of a request body kept in the logs
+BODY_PREFIX_SIZE = 256
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+
+def _read_dns_question(data):
+    """
+    :param data: a DNS query
+    :return: tuple of (name, type, offset following the question)
+    """
+    labels = []
+    pos = 12
+    while True:
+        length = struct.unpack_from('!B', data, pos)[0]
+        pos += 1
+        if length == 0:
+            break
+        if length & 0xc0:
+            raise ValueError('Compressed name in a DNS question')
+        labels.append(data[pos:pos + length])
+        pos += length
+    qtype = struct.unpack_from('!H', data, pos)[0]
+    return b'.'.join(labels).decode('utf-8', 'replace'), qtype, pos + 4
+
+
+def build_dns_response(query, answer_ip, ttl=60):
+    """
+    answer a query for an A record with `answer_ip`, any other query gets an empty answer
+    :param query: the DNS query
+    :param answer_ip: IPv4 address every name resolves to
+    :param ttl:
+    :return: tuple of (response, queried name, queried type)
+    """
+    txid, flags, qdcount = struct.unpack_from('!HHH', query)
+    name, qtype, end = _read_dns_question(query)
+
+    answer = b''
+    if qtype == DNS_TYPE_A:
+        answer = b'\xc0\x0c' + struct.pack('!HHIH', DNS_TYPE_A, 1, ttl, 4) + socket.inet_aton(answer_ip)
+
+    # a response with recursion available, keeping the opcode and the recursion desired bit
+    flags = 0x8080 | (flags & 0x7900)
+    header = struct.pack('!HHHHHH', txid, flags, 1, 1 if answer else 0, 0, 0)
+    return header + query[12:end] + answer, name, qtype
+
+
+class _DNSHandler(BaseRequestHandler):
+
+    def handle(self):
+        query, sock = self.request
+        try:
+            response, name, qtype = build_dns_response(query, self.server.fake_internet.answer_ip)
+        except (ValueError, struct.error):
+            return
+
+        sock.sendto(response, self.client_address)
+        self.server.fake_internet.log({'type': 'dns', 'client': self.client_address[0], 'name': name,
+                                       'qtype': qtype})
+
+
+class _DNSServer(ThreadingMixIn, UDPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _HTTPHandler(BaseHTTPRequestHandler):
+
+    server_version = 'nginx'
+    sys_version = ''
+    protocol_version = 'HTTP/1.1'
+
+    # seconds a client may stay silent
+    timeout = 30
+
+    def setup(self):
+        server = self.server
+        self.sni = None
+        if server.tls:
+            self.request.settimeout(self.timeout)
+            try:
+                hello = self.request.recv(4096, socket.MSG_PEEK)
+                self.sni = parse_tls_sni(hello, 0, len(hello))
+            except (socket.error, struct.error, ValueError):
+                pass
+
+            handshake = server.ssl_context is not None
+            if handshake:
+                try:
+                    self.request = server.ssl_context.wrap_socket(self.request, server_side=True)
+                except (ssl.SSLError, socket.error):
+                    handshake = False
+
+            server.fake_internet.log({'type': 'tls', 'client': self.client_address[0], 'sni': self.sni,
+                                      'handshake': handshake})
+            if not handshake:
+                # nothing more to learn from a client that rejected the certificate
+                raise socket.error('TLS handshake failed')
+
+        BaseHTTPRequestHandler.setup(self)
+
+    def _respond(self):
+        length = min(int(self.headers.get('Content-Length') or 0), MAX_BODY_SIZE)
+        body = self.rfile.read(length) if length else b''
+        host = self.headers.get('Host') or self.sni or ''
+
+        status, content_type, payload = self.server.fake_internet.find_response(host.split(':')[0], self.path)
+        self.server.fake_internet.log({
+            'type': 'https' if self.server.tls else 'http', 'client': self.client_address[0],
+            'method': self.command, 'host': host, 'path': self.path,
+            'user_agent': self.headers.get('User-Agent'), 'body_len': len(body),
+            'body_prefix': body[:BODY_PREFIX_SIZE].decode('utf-8', 'replace'), 'status': status})
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_HEAD = do_DELETE = do_OPTIONS = do_PATCH = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        logger.debug('Request from {} to the fake internet failed'.format(client_address[0]))
+
+
+def load_responses(path=FAKE_INTERNET_RESPONSES):
+    """
+    load the canned responses, every rule has optional `host` and `path` glob patterns,
+    a `status`, a `content_type` and a `body` or the path of a `file` relative to the rules
+    :param path:
+    :return: list of (host pattern, path pattern, status, content type, payload)
+    """
+    with open(path, 'r') as fh:
+        rules = json.load(fh)
+
+    responses = []
+    for rule in rules:
+        if 'file' in rule:
+            with open(os.path.join(os.path.dirname(path), rule['file']), 'rb') as fh:
+                payload = fh.read()
+        else:
+            payload = rule.get('body', '').encode('utf-8')
+        responses.append((rule.get('host', '*'), rule.get('path', '*'), rule.get('status', 200),
+                          rule.get('content_type', 'text/html'), payload))
+    return responses
+
+
+def ensure_certificate(cert_dir=FAKE_INTERNET_DIR):
+    """
+    generate the self-signed certificate of the HTTPS responder once
+    :param cert_dir:
+    :return: tuple of (certificate path, key path) or None if openssl isn't available
+    """
+    cert_path, key_path = os.path.join(cert_dir, 'cert.pem'), os.path.join(cert_dir, 'key.pem')
+    if os.path.exists(cert_path) and os.path.exists(key_path):
+        return cert_path, key_path
+
+    if not os.path.isdir(cert_dir):
+        os.makedirs(cert_dir)
+    try:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '3650',
+                               '-subj', '/CN=localhost', '-keyout', key_path, '-out', cert_path],
+                              stdout=open(os.devnull, 'wb'), stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError) as err:
+        logger.warning('Unable to generate a certificate for the HTTPS responder: {}'.format(err))
+        return None
+    return cert_path, key_path
+
+
+class FakeInternet(object):
+    """
+    Host side DNS sinkhole and HTTP/HTTPS responders standing in for the internet.
+    Every name resolves to `answer_ip` and the device's HTTP/HTTPS traffic, as well
+    as any TCP connection to `answer_ip`, is redirected to the responders with iptables,
+    either straight to the host or through `adb reverse`.
+    Queries and requests are logged to <log_base>.<n>.ndjson
+    """
+
+    chain = 'xendroid_fakenet'
+
+    def __init__(self, log_base, mode=MODE_IPTABLES, host_ip='10.0.2.2', answer_ip='198.18.0.1',
+                 bind_address='0.0.0.0', responses_path=FAKE_INTERNET_RESPONSES):
+        """
+        :param log_base: base path of the logs, see `EventWriter`
+        :param mode: MODE_IPTABLES when the device reaches the host at `host_ip`, e.g. 10.0.2.2 from
+        an emulator, MODE_REVERSE otherwise, DNS is UDP which `adb reverse` can't carry so names
+        aren't resolved in that mode
+        :param host_ip: address of the host as seen by the device in MODE_IPTABLES
+        :param answer_ip: address every name resolves to
+        :param bind_address: address the responders listen on
+        :param responses_path: canned responses, see `load_responses`
+        """
+        if mode not in (MODE_IPTABLES, MODE_REVERSE):
+            raise ValueError('Unknown fake internet mode `{}`'.format(mode))
+
+        self.log_base = log_base
+        self.mode = mode
+        self.host_ip = host_ip
+        self.answer_ip = answer_ip
+        self.bind_address = bind_address
+        self.responses = load_responses(responses_path)
+
+        self.servers = {}
+        self.adb_connection = None
+        self.logs_dumper = None
+
+    def log(self, record):
+        record['ts'] = time.time()
+        self.logs_dumper.write(record)
+
+    def find_response(self, host, path):
+        """
+        :return: tuple of (status, content type, payload) of the first matching rule
+        """
+        for host_pattern, path_pattern, status, content_type, payload in self.responses:
+            if fnmatch.fnmatch(host, host_pattern) and fnmatch.fnmatch(path, path_pattern):
+                return status, content_type, payload
+        return 404, 'text/html', b''
+
+    def _serve(self, name, server):
+        server.fake_internet = self
+        thread = threading.Thread(target=server.serve_forever, name='fake-internet-' + name)
+        thread.daemon = True
+        thread.start()
+        self.servers[name] = server
+        return server.server_address[1]
+
+    def _start_servers(self):
+        if self.mode == MODE_IPTABLES:
+            self._serve('dns', _DNSServer((self.bind_address, 0), _DNSHandler))
+
+        for name, tls in (('http', False), ('https', True)):
+            server = _HTTPServer((self.bind_address, 0), _HTTPHandler)
+            server.tls = tls
+            server.ssl_context = None
+            if tls:
+                cert = ensure_certificate()
+                if cert is not None:
+                    server.ssl_context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+                    server.ssl_context.load_cert_chain(*cert)
+            self._serve(name, server)
+
+    def port(self, name):
+        return self.servers[name].server_address[1]
+
+    def _iptables(self, cmds):
+        self.adb_connection.shell(' && '.join('iptables -w -t nat {}'.format(cmd) for cmd in cmds))
+
+    def _remove_rules(self):
+        cmds = ['iptables -w -t nat -D OUTPUT -j {}'.format(self.chain),
+                'iptables -w -t nat -F {}'.format(self.chain), 'iptables -w -t nat -X {}'.format(self.chain)]
+        try:
+            self.adb_connection.shell('; '.join(cmds) + '; true')
+        except XenDroidADBError as err:
+            logger.warning('Unable to remove the fake internet rules: {}'.format(err))
+
+    def _redirect(self):
+        """
+        redirect the device's DNS, HTTP and HTTPS traffic to the responders
+        :return:
+        """
+        if self.mode == MODE_REVERSE:
+            for name in ('http', 'https'):
+                self.adb_connection.reverse(self.port(name), self.port(name))
+
+        def dnat(port):
+            if self.mode == MODE_REVERSE:
+                # to the adb reverse listeners on the device's loopback, unlike a DNAT to 127.0.0.1
+                # this doesn't get the packets dropped as martians without route_localnet
+                return '-j REDIRECT --to-ports {}'.format(port)
+            return '-j DNAT --to-destination {}:{}'.format(self.host_ip, port)
+
+        cmds = ['-N {}'.format(self.chain)]
+        if self.mode == MODE_IPTABLES:
+            cmds += ['-A {} -d {} -j RETURN'.format(self.chain, self.host_ip),
+                     '-A {} -p udp --dport 53 {}'.format(self.chain, dnat(self.port('dns')))]
+        cmds += ['-A {} -p tcp --dport 443 {}'.format(self.chain, dnat(self.port('https'))),
+                 '-A {} -p tcp --dport 80 {}'.format(self.chain, dnat(self.port('http'))),
+                 '-A {} -d {} -p tcp {}'.format(self.chain, self.answer_ip, dnat(self.port('http'))),
+                 '-I OUTPUT -j {}'.format(self.chain)]
+
+        # leftovers of a task that didn't stop cleanly
+        self._remove_rules()
+        self._iptables(cmds)
+
+    def start(self, adb_connection):
+        """
+        start the responders and redirect the device's traffic to them
+        :param adb_connection: ADB connection to the device, rooted
+        :return:
+        """
+        self.adb_connection = adb_connection
+        self.logs_dumper = EventWriter(self.log_base, policy=POLICY_BLOCK,
+                                       header={'type': 'xendroid-fake-internet', 'mode': self.mode,
+                                               'answer_ip': self.answer_ip})
+        self._start_servers()
+
+        try:
+            self._redirect()
+        except XenDroidADBError as err:
+            self.stop()
+            raise XenDroidStartupError('Unable to redirect the traffic to the fake internet: {}'.format(err))
+
+        if self.mode == MODE_REVERSE:
+            logger.warning('DNS is not available through adb reverse, only connections to IP addresses '
+                           'and to {} reach the fake internet'.format(self.answer_ip))
+        logger.info('Fake internet started, {}'.format(', '.join(
+            '{} on port {}'.format(name, self.port(name)) for name in sorted(self.servers))))
+
+    def stop(self):
+        """
+        remove the redirection and stop the responders
+        :return:
+        """
+        if self.adb_connection is not None:
+            self._remove_rules()
+            if self.mode == MODE_REVERSE:
+                for name in ('http', 'https'):
+                    if name in self.servers:
+                        try:
+                            self.adb_connection.remove_reverse(self.port(name))
+                        except XenDroidADBError:
+                            pass
+            self.adb_connection = None
+
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+        self.servers = {}
+
+        if self.logs_dumper is not None:
+            self.logs_dumper.close()
+            self.logs_dumper = None
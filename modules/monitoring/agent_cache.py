@@ -0,0 +1,113 @@
+# Copyright (C) 2018  Muhammed Ziad
+# This file is part of XenDroid - https://github.com/muhzii/XenDroid
+#
+# An instrumented sandbox for Android
+# This program is a free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License
+
+
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+
+from lib.definitions.constants import AGENT_CACHE_DIR
+
+
+class AgentCache(object):
+    """
+    On-disk cache of the generated frida agent and of its compiled bytecode,
+    entries are keyed by the hash of everything the agent is generated from
+    so a stale entry is never picked up, it's just not looked up anymore
+    """
+
+    _lock = threading.Lock()
+
+    # process wide counters, see `report`
+    hits = {'source': 0, 'bytecode': 0}
+    misses = {'source': 0, 'bytecode': 0}
+
+    def __init__(self, root=AGENT_CACHE_DIR):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.root = root
+
+    @staticmethod
+    def make_key(input_files, version):
+        """
+        :param input_files: paths of the files the agent is generated from
+        :param version: anything else that affects the generated agent
+        :return: hex digest identifying the agent
+        """
+        sha256 = hashlib.sha256(str(version).encode('utf-8'))
+        for path in input_files:
+            with open(path, 'rb') as fh:
+                content = fh.read()
+            sha256.update(str(len(content)).encode('utf-8') + b':' + content)
+        return sha256.hexdigest()
+
+    def _read(self, name):
+        path = os.path.join(self.root, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as fh:
+            return fh.read()
+
+    def _write(self, name, data):
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.root)
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(data)
+            os.rename(tmp_path, os.path.join(self.root, name))
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def get_source(self, key, generate):
+        """
+        get the agent's source, generating it on a miss
+        :param key: see `make_key`
+        :param generate: callable returning the source
+        :return: the source
+        """
+        name = key + '.js'
+        with self._lock:
+            data = self._read(name)
+            if data is not None:
+                self.hits['source'] += 1
+                return data.decode('utf-8')
+
+            self.misses['source'] += 1
+            source = generate()
+            self._write(name, source.encode('utf-8'))
+            return source
+
+    def get_bytecode(self, key, runtime_tag, compile_func):
+        """
+        get the compiled agent, compiling it on a miss
+        :param key: see `make_key`
+        :param runtime_tag: identifies the compiler, e.g. frida's version
+        :param compile_func: callable returning the bytecode, or None when compiling isn't supported,
+        nothing is cached when it raises, e.g. on a detached session
+        :return: the bytecode or None
+        """
+        name = '{}.{}.bytecode'.format(key, runtime_tag)
+        with self._lock:
+            data = self._read(name)
+            if data is not None:
+                self.hits['bytecode'] += 1
+                # an empty entry records that compiling isn't supported
+                return data or None
+
+            self.misses['bytecode'] += 1
+            bytecode = compile_func()
+            self._write(name, bytecode or b'')
+            return bytecode
+
+    @classmethod
+    def report(cls):
+        return 'agent source {} hits/{} misses, bytecode {} hits/{} misses'.format(
+            cls.hits['source'], cls.misses['source'], cls.hits['bytecode'], cls.misses['bytecode'])
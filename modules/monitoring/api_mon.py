@@ -10,7 +10,12 @@ import os
 import re
 import json
 import logging
+import threading
 
+from lib.api.event_writer import EventWriter, read_records
+from modules.snapshot import ContentStore
+from modules.static_analysis import filter_hooks
+from modules.monitoring.agent_cache import AgentCache
 from lib.definitions.constants import ROOT_DIR
 from lib.definitions.classes import MonitoringModule
 
@@ -25,6 +30,10 @@ class ScriptFactory(object):
     for Android Java API instrumentation
     """
     values_module = __import__('lib.definitions.values', fromlist=['*'])
+    values_file = os.path.join(ROOT_DIR, 'lib', 'definitions', 'values.py')
+
+    # bump whenever the generated code changes, cached agents are keyed by it
+    generator_version = 5
 
     def __init__(self, hook_def):
 
@@ -55,7 +64,7 @@ class ScriptFactory(object):
                             "Method" : "%s"
                         };
                         %s
-                        send(JSON.stringify(hookData));
+                        xendroidEmit(hookData);
                         var ret_val;
                         %s
                         return ret_val;
@@ -197,19 +206,138 @@ class ScriptFactory(object):
         else:
             return self.__get_hook_code()
 
-    @staticmethod
-    def wrap_hook_code(hook_code):
+    # events are buffered in the agent and sent in batches
+    batch_size = 256
+    flush_interval = 250
+    buffer_capacity = 4096
+
+    agent_runtime = \
+        """
+        // Hook events go to a ring buffer which is flushed as one
+        // newline-delimited JSON `data` payload per batch
+        const XENDROID_BATCH_SIZE = %d;
+        const XENDROID_FLUSH_INTERVAL = %d;
+        const XENDROID_BUFFER_CAPACITY = %d;
+
+        var xendroidBuffer = new Array(XENDROID_BUFFER_CAPACITY);
+        var xendroidHead = 0, xendroidCount = 0, xendroidDropped = 0;
+        var xendroidFlushPending = false;
+        // captured buffers waiting for the next flush, as [header, ArrayBuffer]
+        var xendroidBlobs = [], xendroidBlobBytes = 0;
+
+        // never send from inside a hook, the flush runs once the hooked threads
+        // let go of the script
+        function xendroidScheduleFlush() {
+            if (!xendroidFlushPending) {
+                xendroidFlushPending = true;
+                setTimeout(xendroidFlush, 0);
+            }
+        }
+
+        function xendroidQueueBlob(header, buffer) {
+            xendroidBlobs.push([header, buffer]);
+            xendroidBlobBytes += buffer.byteLength;
+            xendroidScheduleFlush();
+        }
+
+        function xendroidFlush() {
+            xendroidFlushPending = false;
+
+            var blobs = xendroidBlobs;
+            xendroidBlobs = [];
+            xendroidBlobBytes = 0;
+            for (var b = 0; b < blobs.length; b++)
+                send(blobs[b][0], blobs[b][1]);
+
+            if (xendroidCount === 0)
+                return;
+
+            var lines = [];
+            for (var i = 0; i < xendroidCount; i++) {
+                var idx = (xendroidHead + i) %% XENDROID_BUFFER_CAPACITY;
+                lines.push(xendroidBuffer[idx]);
+                xendroidBuffer[idx] = undefined;
+            }
+            var count = xendroidCount;
+            xendroidHead = (xendroidHead + xendroidCount) %% XENDROID_BUFFER_CAPACITY;
+            xendroidCount = 0;
+
+            var raw = unescape(encodeURIComponent(lines.join("\\n")));
+            var data = new Uint8Array(raw.length);
+            for (var j = 0; j < raw.length; j++)
+                data[j] = raw.charCodeAt(j);
+
+            send({"type": "xendroid-batch", "count": count, "dropped": xendroidDropped}, data.buffer);
+        }
+
+        function xendroidEmit(hookData) {
+            if (hookData["t"] === undefined)
+                hookData["t"] = Date.now();
+
+            var idx = (xendroidHead + xendroidCount) %% XENDROID_BUFFER_CAPACITY;
+            if (xendroidCount === XENDROID_BUFFER_CAPACITY) {
+                // full, overwrite the oldest event
+                xendroidHead = (xendroidHead + 1) %% XENDROID_BUFFER_CAPACITY;
+                xendroidDropped++;
+            } else {
+                xendroidCount++;
+            }
+            xendroidBuffer[idx] = JSON.stringify(hookData);
+
+            // until the flush runs a burst keeps filling the ring
+            if (xendroidCount >= XENDROID_BATCH_SIZE)
+                xendroidScheduleFlush();
+        }
+
+        // called before the periodic and the final flushes to release
+        // what the hooks held back, e.g. by their policies
+        var xendroidReleasers = [];
+
+        function xendroidTick() {
+            for (var i = 0; i < xendroidReleasers.length; i++)
+                xendroidReleasers[i]();
+            xendroidFlush();
+        }
+
+        setInterval(xendroidTick, XENDROID_FLUSH_INTERVAL);
+
+        // called by frida when the script gets unloaded
+        rpc.exports.dispose = xendroidTick;
+        """
+
+    @classmethod
+    def wrap_hook_code(cls, hook_code):
+        runtime = cls.agent_runtime % (cls.batch_size, cls.flush_interval, cls.buffer_capacity)
         return \
             """
             // This script is generated from XenDroid `https://www.github.com/muhzii/XenDroid`
-
+            %s
             // Attach to the vm
             Java.perform(function() {
                 const Arrays = Java.use("java.util.Arrays");
                 const String = Java.use("java.lang.String");
                 %s
             });
-            """ % hook_code
+            """ % (runtime, hook_code)
+
+    @classmethod
+    def build_agent(cls, hooks_def):
+        """
+        generate the whole agent
+        :param hooks_def: list of hook definitions
+        :return: the agent's source
+        """
+        hook_code = str()
+        for hook in hooks_def:
+            hook_code += cls(hook).get_script(wrap=False)
+        return cls.wrap_hook_code(hook_code)
+
+    @classmethod
+    def cache_version(cls):
+        """
+        :return: everything besides the input files that the generated agent depends on
+        """
+        return 'v{}:{}:{}:{}'.format(cls.generator_version, cls.batch_size, cls.flush_interval, cls.buffer_capacity)
 
     def get_script(self, wrap=True):
         gen_name = "_get_hook_code_for_{}".format(re.sub('[.$]', '_', self.cls_name))
@@ -226,57 +354,905 @@ class ScriptFactory(object):
             return script
 
 
-class APIMonitor(MonitoringModule):
+class TableAgentFactory(object):
+    """
+    Generates an agent made of a single generic hook routine driven by a
+    table of the hooks, every class is resolved once and all of its hooked
+    overloads are installed from the same wrapper.
+    Hooks that need more than capturing their parameters refer to a handler
+    of the agent's registry by name
+    """
+    values_module = ScriptFactory.values_module
+    values_file = ScriptFactory.values_file
+
+    # bump whenever the generated code changes, cached agents are keyed by it
+    generator_version = 9
+
+    # hooks of classes that aren't loaded yet are installed once they are
+    lazy = True
+    # ms before the first check for deferred classes the runtime loaded on its own,
+    # doubled after every check, there are at most `sweep_passes` of them
+    sweep_interval = 2000
+    sweep_passes = 6
+
+    policy_keys = ('sample', 'max_rate', 'collapse')
+
+    # captured values longer than this are replaced by their length and a prefix
+    inline_limit = 1024
+    prefix_size = 64
+    # largest buffer sent to the host's blob store
+    blob_limit = 16 * 1024 * 1024
+    # bytes of captured buffers held by the agent until the next flush
+    blob_queue_limit = 64 * 1024 * 1024
+
+    agent_code = \
+        """
+        const XENDROID_HOOKS = %s;
+        const XENDROID_LAZY = %s;
+        const XENDROID_SWEEP_INTERVAL = %d;
+        const XENDROID_SWEEP_PASSES = %d;
+        const XENDROID_INLINE_LIMIT = %d;
+        const XENDROID_PREFIX_SIZE = %d;
+        const XENDROID_BLOB_LIMIT = %d;
+        const XENDROID_BLOB_QUEUE_LIMIT = %d;
+
+        // per hook [calls, ms in the hook, ms in the original method], see `rpc.exports.profile`
+        var profileStats = {};
+        var profiling = false;
+        // hooks take well under a ms, Date.now is only the last resort
+        var profileClock = "Date.now";
+        const profileNow = (function() {
+            if (typeof performance !== "undefined" && performance.now) {
+                profileClock = "performance.now";
+                return function() { return performance.now(); };
+            }
+            try {
+                // exclusive so that the JS lock, and with it the shared timespec, is kept during the call
+                const clockGettime = new NativeFunction(Module.findExportByName(null, "clock_gettime"),
+                    "int", ["int", "pointer"], {"scheduling": "exclusive"});
+                const timespec = Memory.alloc(2 * Process.pointerSize);
+                const nsecPtr = timespec.add(Process.pointerSize);
+                const toNumber = function(v) { return typeof v === "number" ? v : v.toNumber(); };
+                profileClock = "clock_gettime";
+                return function() {
+                    clockGettime(1, timespec);  // CLOCK_MONOTONIC
+                    return toNumber(timespec.readLong()) * 1000 + toNumber(nsecPtr.readLong()) / 1e6;
+                };
+            } catch (e) {
+                return Date.now;
+            }
+        })();
+
+        rpc.exports.setProfiling = function(enabled) {
+            profiling = enabled;
+            profileStats = {};
+            return profileClock;
+        };
+
+        rpc.exports.profile = function() {
+            return profileStats;
+        };
+
+        var blobCapture = false;
+        // ids of the threads capturing the values of a hook
+        const capturingThreads = {};
+
+        rpc.exports.setBlobCapture = function(enabled) {
+            blobCapture = enabled;
+        };
+
+        Java.perform(function() {
+            const Arrays = Java.use("java.util.Arrays");
+            const String = Java.use("java.lang.String");
+
+            // how a captured parameter is turned into a loggable value
+            const formatters = {
+                "raw": function(v) { return v; },
+                "array": function(v) { return v === null ? null : capString(Arrays.deepToString(v)); },
+                "bytes": captureBytes,
+                "file": function(v) { return v === null ? null : v.getAbsolutePath(); },
+                "string": function(v) { return v === null ? null : capString(v.toString()); }
+            };
+
+            const MessageDigest = Java.use("java.security.MessageDigest");
+            const stringFromBytes = String.$new.overload("[B", "int", "int");
+            // digests of the blobs already sent
+            var sentBlobs = {}, sentBlobsCount = 0;
+
+            // long values are replaced by their length and a prefix
+            function capString(s) {
+                if (s.length <= XENDROID_INLINE_LIMIT)
+                    return s;
+                return {"len": s.length, "prefix": s.substring(0, XENDROID_PREFIX_SIZE)};
+            }
+
+            // large buffers are replaced by their length, sha1 and a prefix, their
+            // content is sent once per digest in a `xendroid-blob` message if enabled,
+            // buffers that don't fit in what's left of the blob queue only keep their digest
+            function captureBytes(v) {
+                if (v === null)
+                    return null;
+
+                const length = v.length;
+                if (length <= XENDROID_INLINE_LIMIT)
+                    return String.$new(v).toString();
+
+                const digest = MessageDigest.getInstance("SHA-1").digest(v);
+                var sha1 = "";
+                for (var i = 0; i < digest.length; i++)
+                    sha1 += ((digest[i] & 0xff) + 0x100).toString(16).substring(1);
+
+                if (blobCapture && length <= XENDROID_BLOB_LIMIT && !sentBlobs.hasOwnProperty(sha1) &&
+                        xendroidBlobBytes + length <= XENDROID_BLOB_QUEUE_LIMIT)
+                    queueBlob(sha1, v);
+                return {"len": length, "sha1": sha1,
+                        "prefix": stringFromBytes.call(String, v, 0, XENDROID_PREFIX_SIZE).toString()};
+            }
+
+            function queueBlob(sha1, v) {
+                // copied natively through JNI, the next flush sends it as binary data
+                const env = Java.vm.getEnv();
+                const elements = env.getByteArrayElements(v.$h);
+                var buffer;
+                try {
+                    buffer = elements.readByteArray(v.length);
+                } finally {
+                    env.releaseByteArrayElements(v.$h, elements);
+                }
+                xendroidQueueBlob({"type": "xendroid-blob", "sha1": sha1}, buffer);
+
+                if (sentBlobsCount >= 4096) {
+                    sentBlobs = {};
+                    sentBlobsCount = 0;
+                }
+                sentBlobs[sha1] = true;
+                sentBlobsCount++;
+            }
+
+            function contentValues(values, keyName) {
+                var entries = [];
+                var it = values.keySet().iterator();
+                while (it.hasNext()) {
+                    var key = it.next();
+                    var value = values.get(key);
+                    var entry = {"Value": value === null ? null : value.toString()};
+                    entry[keyName] = key.toString();
+                    entries.push(entry);
+                }
+                return entries;
+            }
 
-    def __init__(self, analysis_path, frida_connection):
+            // special-case handlers, called with the hooked instance as `this`,
+            // what they capture goes to the `x` field of the event
+            const handlers = {
+                "prefs_file": function(args, extra) {
+                    var file = Java.cast(this.mFile.value, Java.use("java.io.File"));
+                    extra["Target file"] = file.getAbsolutePath();
+                },
+                "prefs_editor_file": function(args, extra) {
+                    var prefs = Java.cast(this.this$0.value, Java.use("android.app.SharedPreferencesImpl"));
+                    var file = Java.cast(prefs.mFile.value, Java.use("java.io.File"));
+                    extra["Target file"] = file.getAbsolutePath();
+                },
+                "content_values": function(args, extra) {
+                    extra["Content values"] = contentValues(args[1], "Key");
+                },
+                "sqlite_file": function(args, extra) {
+                    extra["Target file"] = this.getPath();
+                },
+                "sqlite_insert": function(args, extra) {
+                    extra["Target file"] = this.getPath();
+                    extra["Entries"] = contentValues(args[2], "Column");
+                },
+                "receiver_action": function(args, extra) {
+                    var actions = [];
+                    for (var i = 0; i < args[1].countActions(); i++)
+                        actions.push(args[1].getAction(i));
+                    extra["Action"] = actions.join(" ");
+                },
+                "process_command": function(args, extra) {
+                    extra["Command"] = this.command().toString();
+                }
+            };
+
+            // emits the event as allowed by the hook's policy, repeated events are
+            // held as one record with their count `n` and last timestamp `tl`, the number
+            // of calls skipped by sampling or rate limiting is sent as `s`
+            function emitWithPolicy(policy, state, hookData) {
+                if (policy === null) {
+                    xendroidEmit(hookData);
+                    return;
+                }
+
+                state.calls++;
+                if (policy["sample"] && (state.calls - 1) %% policy["sample"] !== 0) {
+                    state.suppressed++;
+                    return;
+                }
+
+                const now = Date.now();
+                var key = null;
+                if (policy["collapse"]) {
+                    key = JSON.stringify([hookData["a"], hookData["x"]]);
+                    if (state.held !== null && key === state.heldKey) {
+                        state.held["n"]++;
+                        state.held["tl"] = now;
+                        return;
+                    }
+                }
+
+                if (policy["max_rate"]) {
+                    const second = Math.floor(now / 1000);
+                    if (second !== state.second) {
+                        state.second = second;
+                        state.inSecond = 0;
+                    }
+                    if (state.inSecond >= policy["max_rate"]) {
+                        state.suppressed++;
+                        return;
+                    }
+                    state.inSecond++;
+                }
+
+                if (key !== null) {
+                    releaseHeld(state);
+                    hookData["t"] = hookData["tl"] = now;
+                    hookData["n"] = 1;
+                    state.held = hookData;
+                    state.heldKey = key;
+                    return;
+                }
+                xendroidEmit(hookData);
+            }
+
+            function releaseHeld(state) {
+                const held = state.held;
+                if (held === null)
+                    return;
+
+                state.held = state.heldKey = null;
+                if (held["n"] === 1) {
+                    delete held["n"];
+                    delete held["tl"];
+                }
+                xendroidEmit(held);
+            }
+
+            function newPolicyState(id) {
+                const state = {"calls": 0, "suppressed": 0, "second": 0, "inSecond": 0, "held": null, "heldKey": null};
+                xendroidReleasers.push(function() {
+                    releaseHeld(state);
+                    if (state.suppressed > 0) {
+                        xendroidEmit({"h": id, "s": state.suppressed});
+                        state.suppressed = 0;
+                    }
+                });
+                return state;
+            }
+
+            function installHook(cls, clsName, hook) {
+                const id = hook[0], method = hook[1], captures = hook[3];
+                const handler = hook[4] === null ? null : handlers[hook[4]];
+                const mock = hook[5], policy = hook[6];
+                const state = policy === null ? null : newPolicyState(id);
+
+                const overload = cls[method].overload.apply(cls[method], hook[2]);
+                overload.implementation = function() {
+                    if (!profiling)
+                        return hooked.apply(this, arguments);
+
+                    const stats = profileStats[id] || (profileStats[id] = [0, 0, 0]);
+                    const start = profileNow();
+                    try {
+                        return hooked.apply(this, arguments);
+                    } finally {
+                        stats[0]++;
+                        stats[1] += profileNow() - start;
+                    }
+                };
+
+                function callOriginal(self, args) {
+                    if (!profiling)
+                        return overload.apply(self, args);
+
+                    const start = profileNow();
+                    try {
+                        return overload.apply(self, args);
+                    } finally {
+                        const stats = profileStats[id] || (profileStats[id] = [0, 0, 0]);
+                        stats[2] += profileNow() - start;
+                    }
+                }
+
+                function hooked() {
+                    // calls made by this thread while capturing, e.g. to hash a buffer, aren't reported
+                    const tid = Process.getCurrentThreadId();
+                    if (capturingThreads[tid])
+                        return overload.apply(this, arguments);
+
+                    // the host knows the rest of the hook from its id, see `HookTable`
+                    var values = new Array(captures.length);
+                    capturingThreads[tid] = true;
+                    try {
+                        for (var i = 0; i < captures.length; i++)
+                            values[i] = formatters[captures[i][1]](arguments[captures[i][0]]);
+                    } finally {
+                        delete capturingThreads[tid];
+                    }
+
+                    var hookData = {"h": id, "a": values};
+                    if (handler !== null) {
+                        hookData["x"] = {};
+                        handler.call(this, arguments, hookData["x"]);
+                    }
+
+                    emitWithPolicy(policy, state, hookData);
+                    if (mock !== null)
+                        return String.$new(mock);
+                    return callOriginal(this, arguments);
+                }
+            }
+
+            // "<class>.<method>(<params>)" -> installed, installed lazily, deferred or failed
+            const hookStatus = {};
+            // entries of the classes that aren't loaded yet, by class name
+            const pending = {};
+            var pendingCount = 0;
+
+            function hookName(clsName, hook) {
+                return clsName + "." + hook[1] + "(" + hook[2].join(", ") + ")";
+            }
+
+            function installClass(cls, entry, status) {
+                entry[1].forEach(function(hook) {
+                    try {
+                        installHook(cls, entry[0], hook);
+                        hookStatus[hookName(entry[0], hook)] = status;
+                    } catch(e) {
+                        hookStatus[hookName(entry[0], hook)] = "failed: " + e;
+                        setTimeout(function() { throw e; }, 0);
+                    }
+                });
+            }
+
+            function defer(entry) {
+                pending[entry[0]] = entry;
+                pendingCount++;
+                entry[1].forEach(function(hook) {
+                    hookStatus[hookName(entry[0], hook)] = "deferred";
+                });
+            }
 
+            function installPending(name, factories) {
+                const entry = pending[name];
+                for (var i = 0; i < factories.length; i++) {
+                    var cls;
+                    try {
+                        cls = factories[i].use(name);
+                    } catch(e) { continue; }
+
+                    delete pending[name];
+                    pendingCount--;
+                    installClass(cls, entry, "installed lazily");
+                    return;
+                }
+            }
+
+            function factoryFor(loader) {
+                if (Java.ClassFactory !== undefined)
+                    return Java.ClassFactory.get(loader);
+                Java.classFactory.loader = loader;
+                return Java.classFactory;
+            }
+
+            // catches the classes explicitly loaded, e.g. from a dex loaded at runtime
+            function watchClassLoading() {
+                const loadClass = Java.use("java.lang.ClassLoader").loadClass.overload("java.lang.String", "boolean");
+                loadClass.implementation = function(name, resolve) {
+                    const result = loadClass.call(this, name, resolve);
+                    if (pending.hasOwnProperty(name))
+                        installPending(name, [factoryFor(this)]);
+                    return result;
+                };
+            }
+
+            // catches the classes resolved by the runtime without going through `loadClass`,
+            // enumerating the loaded classes is expensive and some deferred classes are never
+            // loaded, so the checks back off and stop after a few, `loadClass` is watched anyway
+            function sweepPending(pass) {
+                if (pendingCount === 0)
+                    return;
+
+                Java.perform(function() {
+                    var factories = null;
+                    Java.enumerateLoadedClassesSync().forEach(function(name) {
+                        if (!pending.hasOwnProperty(name))
+                            return;
+                        if (factories === null)
+                            factories = [Java].concat(Java.enumerateClassLoadersSync().map(factoryFor));
+                        installPending(name, factories);
+                    });
+                });
+
+                if (pass + 1 < XENDROID_SWEEP_PASSES)
+                    scheduleSweep(pass + 1);
+            }
+
+            function scheduleSweep(pass) {
+                setTimeout(function() { sweepPending(pass); }, XENDROID_SWEEP_INTERVAL * Math.pow(2, pass));
+            }
+
+            const loaded = {};
+            if (XENDROID_LAZY) {
+                Java.enumerateLoadedClassesSync().forEach(function(name) {
+                    loaded[name] = true;
+                });
+            }
+
+            XENDROID_HOOKS.forEach(function(entry) {
+                if (XENDROID_LAZY && !loaded.hasOwnProperty(entry[0])) {
+                    defer(entry);
+                    return;
+                }
+
+                var cls;
+                try {
+                    cls = Java.use(entry[0]);
+                } catch(e) {
+                    if (XENDROID_LAZY) {
+                        defer(entry);
+                        return;
+                    }
+                    entry[1].forEach(function(hook) {
+                        hookStatus[hookName(entry[0], hook)] = "failed: " + e;
+                    });
+                    setTimeout(function() { throw e; }, 0);
+                    return;
+                }
+                installClass(cls, entry, "installed");
+            });
+
+            if (XENDROID_LAZY && pendingCount > 0) {
+                watchClassLoading();
+                if (XENDROID_SWEEP_PASSES > 0)
+                    scheduleSweep(0);
+            }
+
+            rpc.exports.hookStatus = function() {
+                return hookStatus;
+            };
+        });
+        """
+
+    def __init__(self, hook_def):
+        """
+        :param hook_def: JSON object that defines a method hook
+        """
+        self.cls_name = hook_def['class']
+        self.method_name = hook_def['method']
+        self.method_params_types = hook_def['params']
+        self.hooked_params = hook_def['hooked_params']
+        self.hook_category = hook_def['category']
+        self.hook_id = hook_def['id']
+        self.policy = self._check_policy(hook_def.get('policy'))
+
+    def _check_policy(self, policy):
+        """
+        validate the optional policy of a hook
+        :param policy: {"sample": N, "max_rate": events per second, "collapse": bool}
+        :return: the policy or None
+        """
+        if not policy:
+            return None
+
+        unknown = set(policy) - set(self.policy_keys)
+        if unknown:
+            raise XenDroidModuleError('Unknown policy settings for hook {}: {}'.format(
+                self.hook_id, ', '.join(sorted(unknown))))
+        for name in ('sample', 'max_rate'):
+            if name in policy and (not isinstance(policy[name], int) or policy[name] < 1):
+                raise XenDroidModuleError('Policy setting `{}` of hook {} must be a positive integer'.format(
+                    name, self.hook_id))
+        return policy
+
+    @staticmethod
+    def _param_kind(param_type):
+        if not re.search('[.[]', param_type):
+            return 'raw'
+        elif param_type.startswith('[L'):
+            return 'array'
+        elif param_type == '[B':
+            return 'bytes'
+        elif param_type == 'java.io.File':
+            return 'file'
+        return 'string'
+
+    def _special_case_for_android_telephony_TelephonyManager(self):
+        if self.method_name.startswith('get'):
+            return None, getattr(self.values_module, 'MOCK_TM_' + self.method_name[3:].upper(), str())
+        return None, None
+
+    def _special_case_for_android_net_wifi_WifiInfo(self):
+        if self.method_name == 'getMacAddress':
+            return None, getattr(self.values_module, 'MOCK_WIFI_MACADDRESS', str())
+        return None, None
+
+    def _special_case_for_android_app_SharedPreferencesImpl(self):
+        return 'prefs_file', None
+
+    def _special_case_for_android_app_SharedPreferencesImpl_EditorImpl(self):
+        return 'prefs_editor_file', None
+
+    def _special_case_for_android_content_ContentResolver(self):
+        if self.method_name.startswith('insert'):
+            return 'content_values', None
+        return None, None
+
+    def _special_case_for_android_database_sqlite_SQLiteDatabase(self):
+        if self.method_name.startswith('insert'):
+            return 'sqlite_insert', None
+        return 'sqlite_file', None
+
+    def _special_case_for_android_content_Context(self):
+        if self.method_name == 'registerReceiver':
+            return 'receiver_action', None
+        return None, None
+
+    def _special_case_for_java_lang_ProcessBuilder(self):
+        if self.method_name == 'start':
+            return 'process_command', None
+        return None, None
+
+    def get_entry(self):
+        """
+        :return: the row of the hook in the agent's table
+        """
+        special_name = "_special_case_for_{}".format(re.sub('[.$]', '_', self.cls_name))
+        special_func = getattr(self, special_name, None)
+        handler, mock = (None, None) if special_func is None else special_func()
+
+        # in the order of `HookTable.captures`
+        captures = [
+            [self.hooked_params[name], self._param_kind(self.method_params_types[self.hooked_params[name]])]
+            for name in sorted(self.hooked_params)
+        ]
+        return [self.hook_id, self.method_name, self.method_params_types, captures, handler, mock, self.policy]
+
+    @classmethod
+    def build_agent(cls, hooks_def):
+        """
+        generate the whole agent
+        :param hooks_def: list of hook definitions
+        :return: the agent's source
+        """
+        table, by_cls = [], {}
+        for hook in hooks_def:
+            if hook['class'] not in by_cls:
+                by_cls[hook['class']] = []
+                table.append([hook['class'], by_cls[hook['class']]])
+            by_cls[hook['class']].append(cls(hook).get_entry())
+
+        runtime = ScriptFactory.agent_runtime % (
+            ScriptFactory.batch_size, ScriptFactory.flush_interval, ScriptFactory.buffer_capacity)
+        return \
+            """
+            // This script is generated from XenDroid `https://www.github.com/muhzii/XenDroid`
+            %s
+            %s
+            """ % (runtime, cls.agent_code % (json.dumps(table, separators=(',', ':')),
+                                               json.dumps(cls.lazy), cls.sweep_interval, cls.sweep_passes,
+                                               cls.inline_limit,
+                                               cls.prefix_size, cls.blob_limit, cls.blob_queue_limit))
+
+    @classmethod
+    def cache_version(cls):
+        """
+        :return: everything besides the input files that the generated agent depends on
+        """
+        return 'table-v{}:{}:{}:{}:{}:{}:{}:{}:{}:{}:{}'.format(
+            cls.generator_version, ScriptFactory.batch_size, ScriptFactory.flush_interval,
+            ScriptFactory.buffer_capacity, cls.lazy, cls.sweep_interval, cls.sweep_passes, cls.inline_limit,
+            cls.prefix_size, cls.blob_limit, cls.blob_queue_limit)
+
+
+class HookTable(object):
+    """
+    Metadata of the hooks by their id, events of the table agent only carry
+    the id of their hook and the captured values which get expanded back from it.
+    It's stored as the header of the event logs
+    """
+
+    header_type = 'xendroid-hooks'
+
+    def __init__(self, hooks):
+        """
+        :param hooks: {id: {class, method, category, params, captures}}
+        """
+        self.hooks = dict((int(hook_id), meta) for hook_id, meta in hooks.items())
+
+    @classmethod
+    def from_hooks_def(cls, hooks_def):
+        hooks = {}
+        for hook in hooks_def:
+            if hook['id'] in hooks:
+                raise XenDroidModuleError('Duplicate hook id {} in the hooks definitions'.format(hook['id']))
+            hooks[hook['id']] = {
+                'class': hook['class'],
+                'method': hook['method'],
+                'category': hook['category'],
+                'params': hook['params'],
+                'captures': sorted(hook['hooked_params']),
+                'policy': hook.get('policy'),
+            }
+        return cls(hooks)
+
+    def header(self):
+        return {'type': self.header_type, 'hooks': self.hooks}
+
+    def expand(self, event):
+        """
+        :param event: event as sent by the agent
+        :return: the event with its hook's metadata
+        """
+        expanded = {}
+        if 'h' in event:
+            meta = self.hooks.get(event['h'])
+            if meta is None:
+                expanded['Hook'] = event['h']
+            else:
+                expanded['Category'] = meta['category']
+                expanded['Class'] = meta['class']
+                expanded['Method'] = meta['method']
+                expanded.update(zip(meta['captures'], event.get('a', [])))
+            expanded.update(event.get('x', {}))
+            if 'n' in event:
+                expanded['Count'] = event['n']
+                expanded['Last timestamp'] = event['tl']
+            if 's' in event:
+                expanded['Suppressed calls'] = event['s']
+        else:
+            expanded.update((k, v) for k, v in event.items() if k != 't')
+
+        if 't' in event:
+            expanded['Timestamp'] = event['t']
+        return expanded
+
+
+def iter_hook_events(logs_path):
+    """
+    read the hook events of a task
+    :param logs_path: base path of the event logs, see `APIMonitor.logs_path`
+    :return: generator of the expanded events
+    """
+    table = HookTable({})
+    for record in read_records(logs_path):
+        if isinstance(record, dict) and record.get('type') == HookTable.header_type:
+            table = HookTable(record['hooks'])
+        elif isinstance(record, dict):
+            yield table.expand(record)
+
+
+class APIMonitor(MonitoringModule):
+
+    def __init__(self, analysis_path, frida_connection, writer_options=None, agent_factory=TableAgentFactory,
+                 profile_interval=None, blob_dir=None, apk_refs=None):
+        """
+        :param analysis_path: the task directory
+        :param frida_connection: frida connection to the device
+        :param writer_options: keyword arguments of the `EventWriter` of the hook events
+        :param agent_factory: generator of the agent, `TableAgentFactory` or `ScriptFactory`
+        :param profile_interval: seconds between two polls of the hooks' overhead, None disables profiling
+        :param blob_dir: content-addressed store for the full content of large captured buffers,
+        per task or shared between tasks, None only keeps their digest and prefix
+        :param apk_refs: `ApkReferences` of the sample, hooks of methods it never references aren't installed
+        """
         MonitoringModule.__init__(self, analysis_path, 'API Monitoring')
 
         self.logger = logging.getLogger(self.__class__.__name__)
         self.frida_connection = frida_connection
 
         self.logs_path = os.path.join(
-            self.analysis_path, 'logs', 'frida_logs.log'
+            self.analysis_path, 'logs', 'frida_logs'
         )
         self.err_logs_path = os.path.join(
             self.analysis_path, 'logs', 'frida_errors_logs.log'
         )
+        self.hooks_report_path = os.path.join(
+            self.analysis_path, 'logs', 'hooks_report.json'
+        )
+        self.profile_path = os.path.join(
+            self.analysis_path, 'logs', 'hooks_profile.json'
+        )
         self.hooks_file = os.path.join(
             ROOT_DIR, 'utils', 'hooking', 'hooks_def.json'
         )
 
+        self.writer_options = writer_options or {}
+        self.agent_factory = agent_factory
+
+        # load the file that contains the scripts definitions
+        with open(self.hooks_file, 'r') as fh:
+            self.hooks_def = json.load(fh)
+        self.hook_table = HookTable.from_hooks_def(self.hooks_def)
+
+        self.unreferenced_hooks = []
+        self.agent_hooks = self.hooks_def
+        # why the hooks weren't filtered, see `filter_hooks`
+        self.unfiltered_reasons = None if apk_refs is not None else ['no static analysis']
+        if apk_refs is not None:
+            self.agent_hooks, self.unreferenced_hooks = filter_hooks(self.hooks_def, apk_refs)
+            if apk_refs.dynamic:
+                self.unfiltered_reasons = list(apk_refs.dynamic)
+                self.logger.warning('Installing all the hooks, the sample may load code through {}'.format(
+                    ', '.join(apk_refs.dynamic)))
+            else:
+                self.logger.info('{} hooks left out, the sample never references their methods'.format(
+                    len(self.unreferenced_hooks)))
         self.logs_dumper = None
         self.errors_dumper = None
         self._init_dumping()
 
-    def _init_dumping(self):
-        # initialize the logging to dump logs to a file that will contain the hooking logs
+        self.events_received = 0
+        self.events_dropped = 0
 
-        self.logs_dumper = logging.getLogger('FRIDA_MESSAGE')
-        self.errors_dumper = logging.getLogger('FRIDA_ERROR')
+        self.profile_interval = profile_interval
+        self.profile_clock = None
+        self.blob_store = None if blob_dir is None else ContentStore(blob_dir)
+        self.blobs_stored = 0
+        self._profiler = None
+        self._profiler_stop = threading.Event()
 
-        self.errors_dumper.setLevel(logging.DEBUG)
-        self.logs_dumper.setLevel(logging.DEBUG)
+    def _init_dumping(self):
+        # hook events are written off frida's message thread, see `EventWriter`
+        self.logs_dumper = EventWriter(self.logs_path, header=self.hook_table.header(), **self.writer_options)
 
-        logs_fh = logging.FileHandler(self.logs_path)
-        logs_fh.setLevel(logging.INFO)
+        # loggers are named after the task so that concurrent tasks don't share handlers
+        task_name = os.path.basename(self.analysis_path)
+        self.errors_dumper = logging.getLogger('FRIDA_ERROR.' + task_name)
+        self.errors_dumper.setLevel(logging.DEBUG)
 
         errors_fh = logging.FileHandler(self.err_logs_path)
         errors_fh.setLevel(logging.INFO)
 
-        self.logs_dumper.addHandler(logs_fh)
         self.errors_dumper.addHandler(errors_fh)
-
-        self.logs_dumper.propagate = False
         self.errors_dumper.propagate = False
 
-    def __log_script_messages(self, message, payload):
+    def __log_script_messages(self, message, data):
         if message['type'] == 'send':
-            if 'payload' in message:
-                self.logs_dumper.info(payload)
+            payload = message.get('payload')
+            if isinstance(payload, dict) and payload.get('type') == 'xendroid-batch':
+                self.__log_batch(payload, data)
+            elif isinstance(payload, dict) and payload.get('type') == 'xendroid-blob':
+                self.__store_blob(payload, data)
+            elif payload is not None:
+                self.logs_dumper.write(payload)
         elif message['type'] == 'error':
             self.errors_dumper.info(message)
 
+    def __log_batch(self, payload, data):
+        """
+        unpack a batch of events flushed by the agent
+        :param payload: batch header
+        :param data: newline-delimited JSON events
+        :return:
+        """
+        if payload['dropped'] > self.events_dropped:
+            self.logger.warning('{} hook events dropped by the agent so far, its buffer overflowed'.format(
+                payload['dropped']))
+            self.events_dropped = payload['dropped']
+
+        if not data:
+            return
+        # the events are already serialized by the agent
+        self.logs_dumper.write_lines(data.split(b'\n'))
+        self.events_received += payload['count']
+
+    def __store_blob(self, payload, data):
+        """
+        keep the content of a captured buffer, identical contents are only stored once
+        :param payload: blob header
+        :param data: the content
+        :return:
+        """
+        if self.blob_store is None or data is None or self.blob_store.has(payload['sha1']):
+            return
+
+        if self.blob_store.add_from_chunks(payload['sha1'], [data]):
+            self.blobs_stored += 1
+        else:
+            self.logger.warning('Captured buffer {} does not match its digest, dropped'.format(payload['sha1']))
+
+    def _write_hooks_report(self):
+        """
+        dump the status of every hook as reported by the agent
+        :return:
+        """
+        try:
+            status = self.frida_connection.call_export('hook_status')
+        except XenDroidFridaError as e:
+            self.logger.debug('Unable to get the status of the hooks: {}'.format(e))
+            return
+
+        report = {'installed': [], 'installed lazily': [], 'never triggered': [], 'failed': {},
+                  'not referenced': ['{}.{}({})'.format(hook['class'], hook['method'], ', '.join(hook['params']))
+                                     for hook in self.unreferenced_hooks],
+                  'filtered': self.unfiltered_reasons is None, 'not filtered because': self.unfiltered_reasons}
+        for hook, state in sorted(status.items()):
+            if state == 'deferred':
+                report['never triggered'].append(hook)
+            elif state.startswith('failed'):
+                report['failed'][hook] = state.split(': ', 1)[-1]
+            else:
+                report[state].append(hook)
+
+        with open(self.hooks_report_path, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+        self.logger.info('Hooks: {} installed, {} installed lazily, {} never triggered, {} failed, '
+                         '{} not referenced'.format(len(report['installed']), len(report['installed lazily']),
+                                                    len(report['never triggered']), len(report['failed']),
+                                                    len(report['not referenced'])))
+
+    def _write_profile(self):
+        """
+        poll the per hook overhead from the agent and dump it, most expensive hooks first
+        :return: whether the agent answered
+        """
+        try:
+            stats = self.frida_connection.call_export('profile')
+        except XenDroidFridaError as e:
+            self.logger.debug('Unable to get the profile of the hooks: {}'.format(e))
+            return False
+
+        hooks = []
+        for hook_id, (calls, total, original) in stats.items():
+            meta = self.hook_table.hooks.get(int(hook_id), {})
+            hooks.append({
+                'id': int(hook_id),
+                'hook': '{}.{}({})'.format(meta.get('class'), meta.get('method'), ', '.join(meta.get('params', []))),
+                'calls': calls,
+                'hook_ms': round(total - original, 3),
+                'original_ms': round(original, 3),
+                'avg_hook_us': round((total - original) * 1000 / calls, 1) if calls else 0,
+            })
+        hooks.sort(key=lambda hook: hook['hook_ms'], reverse=True)
+
+        with open(self.profile_path, 'w') as fh:
+            json.dump({'clock': self.profile_clock, 'coarse': self.profile_clock == 'Date.now', 'hooks': hooks},
+                      fh, indent=2)
+        return True
+
+    def _poll_profile(self):
+        while not self._profiler_stop.wait(self.profile_interval):
+            if not self._write_profile():
+                break
+
+    def _start_profiling(self):
+        try:
+            self.profile_clock = self.frida_connection.call_export('set_profiling', True)
+        except XenDroidFridaError as e:
+            self.logger.warning('Hook profiling is not available: {}'.format(e))
+            return
+
+        if self.profile_clock == 'Date.now':
+            self.logger.warning('Only a 1 ms clock is available to profile the hooks, '
+                                'the profile is marked as coarse')
+
+        self._profiler_stop.clear()
+        self._profiler = threading.Thread(target=self._poll_profile, name='hooks-profiler')
+        self._profiler.daemon = True
+        self._profiler.start()
+
+    def _stop_profiling(self):
+        if self._profiler is None:
+            return
+
+        self._profiler_stop.set()
+        self._profiler.join()
+        self._profiler = None
+        # last poll, covers the time since the previous one
+        self._write_profile()
+
     def start(self):
         """
         start monitoring android api calls
@@ -284,27 +1260,47 @@ class APIMonitor(MonitoringModule):
         """
         super(APIMonitor, self).start()
 
-        # load the file that contains the scripts definitions
-        hooks_def = json.load(open(self.hooks_file, 'r'))
+        agent_cache = AgentCache()
+        # agents for different subsets of the hooks are cached separately
+        hook_ids = ','.join(str(hook['id']) for hook in self.agent_hooks)
+        key = AgentCache.make_key([self.hooks_file, self.agent_factory.values_file],
+                                  '{}:{}'.format(self.agent_factory.cache_version(), hook_ids))
 
-        hook_script_jvm = str()
-        # loop through all the hooks in the json file
-        for hook in hooks_def:
-            script_gen = ScriptFactory(hook)
-            hook_script_jvm += script_gen.get_script(wrap=False)
+        def generate():
+            return self.agent_factory.build_agent(self.agent_hooks)
 
-        hook_script_jvm = ScriptFactory.wrap_hook_code(hook_script_jvm)
+        hook_script_jvm = agent_cache.get_source(key, generate)
 
         self.frida_connection.set_msg_handler(self.__log_script_messages)
         try:
             # attach to the process
             self.frida_connection.start_session()
+
+            try:
+                bytecode = agent_cache.get_bytecode(
+                    key, self.frida_connection.runtime_tag(),
+                    lambda: self.frida_connection.compile_script(hook_script_jvm))
+            except XenDroidFridaError as e:
+                # not cached, the next task tries to compile it again
+                self.logger.debug('{}, loading the agent from its source'.format(e))
+                bytecode = None
+            self.logger.debug('Agent cache: {}'.format(AgentCache.report()))
+
             # load the script into the device
-            self.frida_connection.load_script(hook_script_jvm)
+            self.frida_connection.load_script(hook_script_jvm, bytecode)
         except XenDroidFridaError as e:
             self.logger.error(e.message)
             raise XenDroidModuleError()
 
+        if self.profile_interval is not None:
+            self._start_profiling()
+
+        if self.blob_store is not None:
+            try:
+                self.frida_connection.call_export('set_blob_capture', True)
+            except XenDroidFridaError as e:
+                self.logger.warning('Capturing large buffers is not available: {}'.format(e))
+
         self.pid = self.frida_connection.pid
         self.logger.debug(
             'successfully started the API monitoring module...'
@@ -317,7 +1313,14 @@ class APIMonitor(MonitoringModule):
         """
         super(APIMonitor, self).stop()
 
+        self._stop_profiling()
+        self._write_hooks_report()
+
+        # unloading the script makes the agent flush what's left in its buffer
         self.frida_connection.terminate_session()
+        self.logs_dumper.close()
         self.logger.debug(
-            'API monitoring module successfully terminated!'
+            'API monitoring module successfully terminated! '
+            '({} events received, {} dropped, {} buffers stored)'.format(
+                self.events_received, self.events_dropped, self.blobs_stored)
         )
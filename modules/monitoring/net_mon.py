@@ -8,7 +8,10 @@
 
 import os
 import logging
+import threading
 
+from lib.api.pcap_writer import PcapWriter
+from modules.analysing.traffic import index_capture
 from lib.definitions.classes import MonitoringModule
 
 from lib.definitions.exceptions import (
@@ -20,63 +23,189 @@ class TrafficMonitor(MonitoringModule):
 
     """This is responsible for analysing the network traffic via tcpdump"""
 
-    def __init__(self, analysis_path, adb_connection):
+    # app scoped capture, the app's connections get this bit of their conntrack mark
+    # and their packets are sent to tcpdump through this nflog group
+    nflog_group = 30
+    conn_mark = '0x10000000/0x10000000'
+    chains = ('xendroid_out', 'OUTPUT'), ('xendroid_in', 'INPUT')
 
+    def __init__(self, analysis_path, adb_connection, segment_size=64 * 1024 * 1024, segment_duration=None,
+                 start_timeout=10, package_name=None):
+        """
+        :param analysis_path: the task directory
+        :param adb_connection: adb connection to the device
+        :param segment_size: bytes after which the capture continues in a new pcap file
+        :param segment_duration: seconds of capture after which it continues in a new pcap file
+        :param start_timeout: seconds to wait for tcpdump to start on the device
+        :param package_name: only capture the traffic of this application, and DNS lookups
+        since they're made by the system's resolver, the whole device's traffic is captured
+        if that's not supported on the device
+        """
         MonitoringModule.__init__(self, analysis_path, 'Network monitoring')
 
         self.logger = logging.getLogger(self.__class__.__name__)
         self.adb_connection = adb_connection
+        self.start_timeout = start_timeout
+        self.package_name = package_name
+        self.app_scoped = False
 
         self.t_executable = '/data/local/tmp/tcpdump'
 
-        self.t_dump = self.t_executable + '.pcap'
-        self.t_log = self.t_executable + '.log'
+        # the capture is streamed to net_dump.<n>.pcap as it happens
+        self.dump_path = os.path.join(self.analysis_path, 'logs', 'net_dump')
+        self.pcap_writer = PcapWriter(self.dump_path, segment_size, segment_duration)
+        self.index_path = os.path.join(self.analysis_path, 'logs', 'net_index.ndjson')
+
+        self.capture_thread = None
+        self.started = threading.Event()
+
+    def _capture(self):
+        """
+        read the packets streamed by tcpdump until it's killed,
+        the first line of the stream is the pid of tcpdump
+        :return:
+        """
+        # packet buffered output, the shell replaces itself with tcpdump so `$$` is its pid
+        interface = '-i nflog:{} '.format(self.nflog_group) if self.app_scoped else ''
+        cmd = 'echo $$; exec {} {}-U -w - 2>/dev/null'.format(self.t_executable, interface)
+        pid_line = b''
+        try:
+            for chunk in self.adb_connection.exec_out_stream(cmd):
+                if not self.started.is_set():
+                    pid_line += chunk
+                    if b'\n' not in pid_line:
+                        continue
+                    pid, chunk = pid_line.split(b'\n', 1)
+                    self.pid = int(pid.strip())
+                    self.started.set()
+
+                self.pcap_writer.feed(chunk)
+        except (XenDroidADBError, ValueError) as err:
+            self.logger.error('Network capture interrupted: {}'.format(err))
+        finally:
+            self.pcap_writer.close()
+
+    def _iptables(self, cmds):
+        """
+        run iptables commands for both IPv4 and IPv6
+        :param cmds: commands without the iptables executable
+        :return:
+        """
+        self.adb_connection.shell(' && '.join('{} -w {}'.format(ipt, cmd)
+                                              for ipt in ('iptables', 'ip6tables') for cmd in cmds))
+
+    def _remove_app_rules(self):
+        """
+        remove the rules of an app scoped capture, ignoring the ones that don't exist
+        :return:
+        """
+        cmds = []
+        for ipt in ('iptables', 'ip6tables'):
+            for chain, parent in self.chains:
+                cmds += ['{} -w -D {} -j {}'.format(ipt, parent, chain),
+                         '{} -w -F {}'.format(ipt, chain), '{} -w -X {}'.format(ipt, chain)]
+        try:
+            self.adb_connection.shell('; '.join(cmds) + '; true')
+        except XenDroidADBError as err:
+            self.logger.warning('Unable to remove the capture rules: {}'.format(err))
 
-    def pull_output(self):
+    def _setup_app_scope(self):
         """
-        Pull the tcpdump traffic output files from the device
+        send the packets of the app's connections and DNS lookups to an nflog group
+        :return: whether the capture can be scoped to the app
+        """
+        try:
+            uid = self.adb_connection.get_package_uid(self.package_name)
+            if uid is None:
+                self.logger.warning('No uid found for {}'.format(self.package_name))
+                return False
+
+            interfaces = self.adb_connection.shell('{} -D'.format(self.t_executable)) or b''
+            if b'nflog' not in interfaces:
+                self.logger.warning("tcpdump on the device can't capture from nflog")
+                return False
+
+            # leftovers of a task that didn't stop cleanly
+            self._remove_app_rules()
+
+            mark = '-j CONNMARK --set-xmark {}'.format(self.conn_mark)
+            nflog = '-m connmark --mark {} -j NFLOG --nflog-group {}'.format(self.conn_mark, self.nflog_group)
+            self._iptables(['-N xendroid_out', '-N xendroid_in',
+                            '-A xendroid_out -m owner --uid-owner {} {}'.format(uid, mark),
+                            '-A xendroid_out -p udp --dport 53 {}'.format(mark),
+                            '-A xendroid_out -p tcp --dport 53 {}'.format(mark),
+                            '-A xendroid_out {}'.format(nflog), '-A xendroid_in {}'.format(nflog),
+                            '-I OUTPUT -j xendroid_out', '-I INPUT -j xendroid_in'])
+        except XenDroidADBError as err:
+            self.logger.warning('Unable to set up the capture rules: {}'.format(err))
+            self._remove_app_rules()
+            return False
+
+        self.logger.info('Capturing the traffic of {} (uid {}) only'.format(self.package_name, uid))
+        return True
+
+    def _index_capture(self):
+        """
+        index the flows, DNS messages, HTTP requests and TLS server names of the capture
         :return:
         """
-        pull_to = os.path.join(self.analysis_path, 'logs', 'net_dump.pcap')
-        self.adb_connection.pull(self.t_dump, pull_to)
+        try:
+            stats = index_capture(self.pcap_writer.segments, self.index_path)
+        except (IOError, OSError, ValueError) as err:
+            self.logger.error('Unable to index the network capture: {}'.format(err))
+            return
 
-        pull_to = os.path.join(self.analysis_path, 'logs', 'net_log.log')
-        self.adb_connection.pull(self.t_log, pull_to)
+        self.logger.info('Network index: {flows} flows, {dns} DNS messages, {http} HTTP requests, '
+                         '{tls} TLS handshakes'.format(**stats))
 
     def start(self):
         """
-        Start tcpdump traffic monitoring on the device
-        :return: process id
+        Start tcpdump on the device and stream its capture to the task's logs
+        :return:
         """
         super(TrafficMonitor, self).start()
-
-        # save a pcap file to the target directory
-        args = [self.t_executable, '-w', self.t_dump, '&']
         self.logger.info('Starting network monitoring module on the device...')
 
-        try:
-            self.adb_connection.shell(args)
-        except XenDroidADBError:
-            raise XenDroidModuleError()
+        if self.package_name is not None:
+            self.app_scoped = self._setup_app_scope()
+            if not self.app_scoped:
+                self.logger.warning('Falling back to capturing the traffic of the whole device')
+
+        self.capture_thread = threading.Thread(target=self._capture, name='traffic-capture')
+        self.capture_thread.daemon = True
+        self.capture_thread.start()
+
+        if not self.started.wait(self.start_timeout):
+            if self.app_scoped:
+                self._remove_app_rules()
+            super(TrafficMonitor, self).stop()
+            raise XenDroidModuleError('tcpdump did not start on the device')
 
-        self.pid = self.adb_connection.shell('echo $!')
         self.logger.debug('Network monitoring module started successfully!')
 
     def stop(self):
         """
-        Stop the tcpdump process and pull the logs
+        Stop the tcpdump process and wait for the rest of the capture
         :return:
         """
         if self.isRunning():
             self.logger.debug('Stopping the network sniffer...')
-            self.adb_connection.kill_process(self.pid)
 
-            args = [self.t_executable, '-ttttnnql', '-r', self.t_dump, '>', self.t_log]
+            # SIGTERM so that tcpdump flushes what it has captured
             try:
-                self.adb_connection.shell(args)
+                self.adb_connection.shell('kill {}'.format(self.pid))
             except XenDroidADBError:
                 raise XenDroidModuleError()
 
-            self.pull_output()
+            self.capture_thread.join(self.start_timeout)
+            if self.capture_thread.is_alive():
+                self.logger.warning('Timed out while waiting for the end of the capture stream')
+
+            if self.app_scoped:
+                self._remove_app_rules()
+
+            self.logger.info('Captured {} packets in {} pcap files'.format(
+                self.pcap_writer.packets, len(self.pcap_writer.segments)))
+            self._index_capture()
             super(TrafficMonitor, self).stop()
             self.logger.debug('Network monitoring process has been killed!')
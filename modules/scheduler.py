@@ -0,0 +1,301 @@
+# Copyright (C) 2018  Muhammed Ziad
+# This file is part of XenDroid - https://github.com/muhzii/XenDroid
+#
+# An instrumented sandbox for Android
+# This program is a free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License
+
+
+import time
+import logging
+
+from collections import deque
+from multiprocessing import Process, Queue
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from modules.analysis_manager import AnalysisManager
+from lib.definitions.exceptions import XenDroidADBError, XenDroidStartupError, XenDroidTimeOutError
+
+# failures that tell something about the device rather than about the sample,
+# only these count towards retiring a device
+DEVICE_ERRORS = (XenDroidADBError, XenDroidStartupError, XenDroidTimeOutError)
+
+
+def _device_worker(serial, inbox, results, offline, app_traffic_only, fake_internet, profile_interval,
+                   capture_blobs, blob_dir):
+    """
+    run the analysis tasks sent to one device, one at a time
+    :param serial: device serial
+    :param inbox: queue of apk paths, None stops the worker
+    :param results: queue receiving (serial, apk path, error or None, whether it's a device error)
+    :param offline: passed to the `AnalysisManager`
+    :param app_traffic_only: passed to the `AnalysisManager`
+    :param fake_internet: passed to the `AnalysisManager`
+    :param profile_interval: passed to the `AnalysisManager`
+    :param capture_blobs: passed to the `AnalysisManager`
+    :param blob_dir: passed to the `AnalysisManager`
+    :return:
+    """
+    while True:
+        apk_path = inbox.get()
+        if apk_path is None:
+            break
+
+        error = None
+        device_error = False
+        try:
+            am = AnalysisManager(apk_path, serial, offline, app_traffic_only, fake_internet, profile_interval,
+                                 capture_blobs, blob_dir)
+            try:
+                am.start()
+            finally:
+                am.roll_back()
+        except Exception as err:
+            logging.getLogger('Scheduler').exception('Task {} failed on {}'.format(apk_path, serial))
+            error = '{}: {}'.format(err.__class__.__name__, err)
+            device_error = isinstance(err, DEVICE_ERRORS)
+
+        results.put((serial, apk_path, error, device_error))
+
+
+class AnalysisTask(object):
+
+    def __init__(self, apk_path):
+        self.apk_path = apk_path
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        self.attempts = 0
+        self.failed_on = set()
+        self.error = None
+
+
+class DeviceWorker(object):
+
+    def __init__(self, serial):
+        self.serial = serial
+        self.inbox = Queue()
+        self.process = None
+
+        self.task = None
+        self.task_started_at = None
+        self.retired = False
+
+        self.completed = 0
+        self.failed = 0
+        self.consecutive_failures = 0
+        self.busy_time = 0.0
+
+
+class SchedulerReport(object):
+
+    def __init__(self, workers, done, failed, unassigned, elapsed):
+        """
+        :param workers: the `DeviceWorker`s
+        :param done: tasks that completed
+        :param failed: tasks that failed on every attempt
+        :param unassigned: tasks left when no device was able to take them
+        :param elapsed: wall time of the run in seconds
+        """
+        self.workers = workers
+        self.done = done
+        self.failed = failed
+        self.unassigned = unassigned
+        self.elapsed = elapsed
+
+    def throughput(self, worker):
+        """
+        :return: completed tasks per hour for a device
+        """
+        return worker.completed * 3600.0 / self.elapsed if self.elapsed else 0.0
+
+    def queue_latencies(self):
+        return [t.started_at - t.enqueued_at for t in self.done + self.failed if t.started_at is not None]
+
+    def __str__(self):
+        lines = ['{} tasks done, {} failed, {} unassigned in {:.1f}s'.format(
+            len(self.done), len(self.failed), len(self.unassigned), self.elapsed)]
+
+        for worker in self.workers:
+            lines.append('  {}: {} done, {} failed, {:.2f} tasks/hour, {:.0f}% busy{}'.format(
+                worker.serial, worker.completed, worker.failed, self.throughput(worker),
+                100 * worker.busy_time / self.elapsed if self.elapsed else 0,
+                ' (retired)' if worker.retired else ''))
+
+        latencies = self.queue_latencies()
+        if latencies:
+            lines.append('  queue latency: avg {:.1f}s, max {:.1f}s'.format(
+                sum(latencies) / len(latencies), max(latencies)))
+        return '\n'.join(lines)
+
+
+class AnalysisScheduler(object):
+    """
+    Runs a queue of APKs over a pool of devices, one `AnalysisManager`
+    task per device at a time, each device is driven by its own process.
+    A failed task is handed to another device and a device that keeps failing
+    because of adb, its startup or timeouts is taken out of the pool, failures
+    caused by the samples themselves don't count against the devices
+    """
+
+    def __init__(self, serials, offline=False, max_attempts=2, max_device_failures=2, app_traffic_only=False,
+                 fake_internet=None, profile_interval=None, capture_blobs=False, blob_dir=None):
+        """
+        :param serials: device serials as per the output of `adb devices`
+        :param offline: only use already cached artifacts
+        :param app_traffic_only: only capture the network traffic of the analysed applications
+        :param fake_internet: keyword arguments of the `FakeInternet` every device is wired to, or None
+        :param profile_interval: seconds between two dumps of the hooks' overhead of every task, or None
+        :param capture_blobs: keep the full content of large captured buffers
+        :param blob_dir: store of the captured buffers shared by every task, None for one store per task
+        :param max_attempts: attempts per task before it's given up
+        :param max_device_failures: consecutive device errors before a device is retired
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.workers = [DeviceWorker(serial) for serial in serials]
+        self.offline = offline
+        self.app_traffic_only = app_traffic_only
+        self.fake_internet = fake_internet
+        self.profile_interval = profile_interval
+        self.capture_blobs = capture_blobs
+        self.blob_dir = blob_dir
+        self.max_attempts = max_attempts
+        self.max_device_failures = max_device_failures
+
+        self.pending = deque()
+        self.done = []
+        self.failed = []
+        self.results = Queue()
+
+    def submit(self, apk_path):
+        """
+        add an APK to the queue
+        :param apk_path:
+        :return:
+        """
+        self.pending.append(AnalysisTask(apk_path))
+
+    def _healthy(self):
+        return [w for w in self.workers if not w.retired]
+
+    def _assign(self):
+        for worker in self._healthy():
+            if worker.task is not None:
+                continue
+
+            # prefer tasks that didn't already fail on this device
+            task = next((t for t in self.pending if worker.serial not in t.failed_on), None)
+            if task is None:
+                continue
+
+            self.pending.remove(task)
+            task.attempts += 1
+            if task.started_at is None:
+                task.started_at = time.time()
+
+            worker.task = task
+            worker.task_started_at = time.time()
+            worker.inbox.put(task.apk_path)
+            self.logger.info('Task {} assigned to {}'.format(task.apk_path, worker.serial))
+
+    def _finish(self, worker, error, device_error=False):
+        """
+        :param worker: the `DeviceWorker` that ran the task
+        :param error: None if the task completed
+        :param device_error: whether the failure is the device's, see `DEVICE_ERRORS`
+        :return:
+        """
+        task, worker.task = worker.task, None
+        worker.busy_time += time.time() - worker.task_started_at
+
+        if error is None:
+            task.finished_at = time.time()
+            worker.completed += 1
+            worker.consecutive_failures = 0
+            self.done.append(task)
+            return
+
+        worker.failed += 1
+        if device_error:
+            worker.consecutive_failures += 1
+        task.failed_on.add(worker.serial)
+        task.error = error
+
+        if task.attempts < self.max_attempts:
+            self.logger.warning('Task {} failed on {}, reassigning it: {}'.format(
+                task.apk_path, worker.serial, error))
+            self.pending.appendleft(task)
+        else:
+            self.logger.error('Task {} failed after {} attempts: {}'.format(task.apk_path, task.attempts, error))
+            task.finished_at = time.time()
+            self.failed.append(task)
+
+        if worker.consecutive_failures >= self.max_device_failures:
+            self._retire(worker)
+
+    def _retire(self, worker):
+        self.logger.error('Device {} keeps failing, removing it from the pool'.format(worker.serial))
+        worker.retired = True
+        worker.inbox.put(None)
+
+    def _check_workers(self):
+        for worker in self._healthy():
+            if not worker.process.is_alive():
+                if worker.task is not None:
+                    self._finish(worker, 'worker process for {} died'.format(worker.serial), device_error=True)
+                if not worker.retired:
+                    self._retire(worker)
+
+    def _has_work(self):
+        if any(w.task is not None for w in self.workers):
+            return True
+
+        # pending tasks are only worth waiting for if a device can still take them
+        healthy = set(w.serial for w in self._healthy())
+        return any(healthy - t.failed_on for t in self.pending)
+
+    def run(self):
+        """
+        run the queued tasks until they're all done or no device can take them
+        :return: a `SchedulerReport`
+        """
+        start = time.time()
+
+        for worker in self.workers:
+            worker.process = Process(target=_device_worker,
+                                     args=(worker.serial, worker.inbox, self.results, self.offline,
+                                           self.app_traffic_only, self.fake_internet, self.profile_interval,
+                                           self.capture_blobs, self.blob_dir))
+            worker.process.daemon = True
+            worker.process.start()
+
+        by_serial = dict((w.serial, w) for w in self.workers)
+        try:
+            while True:
+                self._assign()
+                if not self._has_work():
+                    break
+
+                try:
+                    serial, _, error, device_error = self.results.get(timeout=1)
+                except Empty:
+                    self._check_workers()
+                    continue
+                self._finish(by_serial[serial], error, device_error)
+        finally:
+            for worker in self._healthy():
+                worker.inbox.put(None)
+            for worker in self.workers:
+                worker.process.join(5)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+
+        report = SchedulerReport(self.workers, self.done, self.failed, list(self.pending), time.time() - start)
+        self.logger.info('Analysis run finished:\n{}'.format(report))
+        return report
@@ -0,0 +1,318 @@
+# Copyright (C) 2018  Muhammed Ziad
+# This file is part of XenDroid - https://github.com/muhzii/XenDroid
+#
+# An instrumented sandbox for Android
+# This program is a free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License
+
+
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import tempfile
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from lib.definitions.constants import MISC_FOLDER
+from lib.definitions.exceptions import XenDroidADBError
+
+# device directories captured by a snapshot
+SNAPSHOT_ROOTS = ('/data/data', '/sdcard/')
+
+SNAPSHOT_STORE_DIR = os.path.join(MISC_FOLDER, 'snapshot_store')
+
+_HASH_LINE = re.compile(r'^([0-9a-f]{40})  (.+)$')
+
+
+class ContentStore(object):
+    """
+    Host side store of file contents keyed by their sha1 digest,
+    shared between snapshots so that a content is only ever pulled once
+    """
+
+    def __init__(self, root=SNAPSHOT_STORE_DIR):
+        self.root = root
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self.path_for(digest))
+
+    def add_from_chunks(self, digest, chunks):
+        """
+        write the content of a file into the store, it's only committed
+        if the received data hashes to the expected digest
+        :param digest: expected sha1 of the content
+        :param chunks: iterable of data chunks
+        :return: whether the content was stored
+        """
+        t_path = self.path_for(digest)
+        if not os.path.isdir(os.path.dirname(t_path)):
+            os.makedirs(os.path.dirname(t_path))
+
+        sha1 = hashlib.sha1()
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(t_path))
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                for chunk in chunks:
+                    sha1.update(chunk)
+                    fh.write(chunk)
+
+            if sha1.hexdigest() != digest:
+                return False
+            os.rename(tmp_path, t_path)
+            return True
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+
+class Snapshot(object):
+    """
+    The state of the captured directories, maps every file to its digest
+    and ownership, and every directory to its ownership
+    """
+
+    def __init__(self, files=None, dirs=None):
+        """
+        :param files: {path: [sha1, mode, uid, gid]}, the sha1 is None for files whose content
+        couldn't be captured, they're left alone by a restore
+        :param dirs: {path: [mode, uid, gid]}
+        """
+        self.files = files or {}
+        self.dirs = dirs or {}
+
+    def save(self, path):
+        with open(path, 'w') as fh:
+            json.dump({'files': self.files, 'dirs': self.dirs}, fh)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as fh:
+            data = json.load(fh)
+        return cls(data['files'], data['dirs'])
+
+
+class RestoreReport(object):
+
+    def __init__(self, pushed, removed, fixed, elapsed):
+        """
+        :param pushed: number of files pushed back to the device
+        :param removed: number of files and directories removed from the device
+        :param fixed: number of entries that only had their ownership restored
+        :param elapsed: seconds spent
+        """
+        self.pushed = pushed
+        self.removed = removed
+        self.fixed = fixed
+        self.elapsed = elapsed
+
+    def __str__(self):
+        return '{} files pushed, {} entries removed, {} entries fixed in {:.2f}s'.format(
+            self.pushed, self.removed, self.fixed, self.elapsed)
+
+
+class SnapshotEngine(object):
+    """
+    Incremental replacement of `adb backup`/`adb restore`,
+    a snapshot records per-file digests and the contents go to a host side
+    `ContentStore`, a restore then only touches what changed since the capture
+    """
+
+    script_path = '/data/local/tmp/xendroid_snapshot.sh'
+    staging_dir = '/data/local/tmp/xendroid_snapshot'
+
+    def __init__(self, adb_connection, store=None, roots=SNAPSHOT_ROOTS):
+        """
+        :param adb_connection: ADB connection to the device
+        :param store: the `ContentStore` to use, a shared one under MISC_FOLDER by default
+        :param roots: device directories to capture
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.adb_connection = adb_connection
+
+        self.store = store or ContentStore()
+        self.roots = roots
+
+    def _run_script(self, lines):
+        """
+        push a shell script to the device and run it as root
+        :param lines: lines of the script
+        :return: raw output of the script
+        """
+        fd, tmp_path = tempfile.mkstemp(suffix='.sh')
+        try:
+            with os.fdopen(fd, 'w') as fh:
+                fh.write('# generated by XenDroid\n{}\ntrue\n'.format('\n'.join(lines)))
+            self.adb_connection.push_to_path(tmp_path, self.script_path)
+        finally:
+            os.unlink(tmp_path)
+
+        return self.adb_connection.exec_out('su -c sh {}'.format(self.script_path))
+
+    def scan(self):
+        """
+        hash every file under the captured directories on the device
+        :return: a `Snapshot` of the current state
+        """
+        roots = ' '.join(quote(root) for root in self.roots)
+        out = self._run_script([
+            'find {} -type d -exec stat -c "d %a %u %g %n" {{}} + 2>/dev/null'.format(roots),
+            'find {} -type f -exec stat -c "f %a %u %g %n" {{}} + 2>/dev/null'.format(roots),
+            'find {} -type f -exec sha1sum {{}} + 2>/dev/null'.format(roots),
+        ])
+
+        snapshot = Snapshot()
+        digests = {}
+        for line in out.decode('utf-8', 'replace').split('\n'):
+            match = _HASH_LINE.match(line)
+            if match:
+                digests[match.group(2)] = match.group(1)
+                continue
+
+            fields = line.split(' ', 4)
+            if len(fields) != 5 or fields[0] not in ('d', 'f'):
+                continue
+
+            meta = [int(fields[1], 8), int(fields[2]), int(fields[3])]
+            if fields[0] == 'd':
+                snapshot.dirs[fields[4]] = meta
+            else:
+                snapshot.files[fields[4]] = meta
+
+        for path in list(snapshot.files):
+            # None when unreadable or changed during the scan, the path is still recorded
+            # so that a restore doesn't take it for a file added since
+            snapshot.files[path] = [digests.get(path)] + snapshot.files[path]
+
+        return snapshot
+
+    def _hash(self, path):
+        """
+        :param path: file on the device
+        :return: its current sha1 or None
+        """
+        cmd = 'su -c {}'.format(quote('sha1sum {}'.format(quote(path))))
+        match = _HASH_LINE.match(self.adb_connection.exec_out(cmd).decode('utf-8', 'replace').strip())
+        return match.group(1) if match else None
+
+    def _pull_to_store(self, path, digest):
+        cmd = 'su -c {}'.format(quote('cat {}'.format(quote(path))))
+        return self.store.add_from_chunks(digest, self.adb_connection.exec_out_stream(cmd))
+
+    def capture(self, manifest_path=None, retries=2):
+        """
+        take a snapshot of the device, only contents missing from the store are pulled
+        :param retries: attempts to pull again a file that changed while being captured,
+        after which it's recorded without content
+        :param manifest_path: where to save the snapshot's manifest
+        :return: the `Snapshot`
+        """
+        start = time.time()
+        self.logger.info('Taking a snapshot of the device...')
+
+        snapshot = self.scan()
+
+        pulled = 0
+        for path, entry in snapshot.files.items():
+            digest = entry[0]
+            for _ in range(retries + 1):
+                if digest is None or self.store.has(digest):
+                    break
+                if self._pull_to_store(path, digest):
+                    pulled += 1
+                    break
+                # changed while being pulled, e.g. a live database
+                digest = self._hash(path)
+            else:
+                digest = None
+
+            if digest is None:
+                self.logger.debug('{} could not be captured, it will be left alone by the restore'.format(path))
+            entry[0] = digest
+
+        if manifest_path is not None:
+            snapshot.save(manifest_path)
+
+        unverified = sum(1 for entry in snapshot.files.values() if entry[0] is None)
+        self.logger.info('Snapshot of {} files taken ({} without content), {} new contents pulled in {:.2f}s'.format(
+            len(snapshot.files), unverified, pulled, time.time() - start))
+        return snapshot
+
+    @staticmethod
+    def _set_meta(path, mode, uid, gid):
+        path = quote(path)
+        return 'chown {}:{} {p} 2>/dev/null; chmod {:o} {p} 2>/dev/null; restorecon {p} 2>/dev/null'.format(
+            uid, gid, mode, p=path)
+
+    def restore(self, snapshot):
+        """
+        bring the device back to the state of a snapshot, files that changed or
+        were deleted are pushed back, files and directories that were added are removed.
+        Nothing that was present at capture time is ever removed
+        :param snapshot: a `Snapshot` or the path to its manifest
+        :return: a `RestoreReport`
+        """
+        start = time.time()
+        if not isinstance(snapshot, Snapshot):
+            snapshot = Snapshot.load(snapshot)
+
+        self.logger.info('Restoring the device state from the snapshot...')
+        current = self.scan()
+
+        added = [p for p in current.files if p not in snapshot.files]
+        added += [p for p in current.dirs if p not in snapshot.dirs]
+        added_set = set(added)
+        # removing a directory takes its content along
+        to_remove = sorted(p for p in added if os.path.dirname(p) not in added_set)
+
+        lines = ['rm -rf {} 2>/dev/null'.format(quote(p)) for p in to_remove]
+
+        fixed = 0
+        for path in sorted(snapshot.dirs):
+            meta = snapshot.dirs[path]
+            if current.dirs.get(path) != meta:
+                lines.append('mkdir -p {} 2>/dev/null'.format(quote(path)))
+                lines.append(self._set_meta(path, *meta))
+                fixed += 1
+
+        to_push = {}
+        for path, entry in snapshot.files.items():
+            digest, meta = entry[0], entry[1:]
+            if digest is None:
+                # its content wasn't captured
+                continue
+            cur = current.files.get(path)
+            if cur is not None and cur[0] == digest:
+                if cur[1:] != meta:
+                    lines.append(self._set_meta(path, *meta))
+                    fixed += 1
+                continue
+
+            to_push.setdefault(digest, []).append(path)
+            staged = '{}/{}'.format(self.staging_dir, digest)
+            lines.append('cp {} {}'.format(staged, quote(path)))
+            lines.append(self._set_meta(path, *meta))
+
+        if to_push:
+            self.adb_connection.shell('mkdir -p {}'.format(self.staging_dir))
+            for digest in to_push:
+                if not self.store.has(digest):
+                    raise XenDroidADBError('Content {} is missing from the snapshot store'.format(digest))
+                self.adb_connection.push_to_path(
+                    self.store.path_for(digest), '{}/{}'.format(self.staging_dir, digest))
+
+        lines.append('rm -rf {}'.format(self.staging_dir))
+        self._run_script(lines)
+
+        pushed = sum(len(paths) for paths in to_push.values())
+        report = RestoreReport(pushed, len(to_remove), fixed, time.time() - start)
+        self.logger.info('Device restored: {}'.format(report))
+        return report
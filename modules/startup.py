@@ -6,14 +6,21 @@
 # it under the terms of the GNU General Public License
 
 
-import logging
 import os
+import time
+import logging
+import threading
 
-from lib.api.utils import download_and_extract_archive_from_url, get_filename_from_path
-from lib.definitions.constants import MISC_FOLDER, UTILS_FOLDER
-from lib.definitions.exceptions import XenDroidStartupError, XenDroidDependencyError
+from modules.cleanup import DeviceCleaner
+from lib.api.artifacts import ArtifactCache
+from lib.api.utils import file_digest
+from lib.definitions.constants import MISC_FOLDER, UTILS_FOLDER, FRIDA_SERVER_URL
+from lib.definitions.exceptions import (
+    XenDroidStartupError, XenDroidDependencyError, XenDroidDownloadError, XenDroidADBError
+)
 
 try:
+    import frida
     from frida import __version__ as FRIDA_VERSION
 
 except ImportError as e:
@@ -21,132 +28,326 @@ except ImportError as e:
 
 logger = logging.getLogger('Startup')
 
-adb_connection, device_arch, frida_server_fp = None, None, None
+# sha1 digests of the pushed binaries keyed by (path, size, mtime)
+_host_digests = {}
 
 
-def remove_apps_data_on_device():
+class StartupContext(object):
 
     """
-    Remove application's data from all the installed apps
-    :return:
+    State of the startup of a single device, replaces module level globals
+    so that several devices can be prepared at the same time
     """
 
-    t_folders = ('files', 'databases'
-                          'shared_prefs')
+    def __init__(self, adb_connection, offline=False, fake_internet=None):
+        """
+        :param adb_connection: ADB connection to the device
+        :param offline: only use already cached artifacts
+        :param fake_internet: `FakeInternet` to start for the device, or None
+        """
+        self.adb_connection = adb_connection
+        self.offline = offline
+        self.fake_internet = fake_internet
 
-    packages = adb_connection.shell('ls /data/data').split('\n')
+        self.device_arch = None
+        self.frida_server_fp = None
 
-    for package_name in packages:
-        for folder_name in t_folders:
-            cmd = 'su -c rm /data/data/{}/{}/*'.format(package_name, folder_name)
-            adb_connection.shell(cmd)
+        # seconds spent in every startup step
+        self.timings = {}
 
 
-def remove_user_files():
+class StartupStep(object):
+
+    def __init__(self, name, func, deps=()):
+        """
+        :param name: step name
+        :param func: callable taking the `StartupContext`
+        :param deps: names of the steps that must finish first
+        """
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+
+
+def remove_apps_data_on_device(ctx):
 
     """
-    Remove user files from the device storage to prepare for running the sample
-    :return:
+    Remove application's data from all the installed apps
+    :param ctx: startup context
+    :return: cleanup report
     """
 
-    all_dirs = adb_connection.shell('ls -R').split('\n\n')
+    return DeviceCleaner(ctx.adb_connection, roots=()).run()
 
-    extensions = ('.jpg', '.png',
-                  '.jpeg', '.mp4'
-                           '.db', '.xml')
 
-    logger.info('Safe deleting your data before running the target application...')
+def remove_user_files(ctx, dry_run=False):
 
-    for _dir in all_dirs:
-        dir_name = _dir.split(':')[0]
-        dir_files = _dir.split(':')[1].split('\n')
+    """
+    Remove user files from the device storage to prepare for running the sample
+    along with the data of the installed apps
+    :param ctx: startup context
+    :param dry_run: only list the files that would be deleted
+    :return: cleanup report, or a generator of file paths for a dry run
+    """
 
-        for filename in dir_files:
-            if filename.lower().endswith(extensions):
-                adb_connection.shell('su -c rm {}/{}'.format(dir_name, filename))
+    cleaner = DeviceCleaner(ctx.adb_connection)
+    if dry_run:
+        return cleaner.iter_targets()
 
-    remove_apps_data_on_device()
+    logger.info('Safe deleting your data before running the target application...')
 
+    report = cleaner.run()
+    logger.info('Deleted {} files from the device in {:.2f}s'.format(report.matched, report.elapsed))
+    if report.errors:
+        logger.warning('{} errors occurred while deleting files on the device'.format(report.errors))
 
-def download_frida_server():
+    return report
+
+
+def download_frida_server(ctx):
 
     # inspired from: https://github.com/AndroidTamer/frida-push
     """
-    Download the compatible frida version with the one installed on the system
-    extracting the compressed file
+    Get the frida server matching the version installed on the system
+    from the artifact cache, downloading and extracting it on a miss
+    :param ctx: startup context
+    """
+    logger.debug('Fetching the frida server...')
+
+    url = FRIDA_SERVER_URL.format(version=FRIDA_VERSION, arch=ctx.device_arch)
+    try:
+        ctx.frida_server_fp = ArtifactCache(offline=ctx.offline).fetch(
+            'frida-server', FRIDA_VERSION, ctx.device_arch, url)
+    except XenDroidDownloadError as err:
+        raise XenDroidStartupError('frida server download failed, aborting... ({})'.format(err))
+
+
+def get_host_digest(path):
+
+    """
+    sha1 of a host file, memoized as long as the file is unchanged
+    :param path:
+    :return:
     """
-    logger.debug('Downloading the frida server...')
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime)
 
-    url = "https://github.com/frida/frida/releases/download/{}/{}". \
-        format(FRIDA_VERSION, get_filename_from_path(frida_server_fp))
+    if key not in _host_digests:
+        _host_digests[key] = file_digest(path, 'sha1')
+    return _host_digests[key]
 
-    f_name = url.split('/')[-1]
-    f_path = os.path.join(MISC_FOLDER, f_name)
 
-    data = download_and_extract_archive_from_url(url, f_path)
+def push_if_changed(adb_connection, source_p, target_p):
 
-    if data:
-        with open(f_path[:-3], "wb") as frida_server:
-            frida_server.write(data)
-    else:
-        raise XenDroidStartupError('frida server download failed, aborting...')
+    """
+    Push an executable to the device unless the same file is already there
+    :param adb_connection: ADB connection to the device
+    :param source_p: host path
+    :param target_p: device path
+    :return: whether the file was pushed
+    """
+    try:
+        out = adb_connection.shell('sha1sum {}'.format(target_p)) or b''
+        device_digest = out.split()[0].decode() if out.strip() else None
+    except XenDroidADBError:
+        device_digest = None
 
+    if device_digest == get_host_digest(source_p):
+        logger.debug('{} is up to date on the device, skipping the push'.format(target_p))
+        return False
 
-def push_and_execute_frida():
+    adb_connection.push_to_path(source_p, target_p)
+    adb_connection.shell('su -c chmod 0755 {}'.format(target_p))
+    return True
+
+
+def frida_server_is_running(adb_connection):
 
     """
-    Push the frida server file and run the server on the device
+    Check whether a frida server is running on the device and answering requests
+    :param adb_connection: ADB connection to the device
     :return:
     """
-    logger.debug('Pushing and running the frida server on the device...')
+    try:
+        if not adb_connection.shell('pidof frida-server'):
+            return False
+    except XenDroidADBError:
+        return False
+
+    try:
+        frida.get_device(adb_connection.serial).enumerate_processes()
+    except (frida.InvalidArgumentError, frida.ServerNotRunningError,
+            frida.TransportError, frida.TimedOutError):
+        return False
+    return True
+
+
+def push_and_execute_frida(ctx):
+
+    """
+    Push the frida server file and run the server on the device,
+    a server already running from the same binary is reused
+    :param ctx: startup context
+    :return:
+    """
+    adb_connection = ctx.adb_connection
     t_executable = '/data/local/tmp/frida-server'
 
-    adb_connection.push_to_tmp(frida_server_fp, t_executable)
+    pushed = push_if_changed(adb_connection, ctx.frida_server_fp, t_executable)
+    if not pushed and frida_server_is_running(adb_connection):
+        logger.debug('Reusing the frida server running on the device...')
+        return
 
-    shell_cmds = ['chmod 0755 {}'.format(t_executable), 'killall frida-server',
-                  '{}&'.format(t_executable)]
+    logger.debug('Running the frida server on the device...')
+    try:
+        adb_connection.shell('su -c killall frida-server')
+    except XenDroidADBError:
+        # no previous server was running
+        pass
 
-    for cmd in shell_cmds:
-        adb_connection.shell('su -c {}'.format(cmd))
+    adb_connection.shell('su -c {}&'.format(t_executable))
 
 
-def push_tcpdump():
+def push_tcpdump(ctx):
 
     """
     Push the compiled tcpdump executable for the connected device
+    :param ctx: startup context
     :return:
     """
     t_executable = '/data/local/tmp/tcpdump'
-    tcpdump_sp = os.path.join(UTILS_FOLDER, 'tcpdump', device_arch[:3])
+    tcpdump_sp = os.path.join(UTILS_FOLDER, 'tcpdump', ctx.device_arch[:3])
+
+    push_if_changed(ctx.adb_connection, tcpdump_sp, t_executable)
 
-    adb_connection.push_to_tmp(tcpdump_sp, t_executable)
 
+def gain_root(ctx):
 
-def run_startup(_connection):
+    """
+    Restart adbd as root and remount the system partition as writable,
+    this restarts the device transport so it must precede any other device step
+    :param ctx: startup context
+    :return:
+    """
+    ctx.adb_connection.run_cmd('root')
+    ctx.adb_connection.run_cmd('remount')
 
-    global adb_connection, device_arch, frida_server_fp
 
-    os.makedirs(MISC_FOLDER)
+def detect_arch(ctx):
 
-    adb_connection = _connection
-    device_arch = adb_connection.get_device_arch()
+    """
+    Determine the architecture of the device
+    :param ctx: startup context
+    :return:
+    """
+    ctx.device_arch = ctx.adb_connection.get_device_arch()
 
-    if device_arch is None:
+    if ctx.device_arch is None:
         raise XenDroidStartupError('Unable to determine device architecture')
 
-    frida_server_fp = \
-        os.path.join(MISC_FOLDER, 'frida-server-{}-android-{}.xz'.
-                     format(device_arch, FRIDA_VERSION))
 
-    adb_connection.run_cmd('root')
-    adb_connection.run_cmd('remount')
+def start_fake_internet(ctx):
+
+    """
+    Start the fake internet and redirect the device's traffic to it, if one is used
+    :param ctx: startup context
+    :return:
+    """
+    if ctx.fake_internet is not None:
+        ctx.fake_internet.start(ctx.adb_connection)
+
+
+STARTUP_STEPS = (
+    StartupStep('root', gain_root),
+    StartupStep('arch', detect_arch, deps=['root']),
+    StartupStep('wipe', remove_user_files, deps=['root']),
+    StartupStep('frida_download', download_frida_server, deps=['arch']),
+    StartupStep('frida_start', push_and_execute_frida, deps=['frida_download']),
+    StartupStep('tcpdump_push', push_tcpdump, deps=['arch']),
+    StartupStep('fake_internet', start_fake_internet, deps=['root']),
+)
+
+
+def run_steps(ctx, steps):
 
-    remove_user_files()
+    """
+    Run the steps concurrently, each one starts as soon as all of its dependencies
+    finished, no new step is started once one fails
+    :param ctx: startup context
+    :param steps: iterable of `StartupStep`
+    :return:
+    """
+    pending = dict((step.name, step) for step in steps)
+    done, running, errors = set(), set(), []
+    cond = threading.Condition()
+
+    for step in pending.values():
+        unknown = set(step.deps) - set(pending)
+        if unknown:
+            raise XenDroidStartupError('Step `{}` depends on unknown steps: {}'.format(
+                step.name, ', '.join(sorted(unknown))))
+
+    def run_step(step):
+        start = time.time()
+        error = None
+        try:
+            step.func(ctx)
+        except Exception as err:
+            logger.exception('Startup step `{}` failed'.format(step.name))
+            error = err
+
+        with cond:
+            ctx.timings[step.name] = time.time() - start
+            running.discard(step.name)
+            if error is None:
+                done.add(step.name)
+            else:
+                errors.append(error)
+            cond.notify()
+
+    with cond:
+        while running or (pending and not errors):
+            ready = [] if errors else [s for s in pending.values() if set(s.deps) <= done]
+            if not ready and not running:
+                raise XenDroidStartupError('Circular dependency between the steps: {}'.format(
+                    ', '.join(sorted(pending))))
+
+            for step in ready:
+                del pending[step.name]
+                running.add(step.name)
+
+                thread = threading.Thread(target=run_step, args=(step,), name='startup-' + step.name)
+                thread.daemon = True
+                thread.start()
+
+            if running:
+                cond.wait()
+
+    if errors:
+        raise errors[0]
+
+
+def run_startup(_connection, offline=False, steps=STARTUP_STEPS, fake_internet=None):
 
-    if not frida_server_fp.exists():
-        download_frida_server()
-    push_and_execute_frida()
+    """
+    Prepare a device for the analysis
+    :param _connection: ADB connection to the device
+    :param offline: only use already cached artifacts
+    :param steps: startup steps to run
+    :param fake_internet: `FakeInternet` to wire the device to, or None
+    :return: the `StartupContext` of the device
+    """
+    if not os.path.isdir(MISC_FOLDER):
+        os.makedirs(MISC_FOLDER)
+
+    ctx = StartupContext(_connection, offline, fake_internet)
 
-    push_tcpdump()
+    start = time.time()
+    run_steps(ctx, steps)
 
+    logger.info('Startup timings: {} (total {:.2f}s)'.format(
+        ', '.join('{} {:.2f}s'.format(step.name, ctx.timings[step.name]) for step in steps),
+        time.time() - start))
     logger.debug('Device is ready!')
+
+    return ctx
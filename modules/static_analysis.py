@@ -0,0 +1,171 @@
+# Copyright (C) 2018  Muhammed Ziad
+# This file is part of XenDroid - https://github.com/muhzii/XenDroid
+#
+# An instrumented sandbox for Android
+# This program is a free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License
+
+
+import os
+import re
+import json
+import struct
+import logging
+import zipfile
+import tempfile
+
+from lib.api.utils import file_digest
+from lib.definitions.constants import DEX_ANALYSIS_DIR
+
+logger = logging.getLogger('StaticAnalysis')
+
+# bump whenever the content of the cached results changes
+ANALYSIS_VERSION = 2
+
+_DEX_FILE = re.compile(r'^classes\d*\.dex$')
+
+# method references meaning that the app loads code the dex files don't contain,
+# reflection and native libraries aren't in there as AndroidX, Kotlin or OkHttp
+# use them in nearly every APK, which would keep every hook every time
+DYNAMIC_CODE_REFS = {
+    ('Ldalvik/system/DexClassLoader;', '<init>'): 'DexClassLoader',
+    ('Ldalvik/system/InMemoryDexClassLoader;', '<init>'): 'InMemoryDexClassLoader',
+    ('Ldalvik/system/PathClassLoader;', '<init>'): 'PathClassLoader',
+    # only referenced by the constructors of the app's own dex class loaders
+    ('Ldalvik/system/BaseDexClassLoader;', '<init>'): 'BaseDexClassLoader subclass',
+    ('Ldalvik/system/DexFile;', '<init>'): 'DexFile',
+    ('Ldalvik/system/DexFile;', 'loadDex'): 'DexFile',
+}
+
+
+def _read_uleb128(data, offset):
+    result, shift = 0, 0
+    while True:
+        byte = ord(data[offset:offset + 1])
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7
+
+
+def parse_dex_method_refs(data):
+    """
+    list the methods a dex file references, whether it defines or calls them
+    :param data: content of the dex file
+    :return: set of (class descriptor, method name)
+    """
+    if data[:4] != b'dex\n':
+        raise ValueError('Not a dex file')
+
+    string_ids_size, string_ids_off, type_ids_size, type_ids_off = struct.unpack_from('<4I', data, 0x38)
+    method_ids_size, method_ids_off = struct.unpack_from('<2I', data, 0x58)
+
+    string_offsets = struct.unpack_from('<{}I'.format(string_ids_size), data, string_ids_off)
+    type_strings = struct.unpack_from('<{}I'.format(type_ids_size), data, type_ids_off)
+
+    strings = {}
+
+    def get_string(idx):
+        if idx not in strings:
+            # string_data_item: uleb128 utf16 size followed by null terminated MUTF-8
+            _, start = _read_uleb128(data, string_offsets[idx])
+            end = data.index(b'\x00', start)
+            strings[idx] = data[start:end].decode('utf-8', 'replace')
+        return strings[idx]
+
+    refs = set()
+    for i in range(method_ids_size):
+        class_idx, _, name_idx = struct.unpack_from('<HHI', data, method_ids_off + i * 8)
+        refs.add((get_string(type_strings[class_idx]), get_string(name_idx)))
+    return refs
+
+
+class ApkReferences(object):
+    """
+    Method names referenced by the dex files of an APK, and the reasons
+    why the APK may reach methods it doesn't reference
+    """
+
+    def __init__(self, method_names, dynamic):
+        """
+        :param method_names: set of the referenced method names
+        :param dynamic: reasons found for dynamic code, e.g. DexClassLoader
+        """
+        self.method_names = method_names
+        self.dynamic = dynamic
+
+    @classmethod
+    def from_apk(cls, apk_path):
+        method_names, dynamic = set(), set()
+        with zipfile.ZipFile(apk_path) as apk:
+            dex_files = [name for name in apk.namelist() if _DEX_FILE.match(name)]
+            if not dex_files:
+                dynamic.add('no dex file found')
+
+            for name in dex_files:
+                try:
+                    refs = parse_dex_method_refs(apk.read(name))
+                except (ValueError, struct.error, IndexError) as err:
+                    logger.warning('Unable to parse {}: {}'.format(name, err))
+                    dynamic.add('unparsable dex file')
+                    continue
+
+                for ref in refs:
+                    method_names.add(ref[1])
+                    if ref in DYNAMIC_CODE_REFS:
+                        dynamic.add(DYNAMIC_CODE_REFS[ref])
+
+        return cls(method_names, sorted(dynamic))
+
+    @classmethod
+    def for_apk(cls, apk_path, cache_dir=DEX_ANALYSIS_DIR):
+        """
+        get the references of an APK, cached by the APK's sha256
+        :param apk_path:
+        :param cache_dir: where the results are cached
+        :return: an `ApkReferences`
+        """
+        cache_path = os.path.join(cache_dir, '{}.v{}.json'.format(file_digest(apk_path), ANALYSIS_VERSION))
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r') as fh:
+                cached = json.load(fh)
+            return cls(set(cached['method_names']), cached['dynamic'])
+
+        refs = cls.from_apk(apk_path)
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        try:
+            with os.fdopen(fd, 'w') as fh:
+                json.dump({'method_names': sorted(refs.method_names), 'dynamic': refs.dynamic}, fh)
+            os.rename(tmp_path, cache_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        return refs
+
+
+def filter_hooks(hooks_def, apk_refs):
+    """
+    drop the hooks of the methods an APK never references, all the hooks
+    are kept if the APK may call methods dynamically, hooks marked as `always`
+    are always kept
+    :param hooks_def: list of hook definitions
+    :param apk_refs: `ApkReferences` of the APK
+    :return: tuple of (kept hooks, dropped hooks)
+    """
+    if apk_refs.dynamic:
+        return list(hooks_def), []
+
+    kept, dropped = [], []
+    for hook in hooks_def:
+        # the method names are all we can rely on, calls go through subclasses and interfaces
+        name = '<init>' if hook['method'] == '$init' else hook['method']
+        # `always` marks the methods the framework calls on the app's behalf
+        if hook.get('always') or name in apk_refs.method_names:
+            kept.append(hook)
+        else:
+            dropped.append(hook)
+    return kept, dropped
@@ -0,0 +1,111 @@
+# Copyright (C) 2018  Muhammed Ziad
+# This file is part of XenDroid - https://github.com/muhzii/XenDroid
+#
+# An instrumented sandbox for Android
+# This program is a free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License
+
+"""
+Drive the `AdbWireClient` against the in-process `FakeAdbServer`
+usage: python -m unittest discover tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from modules.connection.adb_wire import AdbWireClient, SYNC_DATA_MAX
+from modules.connection.adb_fake_server import FakeAdbServer
+from lib.definitions.exceptions import XenDroidADBError
+
+SERIAL = 'emulator-5554'
+
+
+class AdbWireClientTest(unittest.TestCase):
+
+    features = ('shell_v2', 'cmd')
+
+    def setUp(self):
+        self.server = FakeAdbServer(serials=(SERIAL,), features=self.features)
+        self.server.start()
+        self.client = AdbWireClient(SERIAL, port=self.server.port, timeout=10)
+        self.local_dir = tempfile.mkdtemp(prefix='xendroid_test_')
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        shutil.rmtree(self.local_dir)
+
+    def local_path(self, name):
+        return os.path.join(self.local_dir, name)
+
+    def test_host_query(self):
+        self.assertEqual(self.client.host_query('host:version'), b'0029')
+        self.assertEqual(self.client.features(), set(self.features))
+
+    def test_shell_exit_codes(self):
+        self.assertEqual(self.client.shell('true'), (b'', b'', 0))
+        self.assertEqual(self.client.shell('echo out; echo err >&2; exit 7'), (b'out\n', b'err\n', 7))
+        # the status is a single byte on the wire
+        self.assertEqual(self.client.shell('exit 300')[2], 300 & 0xff)
+
+    def test_exec_out_is_binary_safe(self):
+        self.assertEqual(self.client.exec_out("printf 'a\\000\\r\\nb'"), b'a\x00\r\nb')
+
+    def test_push_pull(self):
+        # spans several sync DATA packets
+        data = os.urandom(SYNC_DATA_MAX * 3 + 17)
+        with open(self.local_path('src'), 'wb') as fh:
+            fh.write(data)
+
+        self.client.push(self.local_path('src'), '/data/local/tmp/file', mode=0o755, mtime=1500000000)
+        with open(self.server.local_path('/data/local/tmp/file'), 'rb') as fh:
+            self.assertEqual(fh.read(), data)
+
+        mode, size, mtime = self.client.stat('/data/local/tmp/file')
+        self.assertEqual((mode & 0o777, size, mtime), (0o755, len(data), 1500000000))
+
+        self.client.pull('/data/local/tmp/file', self.local_path('dst'))
+        with open(self.local_path('dst'), 'rb') as fh:
+            self.assertEqual(fh.read(), data)
+
+    def test_stat_missing_path(self):
+        self.assertEqual(self.client.stat('/data/local/tmp/missing'), (0, 0, 0))
+
+    def test_pull_missing_path_fails(self):
+        with self.assertRaises(XenDroidADBError) as ctx:
+            self.client.pull('/data/local/tmp/missing', self.local_path('dst'))
+        self.assertIn('No such file or directory', str(ctx.exception))
+
+        # the failed connection isn't reused, the next sync request gets a new one
+        self.assertEqual(self.client.stat('/data/local/tmp/missing'), (0, 0, 0))
+
+    def test_sync_connections_are_pooled(self):
+        for _ in range(3):
+            self.client.stat('/data')
+        self.assertEqual(self.server.requests.count('sync:'), 1)
+
+    def test_unknown_device_fails(self):
+        client = AdbWireClient('missing-device', port=self.server.port, timeout=10)
+        with self.assertRaises(XenDroidADBError) as ctx:
+            client.shell('true')
+        self.assertIn("device 'missing-device' not found", str(ctx.exception))
+
+
+class AdbWireClientLegacyShellTest(AdbWireClientTest):
+    """
+    same tests against a device without the shell v2 protocol,
+    the exit status comes from a marker and stderr is merged into stdout
+    """
+
+    features = ('cmd',)
+
+    def test_shell_exit_codes(self):
+        self.assertEqual(self.client.shell('true'), (b'', b'', 0))
+        self.assertEqual(self.client.shell('echo out; exit 7'), (b'out\n', b'', 7))
+        self.assertEqual(self.client.shell('exit 300')[2], 300 & 0xff)
+
+
+if __name__ == '__main__':
+    unittest.main()
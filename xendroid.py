@@ -9,12 +9,10 @@
 
 
 import argparse
-import subprocess
-import time
 import logging
 
-from lib.definitions.exceptions import XenDroidDependencyError
 from modules.analysis_manager import AnalysisManager
+from modules.scheduler import AnalysisScheduler
 
 
 def parse_args():
@@ -25,43 +23,74 @@ def parse_args():
     """
     parser = argparse.ArgumentParser(description="Analyse malware dynamically on your real device/ emulator")
 
-    parser.add_argument("-s", action="store", required=True, dest="serial",
-                        help="device serial as per the output of 'adb devices'")
+    parser.add_argument("-s", action="append", required=True, dest="serials",
+                        help="device serial as per the output of 'adb devices', "
+                             "repeat to spread the analysis over several devices")
 
-    parser.add_argument("-p", action="store", required=True, dest="path_to_apk", help="path to the apk file")
+    parser.add_argument("-p", action="store", required=True, nargs="+", dest="apk_paths",
+                        help="path to the apk file, several files are analysed one task per device at a time")
 
     parser.add_argument("-d", action="store_true", required=False, dest="debug_mode", help="run XenDroid in debug mode")
 
+    parser.add_argument("-o", action="store_true", required=False, dest="offline",
+                        help="offline mode, only use already downloaded artifacts (e.g. frida-server)")
+
+    parser.add_argument("-u", action="store_true", required=False, dest="app_traffic_only",
+                        help="only capture the network traffic of the analysed app, "
+                             "falls back to the whole device if the device doesn't support it")
+
+    parser.add_argument("-i", action="store", required=False, dest="fake_internet", choices=["iptables", "reverse"],
+                        help="answer the device's DNS, HTTP and HTTPS traffic from the host, 'iptables' when the "
+                             "device reaches the host's address (see --host-ip), 'reverse' to go through "
+                             "adb reverse, which carries no DNS")
+
+    parser.add_argument("--host-ip", action="store", required=False, dest="host_ip", default="10.0.2.2",
+                        help="address of the host as seen by the device, 10.0.2.2 from an emulator")
+
+    parser.add_argument("--profile", action="store", type=float, required=False, dest="profile_interval",
+                        metavar="SECONDS",
+                        help="measure the overhead of every hook and dump it to logs/hooks_profile.json "
+                             "every SECONDS")
+
+    parser.add_argument("-b", action="store_true", required=False, dest="capture_blobs",
+                        help="keep the full content of large buffers captured by the hooks in the task's "
+                             "logs/blobs, otherwise only their digest and prefix are logged")
+
+    parser.add_argument("--blob-dir", action="store", required=False, dest="blob_dir",
+                        help="store the captured buffers of every task in this directory, implies -b")
+
     options = parser.parse_args()
+    options.capture_blobs = options.capture_blobs or options.blob_dir is not None
+    options.fake_internet_options = None
+    if options.fake_internet is not None:
+        options.fake_internet_options = {'mode': options.fake_internet, 'host_ip': options.host_ip}
     return options
 
 
+def run_many(options):
+    scheduler = AnalysisScheduler(options.serials, options.offline, app_traffic_only=options.app_traffic_only,
+                                  fake_internet=options.fake_internet_options,
+                                  profile_interval=options.profile_interval, capture_blobs=options.capture_blobs,
+                                  blob_dir=options.blob_dir)
+    for apk_path in options.apk_paths:
+        scheduler.submit(apk_path)
+    scheduler.run()
+
+
 def run():
     options = parse_args()
 
-    if options.serial is None:
-        cmd = ["adb", "devices"]
-        try:
-            r = subprocess.check_output(cmd).split('\n')
-        except OSError as e:
-            raise XenDroidDependencyError(e, 'adb')
-
-        if len(r) < 4:
-            print 'Waiting for a connected device...'
-            while True:
-                r = subprocess.check_output(cmd).split('\n')
-                if len(r) == 4:
-                    break
-            options.serial = r[1].split('\t')[0]
-        elif len(r) > 4:
-            print 'More than one device is attached, try with -s to specify a device serial'
-            time.sleep(2)
-            return
-        else:
-            options.serial = r[1].split('\t')[0]
-
     logging.basicConfig(level=logging.DEBUG if options.debug_mode else logging.INFO)
-    am = AnalysisManager(options.path_to_apk, options.serial)
+    if len(options.serials) > 1 or len(options.apk_paths) > 1:
+        run_many(options)
+        return
+
+    options.serial = options.serials[0]
+    options.path_to_apk = options.apk_paths[0]
+
+    am = AnalysisManager(options.path_to_apk, options.serial, options.offline, options.app_traffic_only,
+                         options.fake_internet_options, options.profile_interval, options.capture_blobs,
+                         options.blob_dir)
     try:
         am.start()
     finally: